@@ -0,0 +1,187 @@
+"""
+Cache of symmetry analyses keyed by structure prototype. Structures which only
+differ by an isotropic lattice scaling or by a relabelling of their species
+share the same space group, equivalent sites, Wyckoff positions and (fractional)
+symmetry operations, so spglib is only run once per prototype. The cached data
+reproduces what the scripts previously obtained from pymatgen's
+SpacegroupAnalyzer, with the same default tolerances.
+"""
+import hashlib
+import numpy as np
+
+SYMMETRY_CACHE = {}
+DEFAULT_SYMPREC = 0.01
+DEFAULT_ANGLE_TOLERANCE = 5
+
+
+def get_cell_arrays(structure):
+    """
+    Returns the lattice, scaled positions and atomic numbers of an ase Atoms or
+    pymatgen Structure
+    """
+    if hasattr(structure, 'get_scaled_positions'):
+        return (np.array(structure.get_cell()),
+                structure.get_scaled_positions(wrap=False),
+                np.array(structure.get_atomic_numbers()))
+    return (np.array(structure.lattice.matrix),
+            np.array(structure.frac_coords),
+            np.array(structure.atomic_numbers))
+
+
+def get_prototype_fingerprint(lattice, scaled_positions, numbers, symprec,
+                              angle_tolerance, decimals=6):
+    """
+    Returns the cache key of a structure, its lattice scale (cube root of the
+    volume) and its species in order of first appearance. The key is built from
+    the volume-normalized lattice, the wrapped scaled positions and the species
+    pattern (each species replaced by its order of first appearance).
+    """
+    scale = np.abs(np.linalg.det(lattice))**(1./3.)
+    species, first_indexes, pattern = np.unique(numbers, return_index=True,
+                                                return_inverse=True)
+    appearance_order = np.argsort(first_indexes)
+    species_labels = np.argsort(appearance_order)[pattern.reshape(-1)]
+
+    wrapped_positions = np.round(scaled_positions % 1.0, decimals) % 1.0
+    fingerprint = hashlib.sha1()
+    fingerprint.update((np.round(lattice/scale, decimals) + 0.0).tobytes())
+    fingerprint.update((wrapped_positions + 0.0).tobytes())
+    fingerprint.update(species_labels.astype(np.int64).tobytes())
+    fingerprint.update("{} {}".format(symprec, angle_tolerance).encode('utf-8'))
+    return fingerprint.hexdigest(), scale, species[appearance_order]
+
+
+def get_symmetry_data(structure, symprec=DEFAULT_SYMPREC,
+                      angle_tolerance=DEFAULT_ANGLE_TOLERANCE):
+    """
+    Returns the (cached) symmetry analysis of an ase Atoms or pymatgen Structure:
+    a dict with the space group number and symbol, the equivalent atoms, the
+    Wyckoff letters of each site and the fractional rotations and translations
+    """
+    import spglib
+
+    lattice, scaled_positions, numbers = get_cell_arrays(structure)
+    key, _, _ = get_prototype_fingerprint(lattice, scaled_positions, numbers,
+                                          symprec, angle_tolerance)
+    if key not in SYMMETRY_CACHE:
+        dataset = spglib.get_symmetry_dataset((lattice, scaled_positions, numbers),
+                                              symprec=symprec,
+                                              angle_tolerance=angle_tolerance)
+        if dataset is None:
+            raise Exception("spglib failed to find the symmetry of {}".format(structure))
+        if isinstance(dataset, dict):
+            get_field = dataset.get
+        else:
+            get_field = lambda x: getattr(dataset, x)
+        SYMMETRY_CACHE[key] = {
+            'number': int(get_field('number')),
+            'international': get_field('international'),
+            'equivalent_atoms': np.array(get_field('equivalent_atoms')),
+            'wyckoffs': list(get_field('wyckoffs')),
+            'rotations': np.array(get_field('rotations')),
+            'translations': np.array(get_field('translations')),
+        }
+    return SYMMETRY_CACHE[key]
+
+
+def get_equivalent_indices(structure, **kwargs):
+    """
+    Groups of symmetry equivalent site indexes, ordered by their lowest index (as
+    SymmetrizedStructure.equivalent_indices)
+    """
+    equivalent_atoms = get_symmetry_data(structure, **kwargs)['equivalent_atoms']
+    _, inverse = np.unique(equivalent_atoms, return_inverse=True)
+    return [np.nonzero(inverse.reshape(-1) == i)[0].tolist()
+            for i in range(np.max(inverse)+1)]
+
+
+def get_wyckoff_symbols(structure, **kwargs):
+    """
+    Wyckoff symbol (multiplicity and letter) of each group of equivalent sites
+    """
+    wyckoffs = get_symmetry_data(structure, **kwargs)['wyckoffs']
+    return ["{}{}".format(len(x), wyckoffs[x[0]])
+            for x in get_equivalent_indices(structure, **kwargs)]
+
+
+def get_cartesian_symmetry_operations(structure, **kwargs):
+    """
+    Returns the cartesian rotations and translations of the symmetry operations
+    """
+    symmetry_data = get_symmetry_data(structure, **kwargs)
+    lattice = get_cell_arrays(structure)[0]
+    rotations = np.einsum('ij,ojk,kl->oil', lattice.T, symmetry_data['rotations'],
+                          np.linalg.inv(lattice.T))
+    translations = np.dot(symmetry_data['translations'], lattice)
+    return rotations, translations
+
+
+def get_symmetry_operations(structure, **kwargs):
+    """
+    The cartesian symmetry operations as pymatgen SymmOps (as
+    SpacegroupAnalyzer.get_symmetry_operations(cartesian=True))
+    """
+    from pymatgen.core.operations import SymmOp
+
+    rotations, translations = get_cartesian_symmetry_operations(structure, **kwargs)
+    return [SymmOp.from_rotation_and_translation(x, y)
+            for x, y in zip(rotations, translations)]
+
+
+def symmetry_reduce(tensors, structure, tol=1e-8, **kwargs):
+    """
+    pymatgen.core.tensors.symmetry_reduce using the cached symmetry operations
+    """
+    from pymatgen.core.tensors import TensorMapping
+
+    symmetry_operations = get_symmetry_operations(structure, **kwargs)
+    unique_mapping = TensorMapping([tensors[0]], [[]], tol=tol)
+    for tensor in tensors[1:]:
+        is_unique = True
+        for unique_tensor in unique_mapping:
+            for symmetry_operation in symmetry_operations:
+                if np.allclose(unique_tensor.transform(symmetry_operation), tensor,
+                               atol=tol):
+                    unique_mapping[unique_tensor].append(symmetry_operation)
+                    is_unique = False
+                    break
+            if not is_unique:
+                break
+        if is_unique:
+            unique_mapping[tensor] = []
+    return unique_mapping
+
+
+def get_conventional_structure(ase_structure, symprec=DEFAULT_SYMPREC,
+                               angle_tolerance=DEFAULT_ANGLE_TOLERANCE):
+    """
+    pymatgen's conventional standard structure of an ase structure. The
+    conventional cell of a prototype is cached in units of the lattice scale and
+    with species labels, and rescaled and relabelled for each structure.
+    """
+    import ase
+
+    lattice, scaled_positions, numbers = get_cell_arrays(ase_structure)
+    key, scale, species = get_prototype_fingerprint(lattice, scaled_positions, numbers,
+                                                    symprec, angle_tolerance)
+    conventional_key = ('conventional', key)
+    if conventional_key not in SYMMETRY_CACHE:
+        from pymatgen.io.ase import AseAtomsAdaptor
+        from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+        mg_structure = AseAtomsAdaptor.get_structure(ase_structure)
+        sga = SpacegroupAnalyzer(mg_structure, symprec=symprec,
+                                 angle_tolerance=angle_tolerance)
+        standard_structure = sga.get_conventional_standard_structure()
+        species_labels = {x: i for i, x in enumerate(species)}
+        SYMMETRY_CACHE[conventional_key] = {
+            'lattice': np.array(standard_structure.lattice.matrix)/scale,
+            'scaled_positions': np.array(standard_structure.frac_coords),
+            'species_labels': np.array([species_labels[x]
+                                        for x in standard_structure.atomic_numbers]),
+        }
+
+    conventional = SYMMETRY_CACHE[conventional_key]
+    return ase.Atoms(numbers=species[conventional['species_labels']],
+                     scaled_positions=conventional['scaled_positions'],
+                     cell=conventional['lattice']*scale, pbc=True)
@@ -1,7 +1,7 @@
 import copy
 import pymatgen as mg
 from pymatgen.analysis.elasticity import DeformedStructureSet
-from pymatgen.core.tensors import symmetry_reduce
+from aiida_alloy.symmetry_cache import symmetry_reduce
 from pymatgen.analysis.elasticity.stress import Stress
 from pymatgen.analysis.elasticity.elastic import ElasticTensor
 import numpy as np
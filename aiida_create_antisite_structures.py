@@ -4,9 +4,11 @@ aiida.load_profile()
 from aiida.orm import Group
 from aiida.orm import StructureData
 from aiida_create_solutesupercell_structures import *
+from neighbor_shells import get_minimum_image_distances
 import ase
 import ase.build
 import click
+import itertools
 import numpy as np
 import random
 from aiida.orm import QueryBuilder
@@ -28,41 +30,101 @@ def get_allstructurenodes_fromgroup(structure_group):
 
     return [x[0] for x in sqb.all()]
 
-def get_smallestcellindex(ase_structure):
-    smallest_cellnorm = np.linalg.norm(ase_structure.cell[0])
-    smallest_index = 0
-    for i in range(len(ase_structure.cell)):
-        this_cellnorm = np.linalg.norm(ase_structure.cell[i])
-        if this_cellnorm < smallest_cellnorm:
-            smallest_index = i
-            smallest_cellnorm = this_cellnorm
-    return smallest_index
-
-def generate_supercell(inputstructure, target_numatoms):
-    output_cell = copy.deepcopy(inputstructure)
-    repeats = [1,1,1]
-    while True:
-        if len(output_cell) >= target_numatoms:
-            break
-        else:
-            smallest_index = get_smallestcellindex(output_cell)
-            repeats[smallest_index] += 1
-            output_cell = inputstructure.repeat(repeats)
-    return repeats, output_cell
+def get_supercell_candidates(cell, multiplicity):
+    """
+    Integer supercell matrices of determinant multiplicity: the diagonal repeats
+    and all matrices within one of the (rounded) transformation to a cube of the
+    target volume
+    """
+    diagonal_candidates = [np.diag([a, b, multiplicity//(a*b)])
+                           for a in range(1, multiplicity+1) if multiplicity % a == 0
+                           for b in range(1, multiplicity//a+1)
+                           if (multiplicity//a) % b == 0]
+
+    target_length = (multiplicity*np.abs(np.linalg.det(cell)))**(1./3.)
+    ideal_matrix = np.round(target_length*np.linalg.inv(cell)).astype(int)
+    offsets = np.array(list(itertools.product([-1, 0, 1], repeat=9))).reshape(-1, 3, 3)
+    candidates = np.concatenate([ideal_matrix[None, :, :] + offsets,
+                                 np.array(diagonal_candidates)])
+    determinants = np.round(np.linalg.det(candidates)).astype(int)
+    return candidates[determinants == multiplicity]
+
+def find_supercell_matrix(cell, multiplicity):
+    """
+    Returns the supercell matrix of determinant multiplicity maximizing the
+    minimum image distance (ties broken by the deviation from a cube), and the
+    minimum image distance. Only the cells are compared, no structure is built.
+    """
+    candidates = get_supercell_candidates(cell, multiplicity)
+    supercell_cells = np.einsum('cij,jk->cik', candidates, cell)
+    image_distances = np.round(get_minimum_image_distances(supercell_cells), 6)
+
+    target_length = (multiplicity*np.abs(np.linalg.det(cell)))**(1./3.)
+    cube_deviations = np.linalg.norm(np.abs(supercell_cells) -
+                                     target_length*np.identity(3)[None, :, :],
+                                     axis=(1, 2))
+    best_index = np.lexsort((cube_deviations, -image_distances))[0]
+    return candidates[best_index], image_distances[best_index]
+
+def make_supercell(inputstructure, supercell_matrix):
+    """
+    Builds the supercell of an input structure in one pass. The atoms of the
+    input cell come first, with their positions unchanged, such that site
+    indexes of the input structure remain valid in the supercell.
+    """
+    cell = np.array(inputstructure.get_cell())
+    corners = np.dot(np.array(list(itertools.product([0, 1], repeat=3))),
+                     supercell_matrix)
+    lattice_points = np.array(list(itertools.product(
+                       *[range(corners[:, i].min(), corners[:, i].max()+1)
+                         for i in range(3)])))
+    supercell_scaled = np.dot(lattice_points, np.linalg.inv(supercell_matrix))
+    inside = np.all((supercell_scaled > -1e-8) & (supercell_scaled < 1-1e-8), axis=1)
+    lattice_points = lattice_points[inside]
+    lattice_points = lattice_points[np.argsort(np.abs(lattice_points).sum(axis=1),
+                                               kind='stable')]
+
+    positions = (inputstructure.get_positions()[None, :, :] +
+                 np.dot(lattice_points, cell)[:, None, :]).reshape(-1, 3)
+    return ase.Atoms(numbers=np.tile(inputstructure.get_atomic_numbers(),
+                                     len(lattice_points)),
+                     positions=positions,
+                     cell=np.dot(supercell_matrix, cell),
+                     pbc=inputstructure.get_pbc())
+
+def generate_supercell(inputstructure, target_numatoms=None, min_image_distance=None):
+    """
+    Returns the supercell matrix and the supercell of the most isotropic
+    (largest minimum image distance) supercell with at least target_numatoms
+    atoms, or of the smallest supercell whose minimum image distance is at least
+    min_image_distance
+    """
+    cell = np.array(inputstructure.get_cell())
+    if min_image_distance is None:
+        multiplicity = max(1, int(np.ceil(float(target_numatoms)/len(inputstructure))))
+        supercell_matrix = find_supercell_matrix(cell, multiplicity)[0]
+    else:
+        multiplicity = 1
+        while True:
+            supercell_matrix, image_distance = find_supercell_matrix(cell, multiplicity)
+            if image_distance >= min_image_distance - 1e-6:
+                break
+            multiplicity += 1
+    return supercell_matrix, make_supercell(inputstructure, supercell_matrix)
 
 def get_unique_sites(structure_ase):
-    from pymatgen.io.ase import AseAtomsAdaptor
-    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-    structure_mg = AseAtomsAdaptor.get_structure(structure_ase)
-    sga = SpacegroupAnalyzer(structure_mg)
-    symmstruct_mg = sga.get_symmetrized_structure()
+    from aiida_alloy.symmetry_cache import get_equivalent_indices, get_wyckoff_symbols
+
+    # the symmetry analysis is shared by all inputs of the same prototype
+    equivalent_indices = get_equivalent_indices(structure_ase)
+    symbols = structure_ase.get_chemical_symbols()
 
-    elements = [x[0].species_string for x in symmstruct_mg.equivalent_sites]
+    elements = [symbols[x[0]] for x in equivalent_indices]
     count = [elements[:i+1].count(elements[i]) for i in range(len(elements))]
 
-    site_indices = [x[0] for x in symmstruct_mg.equivalent_indices]
+    site_indices = [x[0] for x in equivalent_indices]
     elements_count = ["{}{}".format(x[0],x[1]) for x in zip(elements, count)]
-    wyckoff = symmstruct_mg.wyckoff_symbols
+    wyckoff = get_wyckoff_symbols(structure_ase)
 
     unique_sites = list(zip(site_indices, elements_count, wyckoff))
     return unique_sites
@@ -75,34 +137,44 @@ def get_unique_sites(structure_ase):
 @click.option('-is', '--input_structures',
               help='A comma-seprated list of nodes/uuid to import')
 @click.option('-tss', '--target_supercellsize', default=None,
-              help="Target size for supercell")
+              help="Target size for supercell, the most isotropic supercell "
+                   "(including non-diagonal ones) with at least this many atoms is used")
+@click.option('-mid', '--min_image_distance', default=None, type=float,
+              help="Use the smallest supercell with at least this minimum image "
+                   "distance (in Ang) instead of a target size")
 @click.option('-se', '--solute_elements', required=True,
               help="List of solute elements to create antsites with. "
               " Can pass a list of elements using comma seperation"
               " E.g. Mg,Si,Cu. Can specify the creation of a vacancy using 'Vac'")
 @click.option('-sc', '--structure_comments', default="",
               help="Comment to be added to the extras")
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(input_group, input_structures,
-           target_supercellsize,  solute_elements,
+           target_supercellsize, min_image_distance, solute_elements,
            structure_comments, structure_group_label,
            structure_group_description,
-           dryrun):
+           output_format, output_path, flush_size, dryrun):
     """
     Script for generating substitutional and vacancy defects for an input structure
     or all structures in an input group.
     """
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label,
-                             description=structure_group_description)[0]
-    else:
-        structure_group = None
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     if input_group:
         input_group = Group(input_group)
@@ -121,16 +193,21 @@ def launch(input_group, input_structures,
             'structure_comments':structure_comments
                       }
 
-        input_structure_ase = structure_node.get_ase()
+        input_structure_ase = get_ase_structure(structure_node)
         #Unfortunately, we must get the unique sites prior to supercell
         #creation, meaning changes in site index can cause bugs
         unique_sites = get_unique_sites(input_structure_ase)
-        if target_supercellsize is not None:
-            target_supercellsize = int(target_supercellsize)
-            extras['target_supercellsize'] = target_supercellsize
-            input_structure_ase = generate_supercell(
-                                    input_structure_ase, target_supercellsize
-                                    )[1]
+        if target_supercellsize is not None or min_image_distance is not None:
+            if min_image_distance is not None:
+                extras['min_image_distance'] = min_image_distance
+            else:
+                target_supercellsize = int(target_supercellsize)
+                extras['target_supercellsize'] = target_supercellsize
+            supercell_matrix, input_structure_ase = generate_supercell(
+                                    input_structure_ase, target_supercellsize,
+                                    min_image_distance=min_image_distance)
+            extras['supercell_matrix'] = supercell_matrix.tolist()
+        host_lattice = HostLattice(input_structure_ase, species=solute_elements)
         for unique_site in unique_sites:
 
             site_index, element_index, wyckoff = unique_site
@@ -139,17 +216,15 @@ def launch(input_group, input_structures,
             extras['wyckoff'] = wyckoff 
 
             for element in solute_elements:
-                defect_structure = input_structure_ase.copy()
                 extras['element_new'] = element
-                if defect_structure[site_index].symbol == element:
+                if host_lattice.species[host_lattice.occupation[site_index]] == element:
                     continue
                 else:
-                   defect_structure[site_index].symbol = element
-                   store_asestructure(defect_structure, extras,
-                                      structure_group, dryrun)
-
-
+                   defect_occupation = host_lattice.decorate([site_index], [element])
+                   store_asestructure(host_lattice.to_atoms(defect_occupation), extras,
+                                      structure_group, dryrun, storage_batch)
 
+    storage_batch.flush()
 
 if __name__ == "__main__":
    launch()
@@ -35,25 +35,32 @@ def get_displacements_array(displacement):
               " E.g. Mg,Si,Cu. Can specify the creation of a vacancy using 'Vac'"
               " NOTE: will not generate symmetrically equivalent structures."
               " E.g. if Mg-Si dimer has been generated the script will skip Si-Mg")
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(box_size, dimer_separation,
            firstdimer_elements, seconddimer_elements,
            structure_group_label, structure_group_description,
-           dryrun):
+           output_format, output_path, flush_size, dryrun):
     """
     Script for creating surface structures for a given size and matrix element. Generates
     a set of structures with varying vacuum thickness
     """
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label, description=structure_group_description)[0]
-    else:
-        structure_group = None
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     box_size = float(box_size)
     extras = {'box_size':box_size}
@@ -75,7 +82,7 @@ def launch(box_size, dimer_separation,
         extras['second_element'] =  ""
         extras['atomatom_distance'] = ""
         store_asestructure(dimer_structure, extras,
-                           structure_group, dryrun)
+                           structure_group, dryrun, storage_batch)
 
         dimer_structure.append(first_atom) #This will be changed later
         for seconddimer_element in seconddimer_elements:
@@ -88,9 +95,11 @@ def launch(box_size, dimer_separation,
                 dimer_structure[1].position[0] = distance
                 extras['atomatom_distance'] = distance
                 store_asestructure(dimer_structure, extras,
-                                   structure_group, dryrun)
+                                   structure_group, dryrun, storage_batch)
 
         previous_firstdimer_elements += [firstdimer_element]
 
+    storage_batch.flush()
+
 if __name__ == "__main__":
    launch()
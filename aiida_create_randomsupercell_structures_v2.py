@@ -7,31 +7,10 @@ from aiida_create_solutesupercell_structures import *
 import ase
 import ase.build
 import click
+import functools
 import numpy as np
 import random
 
-def determine_selection(concentrations):
-    if not np.allclose(np.sum(concentrations), 1):
-        raise Exception("concentrations:{} do not sum to 1".format(concentrations))
-    random = np.random.rand()
-    cumm_concentration = np.cumsum(concentrations)
-    for i in range(len(cumm_concentration)):
-        if random <= cumm_concentration[i]:
-            return i
-    raise Exception("Error: no selection chosen!")
-
-def randomize_asestructure(ase_structure, elements, concentrations, seed):
-    random_f = np.random.RandomState(seed).rand()
-    for i in range(len(ase_structure)):
-        element_index = determine_selection(concentrations)
-        element_toinsert = elements[element_index]
-        if element_toinsert == "Vac":
-            print("DELETED!!!")
-            del ase_structure[i]
-        else:
-            ase_structure[i].symbol = element_toinsert
-    return ase_structure
-
 def get_averaged_lattice(lattices, concentrations):
     if len(lattices) != len(concentrations):
         raise Exception("Number of lattices must match concentrations")
@@ -44,6 +23,48 @@ def get_averaged_lattice(lattices, concentrations):
                               if x[0] >= 0])
     return average_lattice
 
+def generate_random_sample(matrix_seed, matrix_elements, lattice_sizes, concentrations,
+                           supercell_shape, random_displacement, master_seed,
+                           exact_composition):
+    """
+    Generates one random supercell (and its extras) from its own seed, such that
+    samples can be generated independently by the workers of generate_samples
+    """
+    rng = np.random.default_rng(matrix_seed)
+
+    #matrix_concentration = concentrations[0]
+    #solute_concentrations = concentrations[1:]
+    #res = np.array([x*random.random() for x in solute_concentrations])
+    #norm_res = (res/res.sum())*(1-matrix_concentration)
+    #norm_conc = np.array([matrix_concentration] + norm_res.tolist())
+
+    res = np.array(concentrations)*rng.random(len(concentrations))
+    norm_conc = (res/res.sum())
+
+    average_lattice = get_averaged_lattice(lattice_sizes, norm_conc)
+    extras = {
+        'matrix_elements':matrix_elements,
+        'lattice_sizes':lattice_sizes,
+        'average_lattice':average_lattice,
+        'concentrations': norm_conc,
+        'supercell_shape':supercell_shape,
+        'random_displacement_stdev':random_displacement,
+        'master_seed':master_seed,
+        'exact_composition':exact_composition,
+                  }
+    base_structure = gen_ase_supercell(average_lattice, supercell_shape, matrix_elements[0])
+    host_lattice = HostLattice(base_structure, species=matrix_elements)
+
+    extras['matrix_seed'] = matrix_seed
+    random_occupation = host_lattice.decorate_random(matrix_elements, norm_conc,
+                                                     rng, exact_composition)
+    random_ase = host_lattice.to_atoms(random_occupation,
+                                       vacancy_symbol=VACANCY_INTERNAL_SYMBOL)
+    displacement_seed = int(rng.integers(1, 2**32-1))
+    extras['displacement_seed'] = displacement_seed
+    random_ase.rattle(stdev=random_displacement, seed=displacement_seed)
+    return random_ase, extras
+
 @click.command()
 @click.option('-me', '--matrix_elements', required=True,
               help="list of elements to be used in the matrix")
@@ -60,32 +81,52 @@ def get_averaged_lattice(lattices, concentrations):
               help="Number of samples to generate")
 @click.option('-spsh', '--supercell_shape', required=True,
               help="shape of the supercell to use, format: Nx,Ny,Nz")
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-s', '--seed', default=None, type=int,
+              help="Master seed from which the seeds of all samples are spawned. "
+                   "By default a random master seed is used (stored in the extras)")
+@click.option('-ecm', '--exact_composition', is_flag=True,
+              help="Fix the composition of every sample to the (rounded) concentrations "
+                   "instead of drawing each site independently")
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
 @click.option('-nost', '--nostore', is_flag=True,
-              help="Do not store just dump out file directly")
+              help="Do not store just dump out file directly "
+                   "(same as --output_format poscar, by default in ./RANDOM_DUMP)")
+@click.option('-nw', '--num_workers', default=DEFAULT_NUM_WORKERS, type=int,
+              help="Number of processes generating the samples (0: all cores). "
+                   "The samples do not depend on the number of processes")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(matrix_elements, lattice_sizes, concentrations,
            random_displacement, number_samples, supercell_shape,
+           seed, exact_composition,
            structure_group_label, structure_group_description,
-           nostore,
-           dryrun):
+           nostore, num_workers,
+           output_format, output_path, flush_size, dryrun):
     """
     Script for generating random FCC supercells, where the matrix elements 
     """
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label, description=structure_group_description)[0]
-    else:
-        structure_group = None
-
     if nostore:
-        dumpdir = os.path.abspath("./RANDOM_DUMP")
-        print("STORING RESULTS IN ", dumpdir)
-        os.makedirs(dumpdir, exist_ok=True)
+        if output_format not in ['aiida', 'poscar']:
+            raise Exception("--nostore writes POSCAR files, it can not be combined "
+                            "with --output_format {}".format(output_format))
+        output_format = 'poscar'
+        if output_path is None:
+            output_path = "RANDOM_DUMP"
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     supercell_shape = supercell_shape.split(',')
     if len(supercell_shape) != 3:
@@ -100,42 +141,18 @@ def launch(matrix_elements, lattice_sizes, concentrations,
 
 
 
-    for i in range(number_samples):
-        #matrix_concentration = concentrations[0]
-        #solute_concentrations = concentrations[1:]
-        #res = np.array([x*random.random() for x in solute_concentrations])
-        #norm_res = (res/res.sum())*(1-matrix_concentration)
-        #norm_conc = np.array([matrix_concentration] + norm_res.tolist())
-
-        res = np.array([x*random.random() for x in concentrations])
-        norm_conc = (res/res.sum())
-
-        average_lattice = get_averaged_lattice(lattice_sizes, norm_conc)
-        extras = {
-            'matrix_elements':matrix_elements,
-            'lattice_sizes':lattice_sizes,
-            'average_lattice':average_lattice,
-            'concentrations': norm_conc,
-            'supercell_shape':supercell_shape,
-            'random_displacement_stdev':random_displacement
-                      }
-        base_structure = gen_ase_supercell(average_lattice, supercell_shape, matrix_elements[0])
-
-        random_structure = copy.deepcopy(base_structure)
-        matrix_seed = random.randint(1, 2**32-1)
-        extras['matrix_seed'] = matrix_seed
-        random_ase = randomize_asestructure(random_structure, matrix_elements,
-                                            norm_conc, matrix_seed)
-        displacement_seed = random.randint(1, 2**32-1)
-        extras['displacement_seed'] = displacement_seed
-        random_ase.rattle(stdev=random_displacement, seed=displacement_seed)
-
-        if nostore:
-            random_ase = ase.build.sort(random_ase)
-            dumpfile = os.path.join(dumpdir, "POSCAR_"+str(i))
-            random_ase.write(dumpfile, format="vasp")
-        else:
-            store_asestructure(random_structure, extras, structure_group, dryrun)
+    master_seed, sample_seeds = get_sample_seeds(number_samples, seed)
+    sample_function = functools.partial(generate_random_sample,
+                                        matrix_elements=matrix_elements,
+                                        lattice_sizes=lattice_sizes,
+                                        concentrations=concentrations,
+                                        supercell_shape=supercell_shape,
+                                        random_displacement=random_displacement,
+                                        master_seed=master_seed,
+                                        exact_composition=exact_composition)
+    random_samples = generate_samples(sample_function, sample_seeds,
+                                      num_workers=num_workers)
+    write_structures(random_samples, storage_batch)
 
 if __name__ == "__main__":
    launch()
@@ -7,8 +7,15 @@ import ase
 from ase.build import sort
 import click
 import copy
+import hashlib
+from neighbor_shells import *
+from site_occupations import *
+from cluster_orbits import *
+from structure_arrays import *
 import numpy as np
+import os
 import pandas as pd
+import sqlite3
 import sys
 
 """
@@ -25,7 +32,27 @@ def prep_elementlist(elementlist):
                       else VACANCY_INTERNAL_SYMBOL for x in elementlist]
     return elementlist
 
-GROUP_STRUCTURE_LIST=[]
+"""
+Structures are deduplicated by a fingerprint stored in their extras. The fingerprints
+of each group are cached locally in an SQLite database, shared by all the
+aiida_create_* scripts, such that the group does not need to be loaded on startup.
+The cache of a group is trusted only if the number and an order independent hash
+of the ids of the StructureData members of the group are unchanged.
+"""
+FINGERPRINT_EXTRA="structure_fingerprint"
+FINGERPRINT_DECIMALS=6
+FINGERPRINT_CACHE_PATH=os.environ.get("AIIDA_ALLOY_FINGERPRINT_CACHE",
+                                      "~/.aiida_alloy/structure_fingerprints.sqlite")
+GROUP_FINGERPRINT_INDEX={}
+# extra recording the hash of the dump files a structure was imported from
+SOURCE_HASH_EXTRA="source_content_hash"
+
+# number of structures stored per transaction by StructureStorageBatch
+DEFAULT_FLUSH_SIZE=500
+# number of processes used by generate_samples, 0 uses all cores
+DEFAULT_NUM_WORKERS=0
+# outputs of get_structure_sink, all but 'aiida' are file sinks of structure_sinks
+STRUCTURE_SINK_FORMATS=['aiida', 'poscar', 'runner', 'columnar']
 
 
 def gen_ase_supercell(lattice_size, supercell_shape, matrix_element):
@@ -44,36 +71,9 @@ def gen_ase_supercell(lattice_size, supercell_shape, matrix_element):
     return supercell_atoms
 
 def return_nn_distanceAndIndex(ase_supercell):
-    supercell_frame = pd.DataFrame(ase_supercell.get_positions(),
-                                   columns=['x','y','z'])
-    supercell_frame['distance'] = supercell_frame.apply(
-                                    np.linalg.norm, axis=1)
-    supercell_frame['distance'] = supercell_frame['distance'].round(9)
-
-    supercell_shape = ase_supercell.get_cell()
-    lx = supercell_shape[0][0]
-    ly = supercell_shape[1][1]
-    lz = supercell_shape[2][2]
-
-    # we assume the first solute is always at the origin
-    supercell_frame = supercell_frame[
-                 (supercell_frame['x'] <= lx/2.) &
-                 (supercell_frame['y'] <= ly/2.) &
-                 (supercell_frame['z'] <= lz/2.) ]
-
-    supercell_frame.sort_values('distance', inplace=True)
-    supercell_frame.drop_duplicates(subset='distance',
-                                    inplace=True)
-
-
-
-    distance_values = supercell_frame['distance'].values
-    index_values = supercell_frame.index.values
-
-    nn_distanceindex_frame = pd.DataFrame(data=list(zip(distance_values,index_values)),
-                                          columns=['distances','indexes'])
-
-    return nn_distanceindex_frame
+    # kept for backwards compatibility, see neighbor_shells.get_neighbor_shells
+    nn_distanceindex_frame = get_neighbor_shells(ase_supercell, center_index=0)
+    return nn_distanceindex_frame[['distances', 'indexes']]
 
 
 def get_allstructures_fromgroup(structure_group):
@@ -90,41 +90,207 @@ def get_allstructures_fromgroup(structure_group):
     sqb.append(Group, filters={'label': structure_group_label}, tag='g')
     sqb.append(StructureData, with_group='g')
 
-    res = [x[0].get_ase() for x in sqb.all()]
+    structure_nodes = [x[0] for x in sqb.all()]
+    res = [get_ase_from_arrays(x) for x in get_structure_arrays_batch(structure_nodes)]
     return res
 
-def checkif_structure_alreadyin_group(structure_tocheck, structure_group):
+def get_structure_fingerprint(ase_structure):
+    """
+    Returns a hash identifying a (sorted) structure by its formula, cell and
+    positions. Rounding to FINGERPRINT_DECIMALS replaces the allclose checks
+    previously used to compare structures.
+    """
+    return get_array_fingerprint(ase_structure.get_chemical_formula(),
+                                 np.array(ase_structure.get_cell()),
+                                 ase_structure.get_positions())
 
-    # pull the list of all structures in the group but only once per execution
-    global GROUP_STRUCTURE_LIST
-    if len(GROUP_STRUCTURE_LIST) == 0:
-        GROUP_STRUCTURE_LIST = get_allstructures_fromgroup(structure_group)
+def get_array_fingerprint(chemical_formula, cell, positions):
+    """
+    get_structure_fingerprint from the formula, cell and (sorted) positions
+    arrays, such that candidates can be rejected before building an Atoms object
+    """
+    cell = np.round(cell, FINGERPRINT_DECIMALS) + 0.0
+    positions = np.round(positions, FINGERPRINT_DECIMALS) + 0.0
+    fingerprint = hashlib.sha1()
+    fingerprint.update(chemical_formula.encode('utf-8'))
+    fingerprint.update(np.ascontiguousarray(cell, dtype=float).tobytes())
+    fingerprint.update(np.ascontiguousarray(positions, dtype=float).tobytes())
+    return fingerprint.hexdigest()
+
+def get_fingerprint_cache():
+    cache_path = os.path.expanduser(FINGERPRINT_CACHE_PATH)
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    cache = sqlite3.connect(cache_path)
+    cache.execute("CREATE TABLE IF NOT EXISTS fingerprints "
+                  "(group_uuid TEXT, fingerprint TEXT, node_uuid TEXT, "
+                  "PRIMARY KEY (group_uuid, fingerprint))")
+    cache.execute("CREATE TABLE IF NOT EXISTS group_members "
+                  "(group_uuid TEXT PRIMARY KEY, num_members INTEGER, member_hash TEXT)")
+    return cache
+
+def get_member_hash(node_ids, member_hash=0):
+    """
+    Order independent hash of node ids (xor of their hashes), which can be
+    updated with the ids of nodes added to a group
+    """
+    for node_id in node_ids:
+        member_hash ^= int(hashlib.sha1(str(node_id).encode('utf-8')).hexdigest()[:16], 16)
+    return member_hash
+
+def get_group_member_signature(structure_group):
+    """
+    Returns the number and the member hash of the StructureData ids of a group
+    """
+    from aiida.orm import QueryBuilder
 
-    for existing_structure in GROUP_STRUCTURE_LIST:
-        if structure_tocheck.get_chemical_formula() == existing_structure.get_chemical_formula():
-            pass
-        else: continue
+    qb = QueryBuilder()
+    qb.append(Group, filters={'uuid': structure_group.uuid}, tag='g')
+    qb.append(StructureData, with_group='g', project='id')
+    node_ids = [x[0] for x in qb.iterall()]
+    return len(node_ids), get_member_hash(node_ids)
+
+def get_cached_member_signature(cache, structure_group):
+    cached_signature = cache.execute(
+        "SELECT num_members, member_hash FROM group_members WHERE group_uuid=?",
+        (structure_group.uuid,)).fetchone()
+    if cached_signature is None:
+        return None
+    return cached_signature[0], int(cached_signature[1], 16)
+
+def set_cached_member_signature(cache, structure_group, member_signature):
+    cache.execute("INSERT OR REPLACE INTO group_members VALUES (?,?,?)",
+                  (structure_group.uuid, member_signature[0],
+                   "{:016x}".format(member_signature[1])))
+
+def get_groupfingerprints_fromdb(structure_group):
+    """
+    Retrieves the fingerprints of all structures in a group from their extras.
+    Only structures stored before the fingerprint was introduced are converted
+    to ase, after which their fingerprint extra is set.
+    """
+    from aiida.orm import QueryBuilder
+    from aiida.orm import load_node
 
-        if np.allclose(structure_tocheck.get_cell(), existing_structure.get_cell()):
-            pass
-        else: continue
+    sqb = QueryBuilder()
+    sqb.append(Group, filters={'uuid': structure_group.uuid}, tag='g')
+    sqb.append(StructureData, with_group='g',
+               project=['uuid', 'extras.{}'.format(FINGERPRINT_EXTRA)])
+
+    group_fingerprints = {}
+    for node_uuid, fingerprint in sqb.iterall():
+        if fingerprint is None:
+            structure_node = load_node(node_uuid)
+            fingerprint = get_structure_fingerprint(sort(get_ase_structure(structure_node)))
+            structure_node.set_extra(FINGERPRINT_EXTRA, fingerprint)
+        group_fingerprints[fingerprint] = node_uuid
+    return group_fingerprints
+
+def load_group_fingerprint_index(structure_group):
+    """
+    Returns the set of fingerprints of the structures in a group. The local
+    SQLite cache is used unless the StructureData members of the group changed
+    since it was written (only their ids are queried to check this), in which
+    case it is re-synchronized from the node extras.
+    """
+    if structure_group is None:
+        return set()
+
+    cache = get_fingerprint_cache()
+    member_signature = get_group_member_signature(structure_group)
+    if get_cached_member_signature(cache, structure_group) == member_signature:
+        cached_fingerprints = set(x[0] for x in cache.execute(
+                                  "SELECT fingerprint FROM fingerprints WHERE group_uuid=?",
+                                  (structure_group.uuid,)))
+        cache.close()
+        return cached_fingerprints
+
+    group_fingerprints = get_groupfingerprints_fromdb(structure_group)
+    with cache:
+        cache.execute("DELETE FROM fingerprints WHERE group_uuid=?",
+                      (structure_group.uuid,))
+        cache.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?,?,?)",
+                          [(structure_group.uuid, k, v)
+                           for k, v in group_fingerprints.items()])
+        set_cached_member_signature(cache, structure_group, member_signature)
+    cache.close()
+    return set(group_fingerprints)
+
+def get_group_fingerprint_index(structure_group):
+    # load the fingerprints of a group only once per execution
+    group_key = structure_group.uuid if structure_group is not None else None
+    if group_key not in GROUP_FINGERPRINT_INDEX:
+        GROUP_FINGERPRINT_INDEX[group_key] = load_group_fingerprint_index(structure_group)
+    return GROUP_FINGERPRINT_INDEX[group_key]
+
+def register_structure_fingerprints(fingerprint_nodes, structure_group):
+    """
+    Adds (fingerprint, node) pairs to the in-memory index and, for structures
+    stored in the group (node not None), to the local SQLite cache, updating
+    the member signature of the group if the cache was in sync with it.
+    """
+    get_group_fingerprint_index(structure_group).update(
+        [x[0] for x in fingerprint_nodes])
+    stored_nodes = [x for x in fingerprint_nodes if x[1] is not None]
+    if structure_group is None or len(stored_nodes) == 0:
+        return
 
-        if np.allclose(structure_tocheck.get_positions(), existing_structure.get_positions()):
-            pass
-        else: continue
+    cache = get_fingerprint_cache()
+    with cache:
+        cache.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?,?,?)",
+                          [(structure_group.uuid, x[0], x[1].uuid)
+                           for x in stored_nodes])
+        member_signature = get_cached_member_signature(cache, structure_group)
+        if member_signature is not None:
+            set_cached_member_signature(cache, structure_group,
+                                        (member_signature[0] + len(stored_nodes),
+                                         get_member_hash([x[1].pk for x in stored_nodes],
+                                                         member_signature[1])))
+    cache.close()
+
+def get_file_content_hash(file_paths):
+    """
+    Hash of the contents of the files an imported structure is read from, such
+    that importers can skip unchanged files without parsing them
+    """
+    content_hash = hashlib.sha1()
+    for file_path in file_paths:
+        with open(file_path, 'rb') as fp:
+            content_hash.update(fp.read())
+    return content_hash.hexdigest()
 
-        return True # structure matches all the tests within the for loop
+def get_group_extra_values(structure_group_label, extra_key):
+    """
+    Returns the set of values of an extra over the structures of a group,
+    retrieved with a single query
+    """
+    from aiida.orm import QueryBuilder
 
-    return False
+    sqb = QueryBuilder()
+    sqb.append(Group, filters={'label': structure_group_label}, tag='g')
+    sqb.append(StructureData, with_group='g',
+               filters={'extras': {'has_key': extra_key}},
+               project=['extras.{}'.format(extra_key)])
+    return set(x[0] for x in sqb.iterall())
 
+def checkif_structure_alreadyin_group(structure_tocheck, structure_group):
+    fingerprint = get_structure_fingerprint(structure_tocheck)
+    return fingerprint in get_group_fingerprint_index(structure_group)
 
-def store_asestructure(ase_structure, extras, structure_group, dryrun):
+
+def prepare_asestructure(ase_structure, extras):
+    """
+    Sorts the structure, converts vacancy symbols in the extras and deletes the
+    vacancy sites prior to storage
+    """
     ase_structure = sort(ase_structure)
     ase_structure.set_tags([0]*len(ase_structure)) #force AiiDA to use the same kind for each element
 
     # convert any instances of vacancy internal symbol use back to user symbol use
     for key in extras:
-        if extras[key] == VACANCY_INTERNAL_SYMBOL: extras[key] = VACANCY_USER_SYMBOL
+        if isinstance(extras[key], str) and extras[key] == VACANCY_INTERNAL_SYMBOL:
+            extras[key] = VACANCY_USER_SYMBOL
 
         if key == 'matrix_elements':
             extras[key] = [(lambda x: x if x != VACANCY_INTERNAL_SYMBOL
@@ -135,32 +301,177 @@ def store_asestructure(ase_structure, extras, structure_group, dryrun):
     del ase_structure[[x.index for x in ase_structure
                        if x.symbol==VACANCY_INTERNAL_SYMBOL or
                           x.symbol==VACANCY_USER_SYMBOL]]
+    return ase_structure, extras
+
+def get_structure_node(ase_structure, extras, fingerprint):
+    """
+    Creates an unstored StructureData with all of its extras set
+    """
+    aiida_structure = StructureData()
+    aiida_structure.set_ase(ase_structure)
+    node_extras = copy.deepcopy(extras)
+    node_extras["num_atoms"] = len(ase_structure)
+    node_extras["chem_formula"] = ase_structure.get_chemical_formula()
+    node_extras[FINGERPRINT_EXTRA] = fingerprint
+    aiida_structure.set_extra_many(node_extras)
+    return aiida_structure
+
+class StructureStorageBatch(object):
+    """
+    Buffers structures to be stored in a group. Every flush_size structures the
+    nodes (with their extras) are stored in a single transaction and added to
+    the group with a single call. flush() must be called once generation is done,
+    using the batch as a context manager does this automatically.
+    """
+    def __init__(self, structure_group, dryrun=False, flush_size=DEFAULT_FLUSH_SIZE):
+        self.structure_group = structure_group
+        self.dryrun = dryrun
+        self.flush_size = int(flush_size)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, ase_structure, extras):
+        ase_structure, extras = prepare_asestructure(ase_structure, extras)
+
+        fingerprint = get_structure_fingerprint(ase_structure)
+        group_fingerprint_index = get_group_fingerprint_index(self.structure_group)
+        if fingerprint in group_fingerprint_index:
+            print(("skiping structure, already stored in group: {}".format(ase_structure)))
+            return
+        group_fingerprint_index.add(fingerprint)
+
+        if self.dryrun:
+            print(("structure: {}".format(ase_structure)))
+            print(("extras: {}".format(extras)))
+            return
+
+        self.pending.append((get_structure_node(ase_structure, extras, fingerprint),
+                             fingerprint))
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        from aiida.manage.manager import get_manager
+
+        if len(self.pending) == 0:
+            return
+        aiida_structures = [x[0] for x in self.pending]
+        with get_manager().get_backend().transaction():
+            for aiida_structure in aiida_structures:
+                aiida_structure.store()
+        self.structure_group.add_nodes(aiida_structures)
+        register_structure_fingerprints([(x[1], x[0]) for x in self.pending],
+                                        self.structure_group)
+        print(("{} structures stored".format(len(aiida_structures))))
+        self.pending = []
+
+def store_asestructure(ase_structure, extras, structure_group, dryrun,
+                       storage_batch=None):
+    if storage_batch is not None:
+        storage_batch.add(ase_structure, extras)
+        return
 
-    alreadyin_group = checkif_structure_alreadyin_group(ase_structure, structure_group)
+    ase_structure, extras = prepare_asestructure(ase_structure, extras)
 
-    if alreadyin_group:
+    fingerprint = get_structure_fingerprint(ase_structure)
+    if fingerprint in get_group_fingerprint_index(structure_group):
         print(("skiping structure, already stored in group: {}".format(ase_structure)))
         return
 
     if dryrun:
         print(("structure: {}".format(ase_structure)))
         print(("extras: {}".format(extras)))
+        register_structure_fingerprints([(fingerprint, None)], structure_group)
     else:
         print(("storing structure: {}".format(ase_structure)))
-        aiida_structure = StructureData()
-        aiida_structure.set_ase(ase_structure)
+        aiida_structure = get_structure_node(ase_structure, extras, fingerprint)
         aiida_structure_stored = aiida_structure.store()
-        for key in extras:
-            aiida_structure_stored.set_extra(key, extras[key])
-
-        aiida_structure_stored.set_extra("num_atoms", len(ase_structure))
-        aiida_structure_stored.set_extra("chem_formula", ase_structure.get_chemical_formula())
 
         structure_group.add_nodes(aiida_structure_stored)
+        register_structure_fingerprints([(fingerprint, aiida_structure_stored)],
+                                        structure_group)
         print(("{} stored".format(aiida_structure_stored)))
 
     return
 
+def get_structure_sink(output_format, output_path, structure_group_label,
+                       structure_group_description="", dryrun=False,
+                       flush_size=DEFAULT_FLUSH_SIZE):
+    """
+    Returns the output group (None unless storing to AiiDA) and the sink consuming
+    the generated structures: a StructureStorageBatch for the 'aiida' output
+    format, otherwise one of the file sinks of structure_sinks
+    """
+    if output_format != 'aiida':
+        from structure_sinks import get_file_sink
+        return None, get_file_sink(output_format, output_path, dryrun=dryrun,
+                                   flush_size=flush_size)
+
+    if structure_group_label is None:
+        raise Exception("A structure group label is required to store in AiiDA")
+    if not dryrun:
+        structure_group = Group.objects.get_or_create(
+                             label=structure_group_label,
+                             description=structure_group_description)[0]
+    else:
+        structure_group = None
+    return structure_group, StructureStorageBatch(structure_group, dryrun=dryrun,
+                                                  flush_size=flush_size)
+
+def write_structures(structures, structure_sink):
+    """
+    Consumes an iterable of (ase_structure, extras) into a sink
+    """
+    for ase_structure, extras in structures:
+        structure_sink.add(ase_structure, extras)
+    structure_sink.flush()
+
+def apply_to_chunk(sample_function, argument_chunk):
+    return [sample_function(x) for x in argument_chunk]
+
+def generate_samples(sample_function, sample_arguments,
+                     num_workers=DEFAULT_NUM_WORKERS, chunksize=8):
+    """
+    Applies sample_function to each of sample_arguments (any iterable, consumed
+    lazily) in a process pool and yields the results in the order of
+    sample_arguments, such that a single writer (e.g. a StructureStorageBatch)
+    consumes them and the output does not depend on the number of workers. At
+    most two chunks per worker are in flight, so generation waits on a slow
+    writer instead of buffering results. sample_function must be picklable (a
+    module level function or a functools.partial of one) and must not access
+    the database.
+    """
+    import collections
+    import itertools
+    import multiprocessing
+
+    if num_workers == 0:
+        num_workers = os.cpu_count()
+    if num_workers <= 1:
+        for arguments in sample_arguments:
+            yield sample_function(arguments)
+        return
+
+    sample_arguments = iter(sample_arguments)
+    argument_chunks = iter(lambda: list(itertools.islice(sample_arguments, chunksize)), [])
+    with multiprocessing.Pool(num_workers) as pool:
+        pending_chunks = collections.deque()
+        for argument_chunk in argument_chunks:
+            pending_chunks.append(pool.apply_async(apply_to_chunk,
+                                                   (sample_function, argument_chunk)))
+            if len(pending_chunks) >= 2*num_workers:
+                for result in pending_chunks.popleft().get():
+                    yield result
+        while pending_chunks:
+            for result in pending_chunks.popleft().get():
+                yield result
+
 @click.command()
 @click.option('-a', '--lattice_size', required=True,
               help="lattice length (in Ang) to use")
@@ -178,7 +489,7 @@ def store_asestructure(ase_structure, extras, structure_group, dryrun):
               " E.g. Mg,Si,Cu. Can specify the creation of a vacancy using 'Vac'"
               " NOTE: will not generate symmetrically equivalent structures."
               " E.g. if Mg-Si solute solutes have been generated the script will skip Si-Mg")
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
@@ -188,13 +499,22 @@ def store_asestructure(ase_structure, extras, structure_group, dryrun):
               help="Maximum nearest neighbour index for solute-solutes")
 @click.option('-mxd', '--maximum_nn_distance', default=None,
               help="Maximum nearest neighbour distance for solute-solutes")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(lattice_size,
            supercell_shape, matrix_element,
            firstsolute_elements, secondsolute_elements,
            structure_group_label, structure_group_description, single_solute_only,
-           maximum_nn_index, maximum_nn_distance, dryrun):
+           maximum_nn_index, maximum_nn_distance,
+           output_format, output_path, flush_size, dryrun):
     """
     Script for creating supercells of a given size and matrix element (currently only FCC
     crystal structure supported). Generates a pure supercell of a given matrix, one single
@@ -217,12 +537,10 @@ def launch(lattice_size,
     if matrix_element in secondsolute_elements:
         raise Exception("cannot have the matrix element as a second solute")
 
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label,
-                             description=structure_group_description)[0]
-    else:
-        structure_group = None
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     base_extras = {
         'lattice_size':lattice_size,
@@ -231,52 +549,64 @@ def launch(lattice_size,
                   }
 
     pure_structure = gen_ase_supercell(lattice_size, supercell_shape, matrix_element)
+    host_lattice = HostLattice(pure_structure,
+                               species=firstsolute_elements+secondsolute_elements)
 
     pure_extras = copy.deepcopy(base_extras)
-    store_asestructure(pure_structure, pure_extras, structure_group, dryrun)
+    store_asestructure(pure_structure, pure_extras, structure_group, dryrun, storage_batch)
 
-    nn_distanceindex_frame = return_nn_distanceAndIndex(pure_structure)
+    nn_distanceindex_frame = get_neighbor_shells(pure_structure, center_index=0,
+                                                 max_shells=maximum_nn_index)
 
-    previously_generated_firstsol_elements = [] # to avoid duplication in generated structures
+    # permutations of the (0, j) solute pairs of each shell, to avoid duplication
+    # of symmetrically equivalent pairs (e.g. Si-Mg once Mg-Si is generated)
+    supercell_symmetry = get_supercell_symmetry(pure_structure)
+    pair_permutations = [None] + [get_cluster_permutations([0, x], supercell_symmetry)
+                                  for x in nn_distanceindex_frame['indexes'][1:]]
+    generated_pair_decorations = set()
     for firstsolute_element in firstsolute_elements:
 
-        singlesol_structure = copy.deepcopy(pure_structure)
-        singlesol_structure[0].symbol = firstsolute_element
+        singlesol_occupation = host_lattice.decorate([0], [firstsolute_element])
 
         singlesol_extras = copy.deepcopy(pure_extras)
         singlesol_extras['sol1_element'] = firstsolute_element
         singlesol_extras['sol1_index'] = 0
-        store_asestructure(singlesol_structure, singlesol_extras, structure_group, dryrun)
+        store_asestructure(host_lattice.to_atoms(singlesol_occupation),
+                           singlesol_extras, structure_group, dryrun, storage_batch)
 
         for secondsolute_element in secondsolute_elements:
             if single_solute_only:
                 break
 
-            # skip symmetrically equivalent structures
-            if secondsolute_element in previously_generated_firstsol_elements:
-                continue
-
             for i in range(1, len(nn_distanceindex_frame)):
-                secondsol_structure = copy.deepcopy(singlesol_structure)
                 secondsol_index = nn_distanceindex_frame['indexes'][i]
-                secondsol_structure[secondsol_index].symbol = secondsolute_element
-
-                secondsol_extras = copy.deepcopy(singlesol_extras)
-                secondsol_extras['sol2_element'] = secondsolute_element
-                secondsol_extras['sol2_index'] = secondsol_index
-                secondsol_extras['sol2_nn'] = i
                 secondsol_distance = nn_distanceindex_frame['distances'][i]
-                secondsol_extras['sol1sol2_distance'] = secondsol_distance
 
-                store_asestructure(secondsol_structure, secondsol_extras,
-                                   structure_group, dryrun)
+                pair_decoration = get_canonical_decoration(
+                                    [firstsolute_element, secondsolute_element],
+                                    pair_permutations[i])
+                if (i, pair_decoration) not in generated_pair_decorations:
+                    generated_pair_decorations.add((i, pair_decoration))
+                    secondsol_occupation = host_lattice.decorate([secondsol_index],
+                                                                 [secondsolute_element],
+                                                                 singlesol_occupation)
+
+                    secondsol_extras = copy.deepcopy(singlesol_extras)
+                    secondsol_extras['sol2_element'] = secondsolute_element
+                    secondsol_extras['sol2_index'] = secondsol_index
+                    secondsol_extras['sol2_nn'] = i
+                    secondsol_extras['sol1sol2_distance'] = secondsol_distance
+
+                    store_asestructure(host_lattice.to_atoms(secondsol_occupation),
+                                       secondsol_extras, structure_group, dryrun,
+                                       storage_batch)
 
                 if maximum_nn_index and i >= int(maximum_nn_index):
                     break
                 if maximum_nn_distance and secondsol_distance >= float(maximum_nn_distance):
                     break
 
-        previously_generated_firstsol_elements += [firstsolute_element]
+    storage_batch.flush()
 
 if __name__ == "__main__":
    launch()
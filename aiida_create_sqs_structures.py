@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+import aiida
+aiida.load_profile()
+from aiida.orm import Group
+from aiida_create_solutesupercell_structures import *
+from aiida_create_randomsupercell_structures import get_averaged_lattice
+from sqs_search import SQSOptimizer
+import click
+import numpy as np
+
+@click.command()
+@click.option('-me', '--matrix_elements', required=True,
+              help="list of elements to be used in the matrix")
+@click.option('-a', '--lattice_sizes', required=True,
+              help="list of lattice sizes (in Ang) to use in the same order as the elements "
+                   "the system will compute an average based on concentration "
+                   "-1 indicates the element will not be included in the average")
+@click.option('-c', '--concentrations', required=True,
+              help="list of concentrations to use in the same order as the elements"
+                   "concentrations must sum to 1")
+@click.option('-spsh', '--supercell_shape', required=True,
+              help="shape of the supercell to use, format: Nx,Ny,Nz")
+@click.option('-pc', '--pair_cutoff', required=True, type=float,
+              help="Cutoff (in Ang) of the pair clusters to optimize")
+@click.option('-tc', '--triplet_cutoff', default=None, type=float,
+              help="Cutoff (in Ang) of the triplet clusters to optimize")
+@click.option('-nst', '--number_steps', default=50000, type=int,
+              help="Number of Monte Carlo swaps per structure")
+@click.option('-t', '--temperature', default=1e-3, type=float,
+              help="Initial Monte Carlo temperature (in units of the objective), "
+                   "decreased linearly to zero")
+@click.option('-ns', '--number_samples', default=1, type=int,
+              help="Number of SQS structures to generate")
+@click.option('-s', '--seed', default=None, type=int,
+              help="Master seed from which the seeds of all samples are spawned")
+@click.option('-sg', '--structure_group_label', default=None,
+              help="Output AiiDA group to store created structures")
+@click.option('-sgd', '--structure_group_description', default="",
+              help="Description for output AiiDA group")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
+@click.option('-dr', '--dryrun', is_flag=True,
+              help="Prints structures and extras but does not store anything")
+def launch(matrix_elements, lattice_sizes, concentrations, supercell_shape,
+           pair_cutoff, triplet_cutoff, number_steps, temperature,
+           number_samples, seed,
+           structure_group_label, structure_group_description,
+           output_format, output_path, flush_size, dryrun):
+    """
+    Script for generating special quasirandom FCC supercells. The pair (and triplet)
+    cluster correlations are optimized towards those of the random alloy, with the
+    composition fixed to the (rounded) concentrations.
+    """
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
+
+    supercell_shape = supercell_shape.split(',')
+    if len(supercell_shape) != 3:
+        sys.exit("supercell_shape must be of the form Nx,Ny,Nz")
+    matrix_elements = prep_elementlist(matrix_elements)
+    lattice_sizes = [float(x) for x in lattice_sizes.split(',')]
+    concentrations = [float(x) for x in concentrations.split(',')]
+
+    matching_lists = [matrix_elements, lattice_sizes, concentrations]
+    if not all(len(x) == len(matching_lists[0]) for x in matching_lists):
+        raise Exception("unequal matrix_elements, lattice_sizes or concentrations")
+
+    average_lattice = get_averaged_lattice(lattice_sizes, concentrations)
+    base_structure = gen_ase_supercell(average_lattice, supercell_shape, matrix_elements[0])
+    host_lattice = HostLattice(base_structure, species=matrix_elements)
+    # the optimizer uses species indexes into matrix_elements
+    composition_counts = get_composition_counts(len(base_structure), concentrations)
+    sqs_concentrations = composition_counts/float(len(base_structure))
+    sqs_optimizer = SQSOptimizer(base_structure, sqs_concentrations,
+                                 pair_cutoff, triplet_cutoff=triplet_cutoff)
+
+    extras = {
+        'matrix_elements':matrix_elements,
+        'lattice_sizes':lattice_sizes,
+        'average_lattice':average_lattice,
+        'concentrations':concentrations,
+        'supercell_shape':supercell_shape,
+        'sqs_pair_cutoff':pair_cutoff,
+        'sqs_triplet_cutoff':triplet_cutoff,
+        'sqs_number_steps':number_steps,
+                  }
+
+    master_seed, sample_seeds = get_sample_seeds(number_samples, seed)
+    extras['master_seed'] = master_seed
+    for i in range(number_samples):
+        extras['matrix_seed'] = sample_seeds[i]
+        rng = np.random.default_rng(sample_seeds[i])
+        initial_occupation = get_random_occupation(len(base_structure), concentrations,
+                                                   rng, exact_composition=True)
+        sqs_occupation, sqs_objective = sqs_optimizer.optimize(
+                                          initial_occupation, rng, number_steps,
+                                          temperature=temperature)
+        print("sample {}: objective {}".format(i, sqs_objective))
+
+        extras['sqs_objective'] = sqs_objective
+        extras['sqs_correlations'] = sqs_optimizer.get_correlations(
+                                       sqs_occupation,
+                                       [x if x != VACANCY_INTERNAL_SYMBOL
+                                          else VACANCY_USER_SYMBOL
+                                        for x in matrix_elements])
+        symbol_species = np.array([host_lattice.species_index[x] for x in matrix_elements])
+        sqs_ase = host_lattice.to_atoms(symbol_species[sqs_occupation],
+                                        vacancy_symbol=VACANCY_INTERNAL_SYMBOL)
+        store_asestructure(sqs_ase, extras, structure_group, dryrun, storage_batch)
+
+    storage_batch.flush()
+
+if __name__ == "__main__":
+   launch()
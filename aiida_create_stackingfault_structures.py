@@ -4,14 +4,16 @@ aiida.load_profile()
 from aiida.orm import Group
 from aiida.orm import load_node
 from aiida_create_solutesupercell_structures import *
+from gamma_surface import (get_plane_symmetry, reduce_displacements,
+                           get_sheared_cells, get_refinement_displacements)
 import ase
 import ase.build
-from ase.geometry import get_layers
 import click
+import copy
+import itertools
 import json
 import os
 import numpy as np
-import pandas as pd
 
 def get_displacements_array(displacement):
     if len(displacement.split(',')) == 3:
@@ -23,19 +25,74 @@ def get_displacements_array(displacement):
        displacements = np.array([float(displacement)])
     return displacements
 
-def get_layer_frame(structure, miller_index):
-    layer_indexes, layer_distances = get_layers(structure, miller_index)
-    repeating_layer_distances = []
-    for i in range(len(layer_indexes)):
-        layer_distance = layer_distances[layer_indexes[i]]
-        repeating_layer_distances.append(layer_distance)
-    repeating_layer_distances = np.array(repeating_layer_distances)
+def get_displacement_increment(displacement_array):
+    if len(displacement_array) > 1:
+        return displacement_array[1] - displacement_array[0]
+    return 1.0
 
-    layer_dict = {'layer_index': layer_indexes,
-                  'layer_distance': repeating_layer_distances}
-    layer_frame = pd.DataFrame(data=layer_dict)
-    layer_frame.index.name = "structure_index"
-    return layer_frame
+def get_computed_gammasurface(structure_group_label, workchain_group_label):
+    """
+    Returns the displacements and energies of the (solute free) stacking fault
+    structures of structure_group_label with a successful workchain in
+    workchain_group_label
+    """
+    from aiida.orm import QueryBuilder, StructureData, WorkChainNode, Dict
+
+    qb = QueryBuilder()
+    qb.append(Group, filters={'label': workchain_group_label}, tag='wg')
+    qb.append(WorkChainNode, with_group='wg', tag='workchain',
+              filters={'attributes.exit_status': 0})
+    qb.append(StructureData, with_outgoing='workchain', tag='structure',
+              filters={'extras': {'!has_key': 'sol1_element'}},
+              project=['extras.displacement_x', 'extras.displacement_y'])
+    qb.append(Group, with_node='structure', filters={'label': structure_group_label})
+    qb.append(Dict, with_incoming='workchain',
+              edge_filters={'label': 'output_parameters'},
+              project=['attributes.energy'])
+    computed_energies = {}
+    for d_x, d_y, energy in qb.iterall():
+        if d_x is None or d_y is None or energy is None:
+            continue
+        computed_energies[(float(d_x), float(d_y))] = float(energy)
+    displacements = np.array(list(computed_energies.keys())).reshape(-1, 2)
+    return displacements, np.array(list(computed_energies.values()))
+
+def get_layer_ids(structure, tolerance=0.001):
+    """
+    Returns the integer (0,0,1) layer id of every atom, and the distance of each
+    layer along the plane normal (as ase.geometry.get_layers)
+    """
+    cell = np.array(structure.get_cell())
+    plane_normal = np.cross(cell[0], cell[1])
+    plane_normal /= np.linalg.norm(plane_normal)
+    heights = np.dot(structure.get_positions(), plane_normal)
+    order = np.argsort(heights, kind='mergesort')
+    new_layer = np.concatenate([[True], np.diff(heights[order]) > tolerance])
+    layer_ids = np.empty(len(heights), dtype=int)
+    layer_ids[order] = np.cumsum(new_layer) - 1
+    return layer_ids, heights[order][new_layer]
+
+def get_layer_sites(structure, layer_ids):
+    """
+    Returns one site per layer: the site closest (periodic) to the first site of
+    layer 0
+    """
+    reference_index = np.nonzero(layer_ids == 0)[0][0]
+    reference_distances = get_periodic_distances(structure, reference_index)
+    order = np.lexsort((reference_distances, layer_ids))
+    first_in_layer = np.concatenate([[True], np.diff(layer_ids[order]) != 0])
+    return order[first_in_layer]
+
+def get_solute_configurations(solute_layers, solute_elements, number_solutes):
+    """
+    All placements of number_solutes solutes in distinct solute_layers, as lists
+    of layers and of elements (ordered by element combination, then layers)
+    """
+    layer_combinations = list(itertools.combinations(solute_layers, number_solutes))
+    element_combinations = list(itertools.product(solute_elements, repeat=number_solutes))
+    configuration_layers = [list(x) for y in element_combinations for x in layer_combinations]
+    configuration_elements = [list(y) for y in element_combinations for x in layer_combinations]
+    return configuration_layers, configuration_elements
 
 
 @click.command()
@@ -70,6 +127,19 @@ def get_layer_frame(structure, miller_index):
                    "Overides the displacement_{x,y} commands. "
                    "May not be defined for all lattice/surface combinations. "
                    "Useful for benchmarking.")
+@click.option('-gsm', '--gamma_surface', is_flag=True,
+              help="Only create the symmetry inequivalent displacements of the "
+                   "displacement_{x,y} grid (the gamma_multiplicity extra counts "
+                   "the equivalent grid points)")
+@click.option('-rwg', '--refine_workchain_group', default=None,
+              help="Adaptively refine the gamma surface already in structure_group_label "
+                   "using the energies of the finished workchains in this group. "
+                   "Creates the midpoints between neighbouring computed displacements "
+                   "(displacement_{x,y} increments apart) whose energies differ by more "
+                   "than refine_energy_tolerance")
+@click.option('-ret', '--refine_energy_tolerance', default=0.01, type=float,
+              help="Energy difference (in eV) above which the linear interpolation "
+                   "between two computed displacements is refined")
 @click.option('-prm', '--primitive', is_flag=True,
               help="Create primitive cell version (i.e non-orthogonal). ")
 @click.option('-se', '--solute_elements', required=False,
@@ -82,34 +152,46 @@ def get_layer_frame(structure, miller_index):
               " E.g. if Mg-Si solute solutes have been generated the script will skip Si-Mg")
 @click.option('-msl', '--maxsolute_layer', default=None,
               help="Maximum layer to place solutes away from the SF")
+@click.option('-nsl', '--number_solute_layers', default=1, type=int,
+              help="Number of solutes placed simultaneously, each in a different layer. "
+                   "All combinations of layers and solute elements are created")
 @click.option('-tsl', '--testsolute_layer', is_flag=True,
               help="Place one solute at the midpoint (test) of the SF")
 @click.option('-rsl', '--refsolute', is_flag=True,
               help="Place one solute at the origin of an undistorted slab with size of a SF")
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(lattice_size, matrix_element, lattice_and_surface,
            customstructure_node,
            periodic_xrepeats, periodic_yrepeats, periodic_zrepeats,
            displacement_x, displacement_y, special_pointsonly,
-           primitive, solute_elements, maxsolute_layer, testsolute_layer,
+           gamma_surface, refine_workchain_group, refine_energy_tolerance,
+           primitive, solute_elements, maxsolute_layer, number_solute_layers,
+           testsolute_layer,
            refsolute, structure_group_label, structure_group_description,
-           dryrun):
+           output_format, output_path, flush_size, dryrun):
     """
     Script for creating stacking fault structures for a given size and matrix element. Generates
     a set of distorted structures using the 'tilted cell method', i.e. by adding fractional
     increments of the 'x' and 'y' cell vectors to the the 'z', vector.
     """
     STABLE_STACKING_NAME = 'stable_stacking'
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label, description=structure_group_description)[0]
-    else:
-        structure_group = None
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
 
 
@@ -155,7 +237,7 @@ def launch(lattice_size, matrix_element, lattice_and_surface,
                                           )
     elif customstructure_node:
         custom_structure = load_node(customstructure_node)
-        undistorted_structure = custom_structure.get_ase()
+        undistorted_structure = get_ase_structure(custom_structure)
         extras = custom_structure.extras
         if '_aiida_hash' in extras:
             del extras['_aiida_hash']
@@ -191,6 +273,55 @@ def launch(lattice_size, matrix_element, lattice_and_surface,
     dispy_array = get_displacements_array(displacement_y)
     displacements = [[d_x, d_y] for d_x in dispx_array for d_y in dispy_array]
     special_pointnames = []
+    gamma_multiplicities = None
+    refinement_uncertainties = None
+
+    if (gamma_surface or refine_workchain_group) and (special_pointsonly or
+                                                      solute_elements):
+        raise Exception("--gamma_surface/--refine_workchain_group replace the "
+                        "displacement grid and cannot be combined with "
+                        "--special_pointsonly or --solute_elements")
+
+    if gamma_surface or refine_workchain_group:
+        plane_rotations, plane_translations = get_plane_symmetry(
+                                                undistorted_structure,
+                                                periodic_xrepeats, periodic_yrepeats)
+        print("{} plane symmetry operations, {} in-plane translations".format(
+              len(plane_rotations), len(plane_translations)))
+
+    if gamma_surface and not refine_workchain_group:
+        representatives = reduce_displacements(displacements,
+                                               plane_rotations, plane_translations)
+        unique_displacements, gamma_multiplicities = np.unique(representatives,
+                                                               return_counts=True)
+        print("reduced {} displacements to {} by symmetry".format(
+              len(displacements), len(unique_displacements)))
+        displacements = [displacements[i] for i in unique_displacements]
+        gamma_multiplicities = list(gamma_multiplicities)
+
+    if refine_workchain_group:
+        if structure_group is None:
+            raise Exception("Refinement requires the (aiida) structure group "
+                            "of the computed gamma surface")
+        known_displacements, known_energies = get_computed_gammasurface(
+                                                structure_group.label,
+                                                refine_workchain_group)
+        if len(known_displacements) == 0:
+            raise Exception("No computed displacements found in {} for {}".format(
+                            structure_group.label, refine_workchain_group))
+        increments = (get_displacement_increment(dispx_array),
+                      get_displacement_increment(dispy_array))
+        refined_displacements, refinement_uncertainties = get_refinement_displacements(
+                                                            known_displacements,
+                                                            known_energies, increments,
+                                                            plane_rotations,
+                                                            plane_translations,
+                                                            refine_energy_tolerance)
+        print("{} computed displacements, {} refinement displacements".format(
+              len(known_displacements), len(refined_displacements)))
+        displacements = refined_displacements.tolist()
+        refinement_uncertainties = refinement_uncertainties.tolist()
+        gamma_multiplicities = None
 
     if special_pointsonly:
         displacements = [] # overide any user displacements
@@ -212,38 +343,67 @@ def launch(lattice_size, matrix_element, lattice_and_surface,
             special_pointnames.append(STABLE_STACKING_NAME)
         displacements.append([d_x, d_y])
 
-    for displacement in displacements:
+    # all tilted cells are built at once, the atoms are shared by every displacement
+    sheared_cells = get_sheared_cells(undistorted_structure.get_cell(), a1, a2,
+                                      displacements)
+    numbers = undistorted_structure.get_atomic_numbers()
+    positions = undistorted_structure.get_positions()
+    for i, displacement in enumerate(displacements):
         d_x, d_y = displacement
-        extras['displacement_x'] = d_x
-        extras['displacement_y'] = d_y
+        displacement_extras = copy.deepcopy(extras)
+        displacement_extras['displacement_x'] = d_x
+        displacement_extras['displacement_y'] = d_y
         if special_pointsonly:
-            extras['special_point'] = special_pointnames.pop(0)
-        distorted_structure = undistorted_structure.copy()
-        distorted_structure.cell[2] += a1*d_x
-        distorted_structure.cell[2] += a2*d_y
-        store_asestructure(distorted_structure, extras, structure_group, dryrun)
+            displacement_extras['special_point'] = special_pointnames[i]
+        if gamma_surface or refine_workchain_group:
+            displacement_extras['gamma_surface'] = True
+        if gamma_multiplicities is not None:
+            displacement_extras['gamma_multiplicity'] = int(gamma_multiplicities[i])
+        if refinement_uncertainties is not None:
+            displacement_extras['gamma_refinement_uncertainty'] = float(
+                                                                    refinement_uncertainties[i])
+        distorted_structure = ase.Atoms(numbers=numbers, positions=positions,
+                                        cell=sheared_cells[i], pbc=True)
+        store_asestructure(distorted_structure, displacement_extras, structure_group,
+                           dryrun, storage_batch)
 
     solute_elements = prep_elementlist(solute_elements)
-    for solute_element in solute_elements:
-        extras['sol1_element'] = solute_element
-        layer_frame = get_layer_frame(distorted_structure, (0,0,1))
-        layer_frame = layer_frame.drop_duplicates("layer_index").reset_index()
-        solute_layers = list(range(int(len(layer_frame)/2)))
+    if len(solute_elements) > 0:
+        layer_ids, layer_distances = get_layer_ids(distorted_structure)
+        layer_sites = get_layer_sites(distorted_structure, layer_ids)
+        solute_layers = list(range(int(len(layer_sites)/2)))
         if refsolute:
             solute_layers = [0]
         if testsolute_layer:
-            solute_layers = [int(len(layer_frame)/2)-1]
-        for i in solute_layers:
-            solute_structure = distorted_structure.copy()
-            solute_index = int(layer_frame.loc[i]['structure_index'])
-            solute_structure[solute_index].symbol = solute_element
-            extras['sol1_index'] = solute_index
-            extras['sol1sf_distance'] = layer_frame.loc[i]['layer_distance']
-            extras['sol1layer_index'] = int(layer_frame.loc[i]['layer_distance'])
-            store_asestructure(solute_structure, extras, structure_group, dryrun)
-            if maxsolute_layer and i >= int(maxsolute_layer):
-                break
+            solute_layers = [int(len(layer_sites)/2)-1]
+        if maxsolute_layer:
+            solute_layers = [x for x in solute_layers if x <= int(maxsolute_layer)]
+        if number_solute_layers > len(solute_layers):
+            raise Exception("Cannot place {} solutes in {} layers".format(
+                            number_solute_layers, len(solute_layers)))
+
+        configuration_layers, configuration_elements = get_solute_configurations(
+                                                         solute_layers, solute_elements,
+                                                         number_solute_layers)
+        configuration_sites = layer_sites[np.array(configuration_layers)]
+        host_lattice = HostLattice(distorted_structure, species=solute_elements)
+        solute_occupations = host_lattice.decorate_batch(configuration_sites,
+                                                         configuration_elements)
+        for layers, elements, sites, solute_occupation in zip(
+                configuration_layers, configuration_elements,
+                configuration_sites, solute_occupations):
+            # the gamma surface extras are never set together with solutes
+            solute_extras = copy.deepcopy(displacement_extras)
+            for j in range(number_solute_layers):
+                solute_label = 'sol{}'.format(j+1)
+                solute_extras[solute_label+'_element'] = elements[j]
+                solute_extras[solute_label+'_index'] = int(sites[j])
+                solute_extras[solute_label+'sf_distance'] = layer_distances[layers[j]]
+                solute_extras[solute_label+'layer_index'] = int(layer_distances[layers[j]])
+            store_asestructure(host_lattice.to_atoms(solute_occupation), solute_extras,
+                               structure_group, dryrun, storage_batch)
 
+    storage_batch.flush()
 
 if __name__ == "__main__":
    launch()
@@ -41,25 +41,32 @@ def get_displacements_array(displacement):
               help="The thickness of the vacuum in Ang"
                    "The notation is: "
                    "start,end,increment or displacement_value.")
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(lattice_size, matrix_element, lattice_and_surface,
            periodic_xrepeats, periodic_yrepeats, periodic_zrepeats, vacuum_thickness,
            structure_group_label, structure_group_description,
-           dryrun):
+           output_format, output_path, flush_size, dryrun):
     """
     Script for creating surface structures for a given size and matrix element. Generates
     a set of structures with varying vacuum thickness
     """
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label, description=structure_group_description)[0]
-    else:
-        structure_group = None
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     lattice_size = float(lattice_size)
     lattice_type, surface_plane = lattice_and_surface.split('_')
@@ -124,7 +131,9 @@ def launch(lattice_size, matrix_element, lattice_and_surface,
         extras['vacuum_thickness'] = vct_i
         distorted_structure = undistorted_structure.copy()
         distorted_structure.cell[2][2] += vct_i
-        store_asestructure(distorted_structure, extras, structure_group, dryrun)
+        store_asestructure(distorted_structure, extras, structure_group, dryrun, storage_batch)
+
+    storage_batch.flush()
 
 if __name__ == "__main__":
    launch()
@@ -20,24 +20,34 @@ import itertools
               help="element to be used as the matrix")
 @click.option('-te', '--triplet_elements', required=True,
               help="elements to be used for the solute triplets")
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-cc', '--cluster_cutoff', default=None,
+              help="If specified, generate all symmetrically distinct solute triplets "
+                   "with all solute-solute distances below the cutoff (in Ang)")
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(lattice_size, supercell_shape, matrix_element,
-           triplet_elements,
+           triplet_elements, cluster_cutoff,
            structure_group_label, structure_group_description,
-           dryrun):
+           output_format, output_path, flush_size, dryrun):
     """
     Script for generating solute triplets 
     """
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label, description=structure_group_description)[0]
-    else:
-        structure_group = None
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     lattice_size = float(lattice_size)
 
@@ -55,21 +65,35 @@ def launch(lattice_size, supercell_shape, matrix_element,
     pure_extras = copy.deepcopy(base_extras)
 
     triplet_elements = prep_elementlist(triplet_elements)
-    triplets = list(itertools.combinations_with_replacement(
-                      triplet_elements, 3))
-    for triplet in triplets:
-        triplet_extras = copy.deepcopy(base_extras)
-        triplet_extras['triplet'] = triplet
-
-        triplet_structure = copy.deepcopy(pure_structure)
-        triplet_structure[0].symbol = triplet[0]
-        triplet_structure[1].symbol = triplet[1]
-        triplet_structure[2].symbol = triplet[2]
+    host_lattice = HostLattice(pure_structure, species=triplet_elements)
+    supercell_symmetry = get_supercell_symmetry(pure_structure)
+    if cluster_cutoff:
+        triplet_clusters = get_cluster_orbits(pure_structure, 3, float(cluster_cutoff),
+                                              supercell_symmetry=supercell_symmetry)
+    else:
+        # sites (0,j,k) whose pair distances fall in the 1-1-1 nearest neighbour shells
+        triplet_indexes = find_cluster_indexes(pure_structure, (1,1,1))
+        triplet_clusters = [{'indexes': triplet_indexes,
+                             'permutations': get_cluster_permutations(
+                                               triplet_indexes, supercell_symmetry)}]
 
-        store_asestructure(triplet_structure, triplet_extras,
-                           structure_group, dryrun)
+    for triplet_cluster in triplet_clusters:
+        triplet_indexes = triplet_cluster['indexes']
+        # only decorations which are not equivalent by the symmetry of the cluster
+        triplets = get_distinct_decorations(triplet_elements,
+                                            triplet_cluster['permutations'])
+        triplet_occupations = host_lattice.decorate_batch(triplet_indexes, triplets)
+        for triplet, triplet_occupation in zip(triplets, triplet_occupations):
+            triplet_extras = copy.deepcopy(base_extras)
+            triplet_extras['triplet'] = triplet
+            if cluster_cutoff:
+                triplet_extras['triplet_indexes'] = triplet_indexes
+                triplet_extras['triplet_distances'] = triplet_cluster['distances']
 
+            store_asestructure(host_lattice.to_atoms(triplet_occupation), triplet_extras,
+                               structure_group, dryrun, storage_batch)
 
+    storage_batch.flush()
 
 if __name__ == "__main__":
    launch()
@@ -7,6 +7,8 @@ from aiida_create_solutesupercell_structures import *
 import ase
 import ase.build
 import click
+import functools
+import itertools
 import numpy as np
 import random
 from aiida.orm import QueryBuilder
@@ -20,13 +22,10 @@ def get_allstructures_fromgroup(group_name):
     return all_nodes
 
 def get_conventionalstructure(ase_structure):
-    from pymatgen.io.ase import AseAtomsAdaptor
-    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+    from aiida_alloy.symmetry_cache import get_conventional_structure
 
-    mg_structure = AseAtomsAdaptor.get_structure(ase_structure)
-    sga = SpacegroupAnalyzer(mg_structure)
-    standard_structure = sga.get_conventional_standard_structure()
-    standard_ase = AseAtomsAdaptor.get_atoms(standard_structure)
+    # cached per prototype, only the first structure of each runs pymatgen
+    standard_ase = get_conventional_structure(ase_structure)
 
 
     return standard_ase
@@ -51,7 +50,7 @@ def get_strained_structures(equilibrium_structure, norm_strains,
     import pymatgen as mg
     from pymatgen.analysis.elasticity import DeformedStructureSet
     from pymatgen.io.ase import AseAtomsAdaptor
-    from pymatgen.core.tensors import symmetry_reduce
+    from aiida_alloy.symmetry_cache import symmetry_reduce
 
 
     #global debug_global
@@ -82,6 +81,71 @@ def get_strained_structures(equilibrium_structure, norm_strains,
 
     return deformations, strained_structures
 
+def iter_distorted_structures(distortion_task, volumetric_strains, norm_strains,
+                              shear_strains, random_displacement,
+                              number_randomized_samples):
+    """
+    Lazily yields the (structure, extras) distortions of one input structure: each
+    strain deformation x volumetric strain, followed by its randomized samples.
+    The volumetric strains are applied to the cell and positions arrays of each
+    strained structure at once, and distortions whose fingerprint was already
+    produced are rejected before an Atoms object is built. Each randomized
+    sample has its own random_seed, with which its displacements are those of
+    ase.Atoms.rattle(stdev=random_displacement, seed=random_seed) of the
+    (sorted) volume deformed structure.
+    """
+    input_structure_ase, extras, structure_seed = distortion_task
+    rng = np.random.default_rng(structure_seed)
+    extras = dict(extras, structure_seed=structure_seed)
+    volume_deformations = 1.0 + np.array(volumetric_strains)
+    produced_fingerprints = set()
+
+    deformations, strained_structures = get_strained_structures(input_structure_ase,
+                                                                norm_strains,
+                                                                shear_strains)
+    for deformation, strained_structure in zip(deformations, strained_structures):
+        # sorted as prior to storage, such that the fingerprints match
+        strained_structure = sort(strained_structure)
+        chemical_formula = strained_structure.get_chemical_formula()
+        numbers = strained_structure.get_atomic_numbers()
+        pbc = strained_structure.get_pbc()
+        volume_cells = (volume_deformations[:, None, None]
+                        *np.array(strained_structure.get_cell())[None, :, :])
+        volume_positions = (volume_deformations[:, None, None]
+                            *strained_structure.get_positions()[None, :, :])
+
+        for j, volume_strain in enumerate(volumetric_strains):
+            volume_extras = dict(extras, deformation=deformation,
+                                 volume_strain=volume_strain,
+                                 volume_deformation=float(volume_deformations[j]))
+            sample_positions = [volume_positions[j]]
+            sample_extras = [dict(volume_extras, random_seed=None,
+                                  random_displacement_stdev=None)]
+            for k in range(number_randomized_samples):
+                random_seed = int(rng.integers(1, 2**32-1))
+                displacements = np.random.RandomState(random_seed).normal(
+                                  scale=random_displacement, size=(len(numbers), 3))
+                sample_positions.append(volume_positions[j] + displacements)
+                sample_extras.append(dict(volume_extras, random_seed=random_seed,
+                                          random_displacement_stdev=random_displacement))
+
+            for positions, distortion_extras in zip(sample_positions, sample_extras):
+                fingerprint = get_array_fingerprint(chemical_formula, volume_cells[j],
+                                                    positions)
+                if fingerprint in produced_fingerprints:
+                    continue
+                produced_fingerprints.add(fingerprint)
+                yield (ase.Atoms(numbers=numbers, positions=positions,
+                                 cell=volume_cells[j], pbc=pbc),
+                       distortion_extras)
+
+def distort_structure(distortion_task, **kwargs):
+    """
+    All the distortions of iter_distorted_structures as a list, such that input
+    structures can be distorted by the workers of generate_samples
+    """
+    return list(iter_distorted_structures(distortion_task, **kwargs))
+
 @click.command()
 @click.option('-in', '--input_group',
               help='group containing structures to base randomization off of.')
@@ -105,10 +169,24 @@ def get_strained_structures(equilibrium_structure, norm_strains,
               help="Comment to be added to the extras")
 @click.option('-ucs', '--use_conventional_structure', is_flag=True,
               help='Turns the input structure to its pymatgen conventional form prior to running')
-@click.option('-sg', '--structure_group_label', required=True,
+@click.option('-sg', '--structure_group_label', default=None,
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-s', '--seed', default=None, type=int,
+              help="Master seed from which the seeds of all randomized samples are spawned. "
+                   "By default a random master seed is used (stored in the extras)")
+@click.option('-nw', '--num_workers', default=DEFAULT_NUM_WORKERS, type=int,
+              help="Number of processes distorting the input structures (0: all cores). "
+                   "The samples do not depend on the number of processes")
+@click.option('-of', '--output_format', default='aiida',
+              type=click.Choice(STRUCTURE_SINK_FORMATS),
+              help="Store the structures in the AiiDA group, or write them to "
+                   "a POSCAR directory, a RuNNer file or columnar (npz) chunks")
+@click.option('-op', '--output_path', default=None,
+              help="Output file/directory when not storing to AiiDA")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
 def launch(input_group, input_structures, repeat_expansion,
@@ -117,19 +195,18 @@ def launch(input_group, input_structures, repeat_expansion,
            number_randomized_samples, max_atoms, structure_comments,
            use_conventional_structure,
            structure_group_label, structure_group_description,
-           dryrun):
+           seed, num_workers,
+           output_format, output_path, flush_size, dryrun):
     """
     Script for distoring the cell shape for an input structure
     """
-    if not dryrun:
-        structure_group = Group.objects.get_or_create(
-                             label=structure_group_label,
-                             description=structure_group_description)[0]
-    else:
-        structure_group = None
+    structure_group, storage_batch = get_structure_sink(
+                                       output_format, output_path,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     if input_group:
-        structure_nodes = Group.get(label=input_group).nodes
+        structure_nodes = list(Group.get(label=input_group).nodes)
     elif input_structures:
         input_structures = input_structures.split(',')
         structure_nodes = [load_node(x) for x in input_structures]
@@ -140,46 +217,40 @@ def launch(input_group, input_structures, repeat_expansion,
     shear_strains = [float(x) for x in shear_strains.split(',')]
     repeat_expansion = [int(x) for x in repeat_expansion.split(',')]
 
-    for structure_node in structure_nodes:
-        extras = {
-            'input_structure':structure_node.uuid,
-            'repeats':repeat_expansion,
-            'structure_comments':structure_comments
-                      }
-
-        input_structure_ase = structure_node.get_ase()
-        if use_conventional_structure:
-           input_structure_ase = get_conventionalstructure(input_structure_ase)
-           extras['conventional_structure'] = True
-        if len(input_structure_ase) > max_atoms:
-            print(("Skipping {} too many atoms".format(structure_node)))
-            continue
-        input_structure_ase = input_structure_ase.repeat(repeat_expansion)
-        deformations, strained_structures = get_strained_structures(input_structure_ase,
-                                                                    norm_strains,
-                                                                    shear_strains)
-        for i in range(len(strained_structures)):
-            extras['deformation'] = deformations[i]
-            straindeformed_structure = copy.deepcopy(strained_structures[i])
-            straindeformed_cell = copy.deepcopy(straindeformed_structure.cell)
-            for j in range(len(volumetric_strains)):
-                extras['random_seed'] = None
-                extras['random_displacement_stdev'] = None
-                extras['volume_strain'] = volumetric_strains[j]
-                volume_deformation = 1.0+volumetric_strains[j]
-                extras['volume_deformation'] = volume_deformation
-
-                volumedeformed_structure = copy.deepcopy(straindeformed_structure)
-                volumedeformed_structure.set_cell(straindeformed_cell*volume_deformation,
-                                                  scale_atoms=True)
-                store_asestructure(volumedeformed_structure, extras, structure_group, dryrun)
-                for k in range(number_randomized_samples):
-                    random_structure = copy.deepcopy(volumedeformed_structure)
-                    random_seed = random.randint(1, 2**32-1)
-                    extras['random_seed'] = random_seed
-                    extras['random_displacement_stdev'] = random_displacement 
-                    random_structure.rattle(stdev=random_displacement, seed=random_seed)
-                    store_asestructure(random_structure, extras, structure_group, dryrun)
+    master_seed, structure_seeds = get_sample_seeds(len(structure_nodes), seed)
+    def iter_distortion_tasks():
+        for structure_node, structure_seed in zip(structure_nodes, structure_seeds):
+            extras = {
+                'input_structure':structure_node.uuid,
+                'repeats':repeat_expansion,
+                'structure_comments':structure_comments,
+                'master_seed':master_seed,
+                          }
+
+            input_structure_ase = get_ase_structure(structure_node)
+            if use_conventional_structure:
+               input_structure_ase = get_conventionalstructure(input_structure_ase)
+               extras['conventional_structure'] = True
+            if len(input_structure_ase) > max_atoms:
+                print(("Skipping {} too many atoms".format(structure_node)))
+                continue
+            input_structure_ase = input_structure_ase.repeat(repeat_expansion)
+            yield input_structure_ase, extras, structure_seed
+
+    distortion_kwargs = {'volumetric_strains':volumetric_strains,
+                         'norm_strains':norm_strains,
+                         'shear_strains':shear_strains,
+                         'random_displacement':random_displacement,
+                         'number_randomized_samples':number_randomized_samples}
+    if num_workers == 1:
+        distorted_structures = (iter_distorted_structures(x, **distortion_kwargs)
+                                for x in iter_distortion_tasks())
+    else:
+        distorted_structures = generate_samples(
+                                 functools.partial(distort_structure, **distortion_kwargs),
+                                 iter_distortion_tasks(),
+                                 num_workers=num_workers, chunksize=1)
+    write_structures(itertools.chain.from_iterable(distorted_structures), storage_batch)
 
 if __name__ == "__main__":
    launch()
@@ -95,7 +95,7 @@ def write_runner_finalline(fileout, energy=0, charge=0):
 
 def write_structure_torunner(fileout, structure_node, extra_comments={}):
     # get structure path, if applicable
-    ase_structure = structure_node.get_ase()
+    ase_structure = get_ase_structure(structure_node)
     ase_structure.wrap() # need this to avoid a bug in old n2p2 versions
 
     cell = ase_structure.get_cell()
@@ -143,10 +143,10 @@ def write_pwbase_torunner(fileout, pwbasenode, dump_stress, extra_comments={}):
     scf_node = get_timesorted_scfs(pwbasenode)[-1]
 
     try:
-        ase_structure = scf_node.inputs.structure.get_ase()
+        ase_structure = get_ase_structure(scf_node.inputs.structure)
         ase_structure.wrap()
     except Exception:
-        ase_structure = scf_node.inputs.pw__structure.get_ase()
+        ase_structure = get_ase_structure(scf_node.inputs.pw__structure)
         ase_structure = ase_structure.wrap()
     cell = ase_structure.get_cell()
     positions = ase_structure.get_positions()
@@ -248,9 +248,9 @@ def write_pwrelax_torunner(fileout, relax_node, write_only_relaxed,
     timesorted_forces = get_timesorted_values(relax_node, 'forces')
     # assuming the element order remains unchanged
     try:
-        elements = relax_node.inputs.structure.get_ase().get_chemical_symbols()
+        elements = list(get_structure_arrays(relax_node.inputs.structure)['symbols'])
     except Exception:
-        elements = relax_node.inputs.pw__structure.get_ase().get_chemical_symbols()
+        elements = list(get_structure_arrays(relax_node.inputs.pw__structure)['symbols'])
 
     #Sometimes the final forces are not parsed. Trim out the last energy in that case
     if relax_node.exit_status == 401:
@@ -391,9 +391,9 @@ def createjob(group_label, filename, write_only_relaxed, energy_tol,
             print("Writing node: {}".format(node.uuid))
         if output_elements:
             try:
-                input_ase = node.inputs.structure.get_ase()
+                input_ase = get_ase_structure(node.inputs.structure)
             except Exception:
-                input_ase = node.inputs.pw__structure.get_ase()
+                input_ase = get_ase_structure(node.inputs.pw__structure)
             only_output_elements = all([x in output_elements
                                         for x in input_ase.get_chemical_symbols()])
             if not only_output_elements:
@@ -401,9 +401,9 @@ def createjob(group_label, filename, write_only_relaxed, energy_tol,
                 continue
         if required_elements:
             try:
-                input_ase = node.inputs.structure.get_ase()
+                input_ase = get_ase_structure(node.inputs.structure)
             except Exception:
-                input_ase = node.inputs.pw__structure.get_ase()
+                input_ase = get_ase_structure(node.inputs.pw__structure)
             any_required_elements = any([x in required_elements
                                         for x in input_ase.get_chemical_symbols()])
             if not any_required_elements:
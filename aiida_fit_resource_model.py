@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import aiida
+aiida.load_profile()
+
+import click
+import numpy as np
+from aiida.orm import QueryBuilder, Group, load_node
+from aiida.orm import WorkChainNode, CalcJobNode, Dict, KpointsData, StructureData
+from resource_model import ResourceModel, RESOURCE_MODEL_FEATURES
+
+MINED_WORKCHAIN_LABELS = ['PwBaseWorkChain', 'PwRelaxWorkChain']
+
+
+def get_scf_iterations(calcjob_id):
+    """
+    Total number of SCF iterations of a calculation, from its output trajectory
+    """
+    calcjob = load_node(calcjob_id)
+    try:
+        return int(np.sum(calcjob.outputs.output_trajectory.get_array('scf_iterations')))
+    except Exception:
+        return None
+
+
+def get_npools(cmdline):
+    for flag in ['-nk', '-npools', '-npool']:
+        if cmdline is not None and flag in cmdline:
+            return int(cmdline[cmdline.index(flag)+1])
+    return 1
+
+
+def mine_calculation_samples(workchain_group_labels=None, computer_label=None):
+    """
+    Returns a sample dict (see ResourceModel.fit) for every finished pw.x
+    calculation run by a PwBaseWorkChain or PwRelaxWorkChain (of the given
+    workchain groups). The inputs and outputs are projected with a single query.
+    """
+    qb = QueryBuilder()
+    workchain_filters = {'attributes.process_label': {'in': MINED_WORKCHAIN_LABELS}}
+    if workchain_group_labels:
+        qb.append(Group, filters={'label': {'in': list(workchain_group_labels)}}, tag='g')
+        qb.append(WorkChainNode, with_group='g', filters=workchain_filters, tag='workchain')
+    else:
+        qb.append(WorkChainNode, filters=workchain_filters, tag='workchain')
+    calcjob_filters = {'attributes.exit_status': 0,
+                       'attributes.process_label': 'PwCalculation'}
+    qb.append(CalcJobNode, with_ancestors='workchain', filters=calcjob_filters,
+              tag='calcjob', project=['id', 'attributes.resources'])
+    if computer_label:
+        from aiida.orm import Computer
+        qb.append(Computer, with_node='calcjob', filters={'name': computer_label})
+    qb.append(Dict, with_incoming='calcjob', edge_filters={'label': 'output_parameters'},
+              project=['attributes.wall_time_seconds', 'attributes.number_of_bands',
+                       'attributes.scf_iterations'])
+    qb.append(Dict, with_outgoing='calcjob', edge_filters={'label': 'parameters'},
+              project=['attributes.CONTROL.calculation'])
+    qb.append(Dict, with_outgoing='calcjob', edge_filters={'label': 'settings'},
+              project=['attributes.cmdline'])
+    qb.append(KpointsData, with_outgoing='calcjob', edge_filters={'label': 'kpoints'},
+              project=['attributes.mesh'])
+    qb.append(StructureData, with_outgoing='calcjob', edge_filters={'label': 'structure'},
+              project=['attributes.cell'])
+
+    samples = {}
+    for (calcjob_id, resources, wall_time, num_bands, scf_iterations,
+         calculation, cmdline, mesh, cell) in qb.iterall():
+        if calcjob_id in samples:  # reached through several workchains
+            continue
+        if (wall_time is None or num_bands is None or mesh is None or
+                resources is None or 'num_machines' not in resources):
+            continue
+        if scf_iterations is None:
+            scf_iterations = get_scf_iterations(calcjob_id)
+            if scf_iterations is None:
+                continue
+        samples[calcjob_id] = {
+            'num_kpoints': int(np.prod(mesh)),
+            'num_bands': int(num_bands),
+            'volume': float(np.abs(np.linalg.det(cell))),
+            'num_machines': int(resources['num_machines']),
+            'num_pools': get_npools(cmdline),
+            'wall_time': float(wall_time),
+            'scf_iterations': int(np.sum(scf_iterations)),
+            'calculation': calculation or 'scf',
+        }
+    return list(samples.values())
+
+
+@click.command()
+@click.option('-wg', '--workchain_group_label', multiple=True,
+              help='Only mine the workchains of this group. Can be repeated')
+@click.option('-cl', '--computer_label', default=None,
+              help='Only mine the calculations run on this computer')
+@click.option('-om', '--output_model', default='resource_model.json',
+              help='File to write the fitted model to, used by the launcher '
+                   'with --resource_model')
+def launch(workchain_group_label, computer_label, output_model):
+    """
+    Fits the cost model used by aiida_launch_workflow_alalloy.py --resource_model
+    to the finished pw.x calculations of PwBaseWorkChains and PwRelaxWorkChains:
+    their wall time, resources, bands, k-points, cell volume and SCF iterations.
+    """
+    samples = mine_calculation_samples(workchain_group_label, computer_label)
+    print("{} calculations mined".format(len(samples)))
+    resource_model = ResourceModel.fit(samples)
+
+    print("wall time per SCF iteration ~ {:.3g}s * {}".format(
+          np.exp(resource_model.coefficients[0]),
+          " * ".join(["{}^{:.2f}".format(x, y) for x, y in
+                      zip(RESOURCE_MODEL_FEATURES, resource_model.coefficients[1:])])))
+    print("log residual std: {:.3f}".format(resource_model.residual_std))
+    print("condition number: {:.3g}, machines {}-{}, machine exponent error: "
+          "{:.3g}, machine variance inflation factor: {:.3g}".format(
+          resource_model.condition_number, resource_model.num_machines_range[0],
+          resource_model.num_machines_range[1], resource_model.machine_exponent_error,
+          resource_model.machine_vif))
+    if not resource_model.is_machine_exponent_determined():
+        print("WARNING: the number of machines did not vary independently of the "
+              "problem size, the machine exponent is not determined. The launcher "
+              "will use the electron count guess for the machines")
+    print("median SCF iterations: {}".format(resource_model.scf_iterations))
+    resource_model.save(output_model)
+    print("model written to {}".format(output_model))
+
+if __name__ == "__main__":
+    launch()
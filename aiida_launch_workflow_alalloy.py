@@ -2,20 +2,32 @@
 import click
 import time
 import copy
+import multiprocessing
+import os
 import sys
+import threading
 from pprint import pprint
 
 import aiida
 aiida.load_profile()
 from aiida.engine import workfunction
 from aiida.orm import Dict
-
-
-def retrieve_alluncalculated_structures(structure_group_label,
-                                        workchain_group_label=None):
+from structure_arrays import (get_structure_arrays, get_ase_structure,
+                              get_reciprocal_cell)
+from resource_model import ResourceModel
+
+
+def retrieve_alluncalculated_structure_ids(structure_group_label,
+                                           workchain_group_label=None):
+    """
+    Returns the ids of the structures of structure_group_label without a workchain
+    (in workchain_group_label). The calculated structures are excluded by the
+    database, with a single NOT IN (subquery) anti-join, so that no id list is
+    sent back and forth.
+    """
     from aiida.orm import Group
     from aiida.orm import StructureData
-    from aiida.orm import WorkChainNode 
+    from aiida.orm import WorkChainNode
     from aiida.orm import QueryBuilder
 
     sqb = QueryBuilder()
@@ -27,88 +39,436 @@ def retrieve_alluncalculated_structures(structure_group_label,
     if workchain_group_label:
         filters = {'label': workchain_group_label}
     sqb.append(Group, with_node='job', filters=filters)
-
-    ids_dealt_with = [_ for _, in sqb.distinct().all()] or [-1]  # prevent empty list
+    calculated_ids = sqb.get_query().subquery()
 
     # # Now the main query:
     qb = QueryBuilder()
     qb.append(Group, filters={'label': structure_group_label}, tag='g')
-    qb.append(StructureData, project='*', tag='s', with_group='g',
-              filters={'id': {'!in': ids_dealt_with}})  # filter out calculated '!in' for not in
-
-    res = [x[0] for x in qb.all()]
-    return res
-
-def retrieve_numactive_calculations():
+    qb.append(StructureData, project='id', tag='s', with_group='g')
+    structure_alias = qb.get_alias('s')
+    query = qb.get_query().filter(~structure_alias.id.in_(calculated_ids))
+    return [x[0] for x in query.distinct().order_by(structure_alias.id)]
+
+def iter_structures_by_id(structure_ids, batch_size=1000):
+    """
+    Lazily loads the structures of structure_ids, batch_size nodes per query
+    """
+    from aiida.orm import StructureData
     from aiida.orm import QueryBuilder
-    from aiida.orm import CalcJobNode
-    qb = QueryBuilder()
-    qb.append(CalcJobNode,
-              filters={'attributes.process_state':
-                       {'!in': ['finished', 'excepted', 'killed']}}
-    )
-    return len(qb.all())
 
-def retrieve_numactive_elastic():
+    for i in range(0, len(structure_ids), batch_size):
+        batch_ids = structure_ids[i:i+batch_size]
+        qb = QueryBuilder()
+        qb.append(StructureData, filters={'id': {'in': batch_ids}}, project='*')
+        batch_structures = {x.pk: x for x, in qb.iterall()}
+        for structure_id in batch_ids:
+            if structure_id in batch_structures:
+                # the attributes are loaded with the node, memoize the arrays
+                get_structure_arrays(batch_structures[structure_id])
+                yield batch_structures[structure_id]
+
+ACTIVE_PROCESS_FILTERS = {'attributes.process_state':
+                          {'!in': ['finished', 'excepted', 'killed']}}
+# entry points of the workchains launched by each calc_method
+CALC_METHOD_WORKFLOWS = {'scf': 'quantumespresso.pw.base',
+                         'relax': 'quantumespresso.pw.relax',
+                         'vc-relax': 'quantumespresso.pw.relax',
+                         'elastic': 'elastic'}
+
+def retrieve_numactive_workchains():
+    """
+    Returns the number of active top level workchains per process label (one
+    grouped query). Workchains called by another workchain (e.g. the
+    PwBaseWorkChains of a PwRelaxWorkChain) are excluded by a NOT IN (subquery),
+    such that the quota of a campaign is not used up by the subprocesses of
+    another campaign.
+    """
     from aiida.orm import QueryBuilder
-    from aiida.orm import CalcJobNode
-    qb = QueryBuilder()
-    qb.append(CalcJobNode,
-              filters={'attributes.process_state':
-                       {'!in': ['finished', 'excepted', 'killed']},
-                       'attributes._process_label':'ElasticWorkChain'}
-    )
-    return len(qb.all())
-
-
-def get_numelectrons_structure_upffamily(structure, pseudos):
+    from aiida.orm import ProcessNode, WorkChainNode
+    from sqlalchemy import func
 
-    def parse_numelectrons_upfdata(upfdata):
-        upfcontent = upfdata.get_content().split('\n')
-        for line in upfcontent:
-            if "valence" in line.lower() and "z" in line.lower():
-                if len(line.split("=")) == 2:
-                    num_e = int(float((line.split("=")[-1].strip().strip('"'))))
-                elif len(line.split()) == 3:
-                    num_e = int(float(line.split()[0]))
-                else:
-                    raise Exception("Could not parse {}".format(upfdata))
-        return num_e
-
-    def build_upf_numelectrons_dict(structure_ase, pseudos):
-        element_nume_dict = {}
-        for element in set(structure_ase.get_chemical_symbols()):
-            print(pseudos[element])
-            upfdata = pseudos[element]
-            element_nume_dict[element] = parse_numelectrons_upfdata(upfdata)
-        return element_nume_dict
+    sqb = QueryBuilder()
+    sqb.append(ProcessNode, tag='caller')
+    sqb.append(WorkChainNode, with_incoming='caller', project='id',
+               edge_filters={'type': 'call_work'}, filters=ACTIVE_PROCESS_FILTERS)
+    called_ids = sqb.get_query().subquery()
 
-    structure_ase = structure.get_ase()
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters=ACTIVE_PROCESS_FILTERS, tag='workchain')
+    workchain_alias = qb.get_alias('workchain')
+    process_label = workchain_alias.attributes['process_label'].astext
+    query = qb.get_query().filter(~workchain_alias.id.in_(called_ids))
+    query = query.with_entities(process_label, func.count(workchain_alias.id))
+    return dict(query.group_by(process_label).all())
+
+# computer label -> default number of MPI processes per machine
+COMPUTER_MPIPROCS_CACHE = {}
+
+def get_machine_fraction(computer_label, num_mpiprocs_per_machine):
+    """
+    Fraction of a machine used by num_mpiprocs_per_machine processes on a
+    computer, i.e. of a calculation sharing a machine (1 if not given)
+    """
+    from aiida.orm import Computer
+
+    if num_mpiprocs_per_machine is None:
+        return 1.
+    if computer_label not in COMPUTER_MPIPROCS_CACHE:
+        COMPUTER_MPIPROCS_CACHE[computer_label] = Computer.objects.get(
+                                                    name=computer_label
+                                                  ).get_default_mpiprocs_per_machine()
+    default_mpiprocs = COMPUTER_MPIPROCS_CACHE[computer_label]
+    if not default_mpiprocs:
+        return 1.
+    return min(1., num_mpiprocs_per_machine/float(default_mpiprocs))
+
+def retrieve_active_calcjobs():
+    """
+    Returns the number of active calcjobs, of the machines and of the node-hours
+    (machines times wallclock limit) they requested per (computer label, queue
+    name) (one grouped query). Calculations requesting fewer MPI processes than
+    the default of the computer (e.g. bundled ones) count the fraction of the
+    machines they use.
+    """
+    from aiida.orm import QueryBuilder
+    from aiida.orm import CalcJobNode, Computer
+    from sqlalchemy import func, Integer
 
-    element_nume_dict = build_upf_numelectrons_dict(structure_ase, pseudos)
+    qb = QueryBuilder()
+    qb.append(CalcJobNode, filters=ACTIVE_PROCESS_FILTERS, tag='calcjob')
+    qb.append(Computer, with_node='calcjob', tag='computer')
+    calcjob_alias = qb.get_alias('calcjob')
+    computer_label = qb.get_alias('computer').name
+    queue_name = calcjob_alias.attributes['queue_name'].astext
+    resources = calcjob_alias.attributes['resources']
+    num_machines = resources['num_machines'].astext.cast(Integer)
+    num_mpiprocs = resources['num_mpiprocs_per_machine'].astext.cast(Integer)
+    wallclock_seconds = calcjob_alias.attributes['max_wallclock_seconds'].astext.cast(Integer)
+    query = qb.get_query().with_entities(computer_label, queue_name, num_mpiprocs,
+                                         func.count(calcjob_alias.id),
+                                         func.coalesce(func.sum(num_machines), 0),
+                                         func.coalesce(func.sum(num_machines*
+                                                                wallclock_seconds), 0))
+    active_calcjobs = {}
+    for (computer, queue, mpiprocs, num_calcjobs, machines,
+         machine_seconds) in query.group_by(computer_label, queue_name, num_mpiprocs).all():
+        machine_fraction = get_machine_fraction(computer, mpiprocs)
+        totals = active_calcjobs.get((computer, queue), (0, 0., 0.))
+        active_calcjobs[(computer, queue)] = (totals[0] + num_calcjobs,
+                                              totals[1] + machines*machine_fraction,
+                                              totals[2] + machine_seconds*machine_fraction/3600.)
+    return active_calcjobs
+
+def parse_quotas(quota_specs):
+    """
+    Converts 'key:limit' strings to a dict of limits
+    """
+    quotas = {}
+    for quota_spec in quota_specs:
+        key, limit = quota_spec.rsplit(':', 1)
+        quotas[key] = int(limit)
+    return quotas
+
+
+class SubmissionQuotas(object):
+    """
+    Concurrency quotas of a launcher: the maximum number of active workchains per
+    process label, of active calcjobs (overall, per computer and per
+    computer/queue) and of machines and node-hours requested by the active
+    calcjobs. Campaigns
+    running at the same time (e.g. relax, scf and elastic launchers) can each be
+    given their share of the cluster. All quotas are evaluated with one grouped
+    query for the workchains and one for the calcjobs.
+    """
+    def __init__(self, process_label, computer_label, queue_name=None,
+                 max_active_calculations=None, workchain_quotas=None,
+                 computer_quotas=None, max_total_nodes=None, max_node_hours=None):
+        self.process_label = process_label
+        self.computer_label = computer_label
+        self.queue_name = queue_name
+        self.max_active_calculations = max_active_calculations
+        self.workchain_quotas = workchain_quotas or {}
+        self.computer_quotas = computer_quotas or {}
+        self.max_total_nodes = max_total_nodes
+        self.max_node_hours = max_node_hours
+
+    def get_free_resources(self):
+        """
+        Returns the number of processes which can be submitted, the number of
+        free machines and of free node-hours (None if unlimited) and a status
+        message
+        """
+        limits = []
+        if self.process_label in self.workchain_quotas:
+            active_workchains = retrieve_numactive_workchains().get(self.process_label, 0)
+            limits.append((self.workchain_quotas[self.process_label] - active_workchains,
+                           "{} {} running, max {}".format(
+                               active_workchains, self.process_label,
+                               self.workchain_quotas[self.process_label])))
+
+        active_calcjobs = retrieve_active_calcjobs()
+        active_computer_calcjobs = sum(v[0] for k, v in active_calcjobs.items()
+                                       if k[0] == self.computer_label)
+        active_queue_calcjobs = active_calcjobs.get(
+                                  (self.computer_label, self.queue_name), (0, 0))[0]
+        calcjob_counts = [
+            (self.max_active_calculations, sum(v[0] for v in active_calcjobs.values()),
+             "calcs"),
+            (self.computer_quotas.get(self.computer_label), active_computer_calcjobs,
+             "calcs on {}".format(self.computer_label)),
+            (self.computer_quotas.get("{}/{}".format(self.computer_label, self.queue_name)),
+             active_queue_calcjobs,
+             "calcs on {}/{}".format(self.computer_label, self.queue_name)),
+        ]
+        for limit, num_active, name in calcjob_counts:
+            if limit is not None:
+                limits.append((limit - num_active, "{} {} running,max num {} {}".format(
+                                                     num_active, name, name, limit)))
+
+        free_slots, status = min(limits, key=lambda x: x[0]) if limits else (1, "")
+        free_nodes = None
+        if self.max_total_nodes is not None:
+            active_nodes = sum(v[1] for v in active_calcjobs.values())
+            free_nodes = self.max_total_nodes - active_nodes
+            status += ", {} nodes in use, max {}".format(active_nodes, self.max_total_nodes)
+        free_node_hours = None
+        if self.max_node_hours is not None:
+            active_node_hours = sum(v[2] for v in active_calcjobs.values())
+            free_node_hours = self.max_node_hours - active_node_hours
+            status += ", {:.1f} node-hours requested, max {}".format(active_node_hours,
+                                                                    self.max_node_hours)
+        return free_slots, free_nodes, free_node_hours, status
+
+
+class SubmissionThrottle(object):
+    """
+    Limits the number of active processes. get_free_resources returns the number
+    of processes which can still be submitted, the number of free machines and
+    node-hours (None if unlimited), from count queries, and a status message. When
+    no slot (or not enough machines or node-hours) is free the throttle waits
+    until a process terminates,
+    as signalled by the state_changed broadcasts of the AiiDA communicator, and
+    recounts. poll_interval bounds the wait in case a broadcast is missed or the
+    communicator is not available.
+    """
+    TERMINAL_STATES = ['finished', 'excepted', 'killed']
+
+    def __init__(self, get_free_resources, poll_interval):
+        self.get_free_resources = get_free_resources
+        self.poll_interval = poll_interval
+        self.free_slots = 0
+        self.free_nodes = None
+        self.free_node_hours = None
+        self.process_terminated = threading.Event()
+        self.communicator = None
+        self.subscriber_identifier = None
+
+    def subscribe(self):
+        try:
+            from aiida.manage.manager import get_manager
+            self.communicator = get_manager().get_communicator()
+            self.subscriber_identifier = self.communicator.add_broadcast_subscriber(
+                                           self.on_broadcast)
+        except Exception as exception:
+            print("Process broadcasts unavailable ({}), polling every {}s".format(
+                  exception, self.poll_interval))
+            self.communicator = None
+
+    def unsubscribe(self):
+        if self.subscriber_identifier is not None:
+            self.communicator.remove_broadcast_subscriber(self.subscriber_identifier)
+            self.subscriber_identifier = None
+
+    def on_broadcast(self, communicator, body, sender, subject, correlation_id):
+        # subjects are of the form state_changed.<from_state>.<to_state>
+        subject = str(subject)
+        if (subject.startswith('state_changed.') and
+                subject.split('.')[-1] in self.TERMINAL_STATES):
+            self.process_terminated.set()
+
+    def refresh(self):
+        # cleared before counting, such that no termination is missed
+        self.process_terminated.clear()
+        (self.free_slots, self.free_nodes, self.free_node_hours,
+         status) = self.get_free_resources()
+        return status
+
+    def has_slot(self, num_machines=0, node_hours=0):
+        return (self.free_slots > 0 and
+                (self.free_nodes is None or self.free_nodes >= num_machines) and
+                (self.free_node_hours is None or self.free_node_hours >= node_hours))
+
+    def wait(self, status):
+        print("{} waiting....".format(status))
+        self.process_terminated.wait(self.poll_interval)
+
+    def wait_for_slot(self, num_machines=0, node_hours=0):
+        while not self.has_slot(num_machines, node_hours):
+            status = self.refresh()
+            if not self.has_slot(num_machines, node_hours):
+                self.wait(status)
+
+    def take_slot(self, num_machines=0, node_hours=0):
+        self.free_slots -= 1
+        if self.free_nodes is not None:
+            self.free_nodes -= num_machines
+        if self.free_node_hours is not None:
+            self.free_node_hours -= node_hours
+
+
+SCHEDULING_POLICIES = ['database', 'shortest-first', 'largest-first', 'fair-share']
+
+def order_submissions(submission_costs, scheduling_policy):
+    """
+    Orders submission cost dicts (with the structure 'id', 'num_machines',
+    'node_hours' requested and 'composition') by a scheduling policy:
+      database: as retrieved (i.e. by structure id)
+      shortest-first: fewest node-hours first, for the turnaround of small jobs
+      largest-first: most node-hours first, such that small jobs fill the gaps
+      fair-share: the compositions take turns, each time the composition with
+                  the fewest node-hours scheduled so far, shortest-first within
+                  a composition
+    """
+    import heapq
+
+    if scheduling_policy == 'database':
+        return list(submission_costs)
+    elif scheduling_policy == 'shortest-first':
+        return sorted(submission_costs, key=lambda x: x['node_hours'])
+    elif scheduling_policy == 'largest-first':
+        return sorted(submission_costs, key=lambda x: -x['node_hours'])
+    elif scheduling_policy != 'fair-share':
+        raise Exception("Invalid scheduling policy: {}".format(scheduling_policy))
+
+    composition_queues = {}
+    for submission_cost in sorted(submission_costs, key=lambda x: x['node_hours']):
+        composition_queues.setdefault(submission_cost['composition'], []).append(
+            submission_cost)
+    composition_heap = [(0., x) for x in sorted(composition_queues)]
+    ordered_costs = []
+    while composition_heap:
+        scheduled_node_hours, composition = heapq.heappop(composition_heap)
+        submission_cost = composition_queues[composition].pop(0)
+        ordered_costs.append(submission_cost)
+        if composition_queues[composition]:
+            heapq.heappush(composition_heap, (scheduled_node_hours +
+                                              submission_cost['node_hours'], composition))
+    return ordered_costs
+
+def iter_packed_submissions(ordered_costs, throttle):
+    """
+    Yields the submission costs in order as slots, machines and node-hours free
+    up. When the next submission does not fit in the free resources the first
+    later one which does is submitted instead (first fit), so the small
+    submissions fill the gaps left by the large ones and the queue stays full.
+    The caller takes the slot of each submission from the throttle.
+    """
+    def get_first_fit(pending_costs):
+        if throttle.free_slots <= 0:
+            return None
+        for i, submission_cost in enumerate(pending_costs):
+            if throttle.has_slot(submission_cost['num_machines'],
+                                 submission_cost['node_hours']):
+                return i
+        return None
+
+    pending_costs = list(ordered_costs)
+    while pending_costs:
+        fit_index = get_first_fit(pending_costs)
+        if fit_index is None:
+            status = throttle.refresh()
+            fit_index = get_first_fit(pending_costs)
+            if fit_index is None:
+                throttle.wait(status)
+                continue
+        yield pending_costs.pop(fit_index)
+
+
+# element -> (UpfData, z_valence) of each pseudopotential family used in this run
+UPF_FAMILY_CACHE = {}
+
+def parse_upf_zvalence(upf_content):
+    """
+    Returns the valence charge of a UPF file: the z_valence attribute of the
+    PP_HEADER element (UPF v2, also if the header is not well-formed XML, e.g.
+    an unescaped & in the author) or the 'Z valence' line of the PP_HEADER
+    block (UPF v1)
+    """
+    import re
+    from xml.etree import ElementTree
+
+    header_match = re.search(r'<PP_HEADER.*?(/>|</PP_HEADER>)', upf_content, re.S)
+    if header_match is None:
+        raise Exception("No PP_HEADER found")
+    header = header_match.group(0)
+    try:
+        z_valence = ElementTree.fromstring(header).attrib.get('z_valence')
+    except ElementTree.ParseError:
+        z_valence_match = re.search(r'z_valence\s*=\s*"([^"]+)"', header)
+        z_valence = None if z_valence_match is None else z_valence_match.group(1)
+    if z_valence is not None:
+        return float(z_valence)
+    for line in header.split('\n'):
+        if "z valence" in line.lower():
+            return float(line.split()[0])
+    raise Exception("No z_valence found in PP_HEADER")
+
+def get_upf_family_valences(pseudo_familyname):
+    """
+    Returns a dict element -> (UpfData, z_valence) of a pseudopotential family,
+    built (i.e. the UPF headers parsed) once per run
+    """
+    if pseudo_familyname not in UPF_FAMILY_CACHE:
+        from aiida.orm.nodes.data.upf import UpfData
+
+        family_valences = {}
+        for upfdata in UpfData.get_upf_group(pseudo_familyname).nodes:
+            if upfdata.element in family_valences:
+                raise Exception("Multiple pseudopotentials for {} in family {}".format(
+                                upfdata.element, pseudo_familyname))
+            try:
+                z_valence = parse_upf_zvalence(upfdata.get_content())
+            except Exception as exception:
+                raise Exception("Could not parse {}: {}".format(upfdata, exception))
+            family_valences[upfdata.element] = (upfdata, z_valence)
+        UPF_FAMILY_CACHE[pseudo_familyname] = family_valences
+    return UPF_FAMILY_CACHE[pseudo_familyname]
+
+def get_numelectrons_symbols(symbols, element_valences, pseudo_familyname=None):
+    """
+    Number of valence electrons of the site symbols, given a dict element ->
+    z_valence of a pseudopotential family
+    """
+    import numpy as np
 
-    num_e = 0
-    for element in structure_ase.get_chemical_symbols():
-        num_e += element_nume_dict[element]
+    elements, element_counts = np.unique(symbols, return_counts=True)
+    missing_elements = [x for x in elements if x not in element_valences]
+    if len(missing_elements) > 0:
+        raise Exception("No pseudopotential for {} in family {}".format(
+                        missing_elements, pseudo_familyname))
+    return int(round(np.dot(element_counts,
+                            np.array([element_valences[x] for x in elements]))))
 
-    return num_e
+def get_family_zvalences(pseudo_familyname):
+    return {k: v[1] for k, v in get_upf_family_valences(pseudo_familyname).items()}
 
 
-def get_kmeshfrom_kptper_recipang(aiida_structure, kptper_recipang):
+def get_kmeshfrom_structure_arrays(structure_arrays, kptper_recipang):
     import numpy as np
 
-    ase_structure = aiida_structure.get_ase()
-    reci_cell = ase_structure.get_reciprocal_cell()
+    reci_cell = get_reciprocal_cell(structure_arrays)
     kmesh = [np.ceil(kptper_recipang * np.linalg.norm(reci_cell[i]))
              for i in range(len(reci_cell))]
     return kmesh
 
 
-def get_nummachines(structure, pseudo_familyname):
+def get_numbands(num_electrons, nume2bnd_ratio):
+    nbnd = num_electrons * nume2bnd_ratio
+    return max(nbnd, 20) # minimum of 20 bands to avoid certain crashes
+
+
+def get_nummachines_numelectrons(num_electrons):
     # NOTE: used very adhoc guess for nodes, assuming quadratic scaling
-    from aiida.orm.nodes.data.upf import get_pseudos_from_structure
-    pseudos = get_pseudos_from_structure(structure, pseudo_familyname)
-    num_electrons = get_numelectrons_structure_upffamily(structure, pseudos)
     a2 = 1.5*10**-6
     a1 = 5.7*10**-3
     a0 = 2
@@ -117,7 +477,81 @@ def get_nummachines(structure, pseudo_familyname):
     return numnodes
 
 
-def get_nk(num_machines, code):
+# pw.x calculation type whose SCF iterations the resource model uses per calc_method
+RESOURCE_MODEL_CALCULATIONS = {'scf': 'scf', 'relax': 'relax', 'vc-relax': 'vc-relax',
+                               'elastic': 'vc-relax'}
+
+def get_model_resources(resource_model, structure_features, calc_method,
+                        mpiprocs_per_machine, max_nodes_submit, max_wallclock_seconds,
+                        safety_factor):
+    """
+    Returns the num_machines, npools and max_wallclock_seconds chosen by a fitted
+    ResourceModel, i.e. the cheapest (in node-hours) even number of machines
+    up to max_nodes_submit predicted to finish within max_wallclock_seconds
+    """
+    return resource_model.choose_resources(
+             structure_features, RESOURCE_MODEL_CALCULATIONS[calc_method],
+             list(range(2, int(max_nodes_submit)+1, 2)), mpiprocs_per_machine,
+             int(max_wallclock_seconds), safety_factor=safety_factor)
+
+def get_submission_resources(structure_features, preparation_settings):
+    """
+    Returns the num_machines, npools (None unless chosen by the resource model)
+    and max_wallclock_seconds of a calculation: the number of nodes forced by
+    number_of_nodes, else the choice of the resource model, else the guess
+    from the number of electrons
+    """
+    settings = preparation_settings
+    if settings['number_of_nodes']:
+        return int(settings['number_of_nodes']), None, settings['max_wallclock_seconds']
+    elif settings['resource_model'] is not None:
+        return get_model_resources(settings['resource_model'], structure_features,
+                                   settings['calc_method'],
+                                   settings['mpiprocs_per_machine'],
+                                   settings['max_nodes_submit'],
+                                   settings['max_wallclock_seconds'],
+                                   settings['resource_safety_factor'])
+    num_machines = get_nummachines_numelectrons(structure_features['num_electrons'])
+    if settings['calc_method'] in ['relax', 'vc-relax']:
+       num_machines += 4
+    return num_machines, None, settings['max_wallclock_seconds']
+
+def get_bundle_resources(preparation_settings):
+    """
+    Returns the fraction of a machine, npools (None) and max_wallclock_seconds of
+    a bundled calculation, i.e. running on bundle_mpiprocs processes of a
+    machine shared with other calculations. The fraction is counted as by
+    retrieve_active_calcjobs. The resource model is not used, as it is fitted on
+    calculations using whole machines. As by get_machine_fraction, a whole
+    machine is counted if the bundle computer has no default mpiprocs per machine.
+    """
+    settings = preparation_settings
+    if settings['bundle_mpiprocs_per_machine']:
+        machine_fraction = min(1., settings['bundle_mpiprocs'] /
+                                   float(settings['bundle_mpiprocs_per_machine']))
+    else:
+        machine_fraction = 1.
+    return machine_fraction, None, settings['max_wallclock_seconds']
+
+def check_submission_limits(num_machines, node_hours, number_of_nodes, max_nodes_submit,
+                            max_total_nodes, max_node_hours):
+    """
+    Returns why a calculation of num_machines for node_hours can never be
+    submitted, None if it can
+    """
+    if not number_of_nodes and num_machines > int(max_nodes_submit):
+        return ("{} nodes requested, maximum is {}\n"
+                "If you wish to launch please choose nodes manually with "
+                "--number_of_nodes".format(num_machines, max_nodes_submit))
+    if max_total_nodes is not None and num_machines > max_total_nodes:
+        return "{} nodes requested, the total maximum is {}".format(num_machines,
+                                                                   max_total_nodes)
+    if max_node_hours is not None and node_hours > max_node_hours:
+        return "{:.1f} node-hours requested, the total maximum is {}".format(
+                 node_hours, max_node_hours)
+    return None
+
+def get_nk(num_machines, ppm):
     def nk_nump_evenlydivisible(nk, nump):
         nk = float(nk)
         nump = float(nump)
@@ -130,8 +564,6 @@ def get_nk(num_machines, code):
     nk = str(max(4, int(num_machines/2)))  # adhoc guess
 
     # check if our choice is valid
-    computer = code.computer
-    ppm = computer.get_default_mpiprocs_per_machine()
     # if a local computer we set nk = 1
     if ppm == 1:
        nk = str(1)
@@ -143,6 +575,161 @@ def get_nk(num_machines, code):
 
     return nk
 
+def get_bundle_nk(num_processes, max_nk=4):
+    """
+    npools of a bundled calculation: the largest divisor of its number of
+    processes up to max_nk (get_nk requires at least 4 pools)
+    """
+    return str(max(x for x in range(1, min(max_nk, num_processes)+1)
+                   if num_processes % x == 0))
+
+def prepare_submission(preparation_settings, structure_entry):
+    """
+    Prepares the inputs of one structure as plain data, from its (id, arrays)
+    and the preparation_settings of the launcher (see launch): the pw.x
+    parameters, k-point mesh, resources, options and settings, and whether the
+    calculation is 'bundled' (see launch --bundle_code). Also returns the
+    'num_machines', 'node_hours' and 'composition' (chemical system) used for
+    scheduling, or a 'skip_reason'. Does not access the database, such that it
+    can run in a worker process.
+    """
+    import numpy as np
+
+    settings = preparation_settings
+    structure_id, structure_arrays = structure_entry
+    num_atoms = len(structure_arrays['symbols'])
+    if num_atoms > settings['max_atoms_submit']:
+        return {'id': structure_id,
+                'skip_reason': ("has more atoms than the max allowed {}\n"
+                                "If you wish to overide please use "
+                                "--max_atoms_submit".format(settings['max_atoms_submit']))}
+
+    # determine number of bands & setup the parameters
+    num_electrons = get_numelectrons_symbols(structure_arrays['symbols'],
+                                             settings['element_valences'],
+                                             settings['pseudo_familyname'])
+    parameters_dict = copy.deepcopy(settings['base_parameters'])
+    parameters_dict['SYSTEM']['nbnd'] = get_numbands(num_electrons,
+                                                     settings['nume2bnd_ratio'])
+    parameters_dict.update(copy.deepcopy(settings['cellpress_parameters']))
+
+    # determine kpoint mesh
+    kpoints_mesh = get_kmeshfrom_structure_arrays(structure_arrays,
+                                                  settings['kptper_recipang'])
+
+    # determine parallelization & resources (setup the settings & options)
+    structure_features = {
+        'num_electrons': num_electrons,
+        'num_kpoints': int(np.prod(kpoints_mesh)),
+        'num_bands': int(parameters_dict['SYSTEM']['nbnd']),
+        'volume': float(np.abs(np.linalg.det(structure_arrays['cell']))),
+    }
+    bundled = (settings['bundle_max_electrons'] is not None and
+               num_electrons <= settings['bundle_max_electrons'] and
+               not settings['submit_debug'])
+    if bundled:
+        num_machines, model_npools, calc_wallclock_seconds = get_bundle_resources(
+                                                               settings)
+        resources = {'num_machines': 1,
+                     'num_mpiprocs_per_machine': settings['bundle_mpiprocs']}
+    else:
+        num_machines, model_npools, calc_wallclock_seconds = get_submission_resources(
+                                                               structure_features,
+                                                               settings)
+        resources = {'num_machines': num_machines}
+    options_dict = {
+        'max_wallclock_seconds': calc_wallclock_seconds,
+        'resources': resources,
+    }
+    if settings['memory_gb']:
+        options_dict['max_memory_kb'] = int(int(settings['memory_gb'])*1024*1024)
+    if settings['queue_name']:
+        options_dict['queue_name'] = settings['queue_name']
+    if settings['submit_debug']:
+        num_machines = 2
+        options_dict['resources']['num_machines'] = num_machines
+        options_dict['max_wallclock_seconds'] = int(30*60)
+        options_dict['queue_name'] = 'debug'
+    node_hours = num_machines*options_dict['max_wallclock_seconds']/3600.
+    prepared_submission = {
+        'id': structure_id,
+        'bundled': bundled,
+        'num_machines': num_machines,
+        'node_hours': node_hours,
+        'composition': "-".join(sorted(set(structure_arrays['symbols']))),
+        'model_npools': model_npools,
+        'parameters': parameters_dict,
+        'kpoints_mesh': kpoints_mesh,
+        'options': options_dict,
+    }
+    limit_violation = check_submission_limits(num_machines, node_hours,
+                                              settings['number_of_nodes'],
+                                              settings['max_nodes_submit'],
+                                              settings['max_total_nodes'],
+                                              settings['max_node_hours'])
+    if limit_violation is not None:
+        prepared_submission['skip_reason'] = limit_violation
+        return prepared_submission
+
+    if settings['npools']:
+        nk = settings['npools']
+    elif model_npools is not None and not settings['submit_debug']:
+        nk = str(model_npools)
+    elif bundled:
+        nk = get_bundle_nk(settings['bundle_mpiprocs'])
+    else:
+        nk = get_nk(num_machines, settings['mpiprocs_per_machine'])
+    settings_dict = {
+        'cmdline': ['-nk', nk],
+        'no_bands': True
+        }
+    if settings['ndiag']:
+        settings_dict['cmdline'] += ['-ndiag', settings['ndiag']]
+    if settings['z_movement_only']:
+        coordinate_fix = [[True,True,False]]*num_atoms
+        settings_dict['fixed_coords'] = coordinate_fix
+    prepared_submission['settings'] = settings_dict
+    return prepared_submission
+
+def prepare_submission_chunk(preparation_settings, structure_entries):
+    return [prepare_submission(preparation_settings, x) for x in structure_entries]
+
+def iter_prepared_submissions(structures, preparation_settings, pool=None,
+                              num_prepare_ahead=64, chunksize=8):
+    """
+    Yields the (structure, prepared submission) of structures (any iterable of
+    nodes, consumed lazily), in order. With a pool the inputs are prepared by its
+    workers from the memoized arrays of the structures, while the caller submits:
+    up to num_prepare_ahead structures are in preparation, so preparation waits
+    on the submission (i.e. the daemon) instead of buffering results.
+    """
+    import collections
+    import itertools
+
+    structures = iter(structures)
+    if pool is None:
+        for structure in structures:
+            yield structure, prepare_submission(preparation_settings,
+                                                (structure.pk,
+                                                 get_structure_arrays(structure)))
+        return
+
+    structure_chunks = iter(lambda: list(itertools.islice(structures, chunksize)), [])
+    pending_chunks = collections.deque()
+    for structure_chunk in structure_chunks:
+        structure_entries = [(x.pk, get_structure_arrays(x)) for x in structure_chunk]
+        pending_chunks.append((structure_chunk,
+                               pool.apply_async(prepare_submission_chunk,
+                                                (preparation_settings, structure_entries))))
+        if len(pending_chunks)*chunksize >= num_prepare_ahead:
+            structure_chunk, prepared_chunk = pending_chunks.popleft()
+            for structure_prepared in zip(structure_chunk, prepared_chunk.get()):
+                yield structure_prepared
+    while pending_chunks:
+        structure_chunk, prepared_chunk = pending_chunks.popleft()
+        for structure_prepared in zip(structure_chunk, prepared_chunk.get()):
+            yield structure_prepared
+
 def wf_getconventionalstructure(structuredata):
     '''
     Standardize an AiiDA StructureData object via pymatgen Structure
@@ -161,53 +748,6 @@ def wf_getconventionalstructure(structuredata):
     return standard_structuredata
 
 
-def wf_getkpoints(aiida_structure, kptper_recipang):
-    from aiida.orm import KpointsData
-
-    def get_kmeshfrom_kptper_recipang(aiida_structure, kptper_recipang):
-        import numpy as np
-        kptper_recipang = kptper_recipang.value
-
-        ase_structure = aiida_structure.get_ase()
-        reci_cell = ase_structure.get_reciprocal_cell()
-        kmesh = [np.ceil(kptper_recipang * np.linalg.norm(reci_cell[i]))
-                 for i in range(len(reci_cell))]
-        return kmesh
-
-    kpoints_mesh = get_kmeshfrom_kptper_recipang(aiida_structure, kptper_recipang)
-    kpoints = KpointsData()
-    kpoints.set_kpoints_mesh(kpoints_mesh)
-
-    return kpoints
-
-
-def wf_setupparams(base_parameter, structure,
-                   pseudo_familyname, nume2bnd_ratio,
-                   cellpress_parameter):
-        from aiida.orm.nodes.data.upf import get_pseudos_from_structure
-
-        import collections
-        def update(d, u):
-            for k, v in u.items():
-                if isinstance(v, collections.Mapping):
-                    d[k] = update(d.get(k, {}), v)
-                else:
-                    d[k] = v
-            return d
-
-        pseudos = get_pseudos_from_structure(structure, pseudo_familyname.value)
-        nelec = get_numelectrons_structure_upffamily(structure, pseudos)
-        nbnd = nelec * nume2bnd_ratio.value
-        nbnd = max(nbnd, 20) # minimum of 20 bands to avoid certain crashes
-        parameter_dict = base_parameter.get_dict()
-        parameter_dict['SYSTEM']['nbnd'] = nbnd
-
-        cellpress_dict = cellpress_parameter.get_dict()
-        parameter_dict.update(cellpress_dict)
-        parameters = Dict(dict=parameter_dict)
-
-        return parameters
-
 def wf_delete_vccards(parameter):
     new_dict = parameter.get_dict()
     if 'CELL' in new_dict:
@@ -246,11 +786,53 @@ def wf_delete_vccards(parameter):
 @click.option('-mac', '--max_active_calculations', default=300,
               help='maximum number of active calculations')
 @click.option('-mae', '--max_active_elastic', default=5,
-              help='maximum number of active elastic workchains')
+              help='maximum number of active elastic workchains '
+                   '(i.e. --workchain_quota ElasticWorkChain:N, elastic only)')
+@click.option('-wq', '--workchain_quota', multiple=True,
+              help='maximum number of active workchains of a process label, '
+                   'format: ProcessLabel:N e.g. PwRelaxWorkChain:50. Can be repeated')
+@click.option('-cq', '--computer_quota', multiple=True,
+              help='maximum number of active calculations on a computer or one of its '
+                   'queues, format: computer:N or computer/queue:N. Can be repeated')
+@click.option('-qn', '--queue_name', default=None,
+              help='queue (partition) to submit the calculations to. Used by the '
+                   '--computer_quota computer/queue:N quotas')
+@click.option('-mtn', '--max_total_nodes', default=None, type=int,
+              help='maximum number of nodes requested by all active calculations')
+@click.option('-mnh', '--max_node_hours', default=None, type=float,
+              help='maximum node-hours (nodes times wallclock limit) requested by all '
+                   'active calculations')
+@click.option('-sp', '--scheduling_policy', default='database',
+              type=click.Choice(SCHEDULING_POLICIES),
+              help='Order of submission. Except for database (submission in database '
+                   'order), the cost of every structure is estimated up front and '
+                   'smaller submissions fill the nodes/node-hours left free by larger ones')
+@click.option('-nw', '--num_workers', default=2, type=int,
+              help='Number of processes preparing the inputs (parameters, k-points, '
+                   'resources) while the launcher submits, 0 for all CPUs, 1 to '
+                   'prepare them in the launcher')
+@click.option('-npa', '--num_prepare_ahead', default=64, type=int,
+              help='Number of structures prepared ahead of the submission')
 @click.option('-mns', '--max_nodes_submit', default=20,
               help='maximum nodes that can be used in a submission')
 @click.option('-mas', '--max_atoms_submit', default=400,
               help='maximum number atoms that can be used in a submission')
+@click.option('-rm', '--resource_model', default=None,
+              help='Resource model file written by aiida_fit_resource_model.py. Used to '
+                   'choose the number of nodes, npools and wallclock time of each '
+                   'calculation (unless set with --number_of_nodes/--npools)')
+@click.option('-rsf', '--resource_safety_factor', default=2.0, type=float,
+              help='Wallclock time requested relative to the resource model prediction')
+@click.option('-bc', '--bundle_code_node', default=None,
+              help='node of the code used for bundled calculations. Its computer should '
+                   'run several jobs in one allocation, e.g. a HyperQueue (meta-scheduler) '
+                   'computer or a SLURM partition with shared nodes')
+@click.option('-bme', '--bundle_max_electrons', default=None, type=int,
+              help='Bundle the calculations of structures with at most this number of '
+                   'electrons: they run on --bundle_mpiprocs processes of a shared '
+                   'machine of the bundle code, instead of at least 2 machines')
+@click.option('-bmp', '--bundle_mpiprocs', default=4, type=int,
+              help='Number of MPI processes of each bundled calculation')
 @click.option('-nnd', '--number_of_nodes', default=None,
               help='Force all calculations to use the specified number of nodes')
 @click.option('-memgb', '--memory_gb', default=None,
@@ -259,8 +841,10 @@ def wf_delete_vccards(parameter):
               help='ndiag setting to be passed direct to QE')
 @click.option('-nk', '--npools', default=None,
               help='npools setting to be passed direct to QE')
-@click.option('-sli', '--sleep_interval', default=10*60,
-              help='time to wait (sleep) between calculation submissions')
+@click.option('-sli', '--sleep_interval', default=60,
+              help='maximum time (in s) between checks for free slots while the maximum '
+                   'number of calculations are active. Slots are refilled as soon as '
+                   'a process terminates when AiiDA process broadcasts are available')
 @click.option('-zmo', '--z_movement_only', is_flag=True,
               help='Restricts movement to the z direction only. For relaxing stacking fault')
 @click.option('-zco', '--z_cellrelax_only', is_flag=True,
@@ -285,13 +869,15 @@ def launch(code_node, structure_group_label, workchain_group_label,
            nume2bnd_ratio, press_conv_thr,
            calc_method, use_conventional_structure,
            max_wallclock_seconds, max_active_calculations, max_active_elastic,
-           max_nodes_submit, max_atoms_submit,
-           number_of_nodes, memory_gb, ndiag, npools,
+           workchain_quota, computer_quota, queue_name, max_total_nodes, max_node_hours,
+           scheduling_policy, num_workers, num_prepare_ahead, max_nodes_submit, max_atoms_submit,
+           resource_model, resource_safety_factor,
+           bundle_code_node, bundle_max_electrons, bundle_mpiprocs, number_of_nodes, memory_gb, ndiag, npools,
            sleep_interval, z_movement_only, z_cellrelax_only,
            strain_magnitudes, use_all_strains,
            keep_workdir, dryrun, submit_debug, run_debug):
     from aiida.orm import Group, load_node
-    from aiida.orm import Bool, Dict, Float, List, Int, Str, StructureData
+    from aiida.orm import Bool, Dict, KpointsData, List, Str, StructureData
     from aiida.engine import submit, run
     from aiida.plugins.factories import WorkflowFactory
     # announce if running in debug mode
@@ -302,6 +888,12 @@ def launch(code_node, structure_group_label, workchain_group_label,
     code = load_node(code_node)
     workchain_group = Group.objects.get_or_create(label=workchain_group_label)[0]
     base_parameter = load_node(base_parameter_node)
+    if bundle_max_electrons is not None:
+        if not bundle_code_node:
+            raise Exception("--bundle_max_electrons requires a --bundle_code_node")
+        bundle_code = load_node(bundle_code_node)
+    else:
+        bundle_code = None
 
     if structure_node:
         structure_group = Group.objects.get_or_create(label=structure_group_label)[0]
@@ -312,238 +904,279 @@ def launch(code_node, structure_group_label, workchain_group_label,
 
     # Load all the structures in the structure group, not-yet run in workchain_group_label
     structure_group = Group.get(label=structure_group_label)
-    uncalculated_structures = retrieve_alluncalculated_structures(
-                                structure_group_label,
-                                workchain_group_label=workchain_group_label
+    uncalculated_structure_ids = retrieve_alluncalculated_structure_ids(
+                                   structure_group_label,
+                                   workchain_group_label=workchain_group_label
     )
 
-    if len(uncalculated_structures) == 0:
+    if len(uncalculated_structure_ids) == 0:
         print(("All structures in {} already have associated workchains in "
               "the group {}".format(structure_group_label, workchain_group_label)))
         sys.exit()
+    # nodes (and their arrays) are loaded in batches as the submission proceeds
+    uncalculated_structures = iter_structures_by_id(uncalculated_structure_ids)
 
     # determine number of calculations to submit
-    running_calculations = retrieve_numactive_calculations()
-    calcs_to_submit = max_active_calculations - running_calculations
+    process_label = WorkflowFactory(CALC_METHOD_WORKFLOWS[calc_method]).__name__
+    workchain_quotas = parse_quotas(workchain_quota)
     if calc_method == 'elastic':
-        running_elastic = retrieve_numactive_elastic()
-        calcs_to_submit = max_active_elastic - running_elastic
-
-
-    # submit calculations
-    submit_counter=0
-    for structure in uncalculated_structures:
-        if use_conventional_structure:
-            structure = wf_getconventionalstructure(structure)
-        print("Preparing to launch {}".format(structure))
-        print("calcs to submit: {} (active/max){}:{}".format(
-                                     len(uncalculated_structures) -submit_counter,
-                                                        calcs_to_submit,
-                                                        max_active_calculations))
-        submit_counter += 1
-
-        if len(structure.get_ase()) > max_atoms_submit:
-            print("{} has more atoms than the max allowed {}".format(structure,
-                                                                     max_atoms_submit))
-            print("If you wish to overide please use --max_atoms_submit")
-            continue
-
-        # ensure no more than the max number of calcs are submitted
-        while (calcs_to_submit <= 0):
-            running_calculations = retrieve_numactive_calculations()
-            calcs_to_submit = max_active_calculations - running_calculations
-            if calc_method == 'elastic':
-                running_elastic = retrieve_numactive_elastic()
-                calcs_to_submit = max_active_elastic - running_elastic
-            if calcs_to_submit <= 0:  # in case jobs finished during submission
-                if calc_method == 'elastic':
-                    print(("{} elastic running,"
-                          "max num elastic {} waiting....".format(
-                              running_elastic, max_active_elastic)))
-                else:
-                    print(("{} calcs running,"
-                          "max num calcs {} waiting....".format(
-                              running_calculations, max_active_calculations)))
-                time.sleep(sleep_interval)
-
-        # start timer to inspect job submission times
-        from timeit import default_timer as timer
-        start = timer()
-
-        # add any cell-related parameters specified from cli
-        if "CELL" in base_parameter.get_dict():
-            cellpress_dict = {"CELL":base_parameter.get_dict()["CELL"]}
-        else:
-            cellpress_dict = {}
-            if press_conv_thr or z_cellrelax_only:
-                    cellpress_dict["CELL"] = {}
-        if press_conv_thr:
-            cellpress_dict["CELL"]["press_conv_thr"] = float(press_conv_thr)
-        if z_cellrelax_only:
-            cellpress_dict["CELL"]["cell_dofree"] = "z"
-
-        # determine number of bands & setup the parameters
-        cellpress_parameter = Dict(dict=cellpress_dict)
-        parameters = wf_setupparams(base_parameter,
-                                    structure,
-                                    Str(pseudo_familyname),
-                                    Float(nume2bnd_ratio),
-                                    cellpress_parameter)
-
-        # determine kpoint mesh & setup kpoints
-        kpoints = wf_getkpoints(structure, Int(kptper_recipang))
-
-        # determine parallelization & resources (setup the settings & options)
-        if number_of_nodes:
-            num_machines = int(number_of_nodes)
-        else:
-            num_machines = get_nummachines(structure, pseudo_familyname)
-            if calc_method in ['relax', 'vc-relax']:
-               num_machines += 4
-            if num_machines > int(max_nodes_submit):
-                print("{} nodes requested, maximum is {}".format(num_machines, max_nodes_submit))
-                print("If you wish to launch please choose nodes manually with --number_of_nodes")
+        workchain_quotas.setdefault(process_label, int(max_active_elastic))
+        max_active_calculations = None  # elastic workchains are limited as a whole
+    else:
+        max_active_calculations = int(max_active_calculations)
+    submission_quotas = SubmissionQuotas(
+                          process_label,
+                          code.computer.label,
+                          queue_name='debug' if submit_debug else queue_name,
+                          max_active_calculations=max_active_calculations,
+                          workchain_quotas=workchain_quotas,
+                          computer_quotas=parse_quotas(computer_quota),
+                          max_total_nodes=max_total_nodes,
+                          max_node_hours=max_node_hours)
+    throttle = SubmissionThrottle(submission_quotas.get_free_resources, sleep_interval)
+    if resource_model is not None:
+        resource_model = ResourceModel.load(resource_model)
+        if not resource_model.is_machine_exponent_determined():
+            print("The machine exponent of the resource model is not determined "
+                  "(machines {}, exponent error {}), using the electron count "
+                  "guess".format(resource_model.num_machines_range,
+                                 resource_model.machine_exponent_error))
+            resource_model = None
+
+    # add any cell-related parameters specified from cli
+    if "CELL" in base_parameter.get_dict():
+        cellpress_dict = {"CELL":base_parameter.get_dict()["CELL"]}
+    else:
+        cellpress_dict = {}
+        if press_conv_thr or z_cellrelax_only:
+                cellpress_dict["CELL"] = {}
+    if press_conv_thr:
+        cellpress_dict["CELL"]["press_conv_thr"] = float(press_conv_thr)
+    if z_cellrelax_only:
+        cellpress_dict["CELL"]["cell_dofree"] = "z"
+
+    # everything prepare_submission needs, as plain (picklable) data
+    preparation_settings = {
+        'base_parameters': base_parameter.get_dict(),
+        'cellpress_parameters': cellpress_dict,
+        'pseudo_familyname': pseudo_familyname,
+        'element_valences': get_family_zvalences(pseudo_familyname),
+        'nume2bnd_ratio': float(nume2bnd_ratio),
+        'kptper_recipang': int(kptper_recipang),
+        'calc_method': calc_method,
+        'mpiprocs_per_machine': code.computer.get_default_mpiprocs_per_machine(),
+        'number_of_nodes': number_of_nodes,
+        'resource_model': resource_model,
+        'resource_safety_factor': resource_safety_factor,
+        'max_wallclock_seconds': max_wallclock_seconds,
+        'max_nodes_submit': max_nodes_submit,
+        'max_atoms_submit': max_atoms_submit,
+        'max_total_nodes': max_total_nodes,
+        'max_node_hours': max_node_hours,
+        'memory_gb': memory_gb,
+        'queue_name': queue_name,
+        'submit_debug': submit_debug,
+        'npools': npools,
+        'ndiag': ndiag,
+        'z_movement_only': z_movement_only,
+        'bundle_max_electrons': bundle_max_electrons,
+        'bundle_mpiprocs': bundle_mpiprocs,
+        'bundle_mpiprocs_per_machine':
+            bundle_code.computer.get_default_mpiprocs_per_machine() if bundle_code else None,
+    }
+    # spawned workers inherit neither the database connection of the profile
+    # nor the communicator thread of the throttle
+    if num_workers == 0:
+        num_workers = os.cpu_count()
+    preparation_pool = (multiprocessing.get_context('spawn').Pool(num_workers)
+                        if num_workers > 1 else None)
+    try:
+        prepared_submissions = iter_prepared_submissions(
+                                 uncalculated_structures, preparation_settings,
+                                 pool=preparation_pool,
+                                 num_prepare_ahead=num_prepare_ahead)
+        throttle.subscribe()
+        throttle.refresh()
+
+        if scheduling_policy != 'database':
+            # prepare every structure up front, then submit in policy order whatever
+            # fits in the free resources
+            scheduled_structures = {}
+            scheduled_submissions = []
+            for structure, prepared_submission in prepared_submissions:
+                if 'skip_reason' in prepared_submission:
+                    print("{} {}".format(structure, prepared_submission['skip_reason']))
+                    continue
+                scheduled_structures[structure.pk] = structure
+                scheduled_submissions.append(prepared_submission)
+            print("{} structures scheduled, {:.1f} node-hours requested".format(
+                  len(scheduled_submissions),
+                  sum(x['node_hours'] for x in scheduled_submissions)))
+            prepared_submissions = ((scheduled_structures[x['id']], x) for x in
+                                    iter_packed_submissions(
+                                      order_submissions(scheduled_submissions,
+                                                        scheduling_policy),
+                                      throttle))
+
+        # nodes shared by all the submissions
+        pseudo_family = Str(pseudo_familyname)
+        clean_workdir = Bool(not keep_workdir)
+
+        # submit calculations
+        submit_counter=0
+        for structure, prepared_submission in prepared_submissions:
+            if use_conventional_structure:
+                structure = wf_getconventionalstructure(structure)
+            print("Preparing to launch {}".format(structure))
+            print("calcs to submit: {} (active/max){}:{}".format(
+                                         len(uncalculated_structure_ids) -submit_counter,
+                                                            throttle.free_slots,
+                                                            max_active_calculations))
+            submit_counter += 1
+
+            if 'skip_reason' in prepared_submission:
+                print("{} {}".format(structure, prepared_submission['skip_reason']))
                 continue
-        options_dict = {
-            'max_wallclock_seconds': max_wallclock_seconds,
-            'resources': {'num_machines': num_machines},
-        }
-        if memory_gb:
-            options_dict['max_memory_kb'] = int(int(memory_gb)*1024*1024)
-        if submit_debug:
-            num_machines = 2
-            options_dict['resources']['num_machines'] = num_machines
-            options_dict['max_wallclock_seconds'] = int(30*60)
-            options_dict['queue_name'] = 'debug'
-        workchain_options = options_dict
-
-        if npools:
-            nk = npools
-        else:
-            nk = get_nk(num_machines, code)
-        settings_dict = {
-            'cmdline': ['-nk', nk],
-            'no_bands': True
-            }
-        if ndiag:
-            settings_dict['cmdline'] += ['-ndiag', ndiag]
-        if z_movement_only:
-            num_atoms = len(structure.get_ase())
-            coordinate_fix = [[True,True,False]]*num_atoms
-            settings_dict['fixed_coords'] = coordinate_fix
-        settings = Dict(dict=settings_dict)
-
-        # setup inputs & submit workchain
-        clean_workdir = not keep_workdir
-        inputs = {
-                  'clean_workdir': Bool(clean_workdir),
-                  }
-        base_inputs = {
-            'pw': {
-                'code': code,
-                'parameters': wf_delete_vccards(parameters),
-                'metadata': {'options': workchain_options},
-                'settings': settings,
-            }
-        }
-        relax_inputs = {
-            'base': {k: base_inputs[k]  for k in base_inputs if k != 'parameters'},
-            'relaxation_scheme': Str('relax'),
-            'final_scf' : Bool(False),
-            'meta_convergence' : Bool(False)
-        }
-        if calc_method == 'scf':
-            WorkChain = WorkflowFactory('quantumespresso.pw.base')
-            inputs.update(base_inputs)
-            inputs['pw']['structure'] = structure
-            inputs['kpoints'] = kpoints
-            inputs['pseudo_family'] = Str(pseudo_familyname)
-        elif calc_method in ['relax', 'vc-relax']:
-            WorkChain = WorkflowFactory('quantumespresso.pw.relax')
-            inputs.update(relax_inputs)
-            inputs['structure'] = structure
-            inputs['base']['pseudo_family'] = Str(pseudo_familyname)
-            inputs['base']['kpoints'] = kpoints
-            if calc_method == 'relax':
-                inputs['relaxation_scheme'] = Str('relax')
-                parameters = wf_delete_vccards(parameters)
-                inputs['base']['pw']['parameters'] = parameters
-            elif calc_method == 'vc-relax':
-                inputs['relaxation_scheme'] = Str('vc-relax')
-                inputs['base']['pw']['parameters'] = parameters
-            if calc_method == 'elastic':
-                if submit_debug:
-                    print("Using debug queue with elastic workchain is not advised!")
-        elif calc_method == 'elastic':
-            WorkChain = WorkflowFactory('elastic')
-            inputs['structure'] = structure
-
-            # Unfortunately deepcopy on code caueses issues so we need to duplicate
-            # a lot of information
-            sub_relax_inputs = {
-                'base': {k: base_inputs[k]  for k in base_inputs if k != 'parameters'},
-                'relaxation_scheme': Str('relax'),
-                'final_scf' : Bool(False),
-                'meta_convergence' : Bool(False)
-            }
-            sub_relax_inputs['base']['pseudo_family'] = Str(pseudo_familyname)
-            sub_relax_inputs['base']['kpoints'] = kpoints
-            sub_relax_inputs['relaxation_scheme'] = Str('relax')
-            sub_relax_parameters = wf_delete_vccards(parameters)
-            sub_relax_inputs['base']['pw']['parameters'] = sub_relax_parameters
-
 
-            sub_vcrelax_inputs = {
+            # start timer to inspect job submission times
+            from timeit import default_timer as timer
+            start = timer()
+
+            # setup the parameters & kpoints prepared by the workers
+            parameters = Dict(dict=prepared_submission['parameters'])
+            kpoints = KpointsData()
+            kpoints.set_kpoints_mesh(prepared_submission['kpoints_mesh'])
+
+            calc_code = bundle_code if prepared_submission['bundled'] else code
+            if prepared_submission['bundled']:
+                print("bundled on {}: {} processes".format(bundle_code.computer.label,
+                                                           bundle_mpiprocs))
+            num_machines = prepared_submission['num_machines']
+            node_hours = prepared_submission['node_hours']
+            workchain_options = prepared_submission['options']
+            if prepared_submission['model_npools'] is not None:
+                print("resource model: {} nodes, {} pools, {}s".format(
+                      num_machines, prepared_submission['model_npools'],
+                      workchain_options['max_wallclock_seconds']))
+
+            # ensure no quota is exceeded by the submission
+            throttle.wait_for_slot(num_machines, node_hours)
+
+            settings = Dict(dict=prepared_submission['settings'])
+
+            # setup inputs & submit workchain
+            inputs = {
+                      'clean_workdir': clean_workdir,
+                      }
+            base_inputs = {
+                'pw': {
+                    'code': calc_code,
+                    'parameters': wf_delete_vccards(parameters),
+                    'metadata': {'options': workchain_options},
+                    'settings': settings,
+                }
+            }
+            relax_inputs = {
                 'base': {k: base_inputs[k]  for k in base_inputs if k != 'parameters'},
                 'relaxation_scheme': Str('relax'),
                 'final_scf' : Bool(False),
                 'meta_convergence' : Bool(False)
             }
-            sub_vcrelax_inputs['base']['pseudo_family'] = Str(pseudo_familyname)
-            sub_vcrelax_inputs['base']['kpoints'] = kpoints
-            sub_vcrelax_inputs['relaxation_scheme'] = Str('relax')
-            sub_vcrelax_inputs['relaxation_scheme'] = Str('vc-relax')
-            sub_vcrelax_inputs['base']['pw']['parameters'] = parameters
-
-            inputs['initial_relax'] = sub_vcrelax_inputs
-            inputs['elastic_relax'] = sub_relax_inputs
-
-            if strain_magnitudes:
-                strain_magnitudes_list = [float(x) for x in strain_magnitudes.split(',')]
-                inputs['strain_magnitudes'] = List(list=strain_magnitudes_list)
-            if use_all_strains:
-                inputs['symmetric_strains_only'] = Bool(False)
-        else:
-            raise Exception("Invalid calc_method: {}".format(calc_method))
-
-        def print_timing(start):
-            end = timer()
-            time_elapsed = end - start
-            print("timing: {}s".format(time_elapsed))
-
-        calcs_to_submit -= 1
-        if dryrun:
-            pprint("ase_structure: {}".format(structure.get_ase()))
-            pprint("aiida_settings: {}".format(settings.get_dict()))
-            #pprint "aiida_parameters: {}".format(inputs['base']['parameters'].get_dict())
-            pprint("aiida_options: {}".format(workchain_options))
-            pprint("aiida_inputs: ")
-            pprint(inputs)
-            print_timing(start)
-            continue
-        elif run_debug:
-            run(WorkChain, **inputs)
-            sys.exit()
-        else:
-            node = submit(WorkChain, **inputs)
-            print("WorkChain: {} submitted".format(node))
-            print_timing(start)
-
-        if submit_debug:
-            sys.exit()
-
-        workchain_group.add_nodes([node])
-
+            if calc_method == 'scf':
+                WorkChain = WorkflowFactory('quantumespresso.pw.base')
+                inputs.update(base_inputs)
+                inputs['pw']['structure'] = structure
+                inputs['kpoints'] = kpoints
+                inputs['pseudo_family'] = pseudo_family
+            elif calc_method in ['relax', 'vc-relax']:
+                WorkChain = WorkflowFactory('quantumespresso.pw.relax')
+                inputs.update(relax_inputs)
+                inputs['structure'] = structure
+                inputs['base']['pseudo_family'] = pseudo_family
+                inputs['base']['kpoints'] = kpoints
+                if calc_method == 'relax':
+                    inputs['relaxation_scheme'] = Str('relax')
+                    parameters = wf_delete_vccards(parameters)
+                    inputs['base']['pw']['parameters'] = parameters
+                elif calc_method == 'vc-relax':
+                    inputs['relaxation_scheme'] = Str('vc-relax')
+                    inputs['base']['pw']['parameters'] = parameters
+                if calc_method == 'elastic':
+                    if submit_debug:
+                        print("Using debug queue with elastic workchain is not advised!")
+            elif calc_method == 'elastic':
+                WorkChain = WorkflowFactory('elastic')
+                inputs['structure'] = structure
+
+                # Unfortunately deepcopy on code caueses issues so we need to duplicate
+                # a lot of information
+                sub_relax_inputs = {
+                    'base': {k: base_inputs[k]  for k in base_inputs if k != 'parameters'},
+                    'relaxation_scheme': Str('relax'),
+                    'final_scf' : Bool(False),
+                    'meta_convergence' : Bool(False)
+                }
+                sub_relax_inputs['base']['pseudo_family'] = pseudo_family
+                sub_relax_inputs['base']['kpoints'] = kpoints
+                sub_relax_inputs['relaxation_scheme'] = Str('relax')
+                sub_relax_parameters = wf_delete_vccards(parameters)
+                sub_relax_inputs['base']['pw']['parameters'] = sub_relax_parameters
+
+
+                sub_vcrelax_inputs = {
+                    'base': {k: base_inputs[k]  for k in base_inputs if k != 'parameters'},
+                    'relaxation_scheme': Str('relax'),
+                    'final_scf' : Bool(False),
+                    'meta_convergence' : Bool(False)
+                }
+                sub_vcrelax_inputs['base']['pseudo_family'] = pseudo_family
+                sub_vcrelax_inputs['base']['kpoints'] = kpoints
+                sub_vcrelax_inputs['relaxation_scheme'] = Str('relax')
+                sub_vcrelax_inputs['relaxation_scheme'] = Str('vc-relax')
+                sub_vcrelax_inputs['base']['pw']['parameters'] = parameters
+
+                inputs['initial_relax'] = sub_vcrelax_inputs
+                inputs['elastic_relax'] = sub_relax_inputs
+
+                if strain_magnitudes:
+                    strain_magnitudes_list = [float(x) for x in strain_magnitudes.split(',')]
+                    inputs['strain_magnitudes'] = List(list=strain_magnitudes_list)
+                if use_all_strains:
+                    inputs['symmetric_strains_only'] = Bool(False)
+            else:
+                raise Exception("Invalid calc_method: {}".format(calc_method))
+
+            def print_timing(start):
+                end = timer()
+                time_elapsed = end - start
+                print("timing: {}s".format(time_elapsed))
+
+            throttle.take_slot(num_machines, node_hours)
+            if dryrun:
+                pprint("ase_structure: {}".format(get_ase_structure(structure)))
+                pprint("aiida_settings: {}".format(settings.get_dict()))
+                #pprint "aiida_parameters: {}".format(inputs['base']['parameters'].get_dict())
+                pprint("aiida_options: {}".format(workchain_options))
+                pprint("aiida_inputs: ")
+                pprint(inputs)
+                print_timing(start)
+                continue
+            elif run_debug:
+                run(WorkChain, **inputs)
+                sys.exit()
+            else:
+                node = submit(WorkChain, **inputs)
+                print("WorkChain: {} submitted".format(node))
+                print_timing(start)
+
+            if submit_debug:
+                sys.exit()
+
+            workchain_group.add_nodes([node])
+    finally:
+        throttle.unsubscribe()
+        if preparation_pool is not None:
+            preparation_pool.terminate()
 
 
 if __name__ == "__main__":
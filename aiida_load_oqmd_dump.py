@@ -4,11 +4,48 @@ aiida.load_profile()
 
 import click
 import ase
+import ase.io
+import functools
 import glob
 import json
 import os
 from aiida_create_solutesupercell_structures import *
 
+def iter_oqmd_entries(oqmd_dumpfiles, known_hashes):
+    """
+    Yields the (dumpfile, content_hash) of the entries not yet imported, i.e.
+    whose POSCAR and json content hash is not in known_hashes
+    """
+    num_skipped = 0
+    for oqmd_dumpfile in oqmd_dumpfiles:
+        oqmd_json = oqmd_dumpfile+'.json'
+        if not os.path.isfile(oqmd_json):
+            print(("No meta file found for {} refusing to load".format(
+                   oqmd_dumpfile)))
+            continue
+        content_hash = get_file_content_hash([oqmd_dumpfile, oqmd_json])
+        if content_hash in known_hashes:
+            num_skipped += 1
+            continue
+        known_hashes.add(content_hash)
+        yield oqmd_dumpfile, content_hash
+    print("{} entries skipped, already imported".format(num_skipped))
+
+def read_oqmd_entry(oqmd_entry, extras):
+    """
+    Parses one entry, run in the worker processes (no database access)
+    """
+    oqmd_dumpfile, content_hash = oqmd_entry
+    oqmd_structure = ase.io.read(oqmd_dumpfile, format='vasp')
+    with open(oqmd_dumpfile+'.json', 'r') as fp:
+        oqmd_meta = json.load(fp)
+
+    for k,v in extras.items():
+        if k not in oqmd_meta:
+            oqmd_meta[k] = v
+    oqmd_meta[SOURCE_HASH_EXTRA] = content_hash
+    return oqmd_structure, oqmd_meta
+
 @click.command()
 @click.option('-od', '--oqmd_dumpdir', required=True,
                help="path to a directory containing a dump of OQMD entries")
@@ -19,13 +56,19 @@ from aiida_create_solutesupercell_structures import *
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-nw', '--num_workers', default=DEFAULT_NUM_WORKERS, type=int,
+              help="Number of processes parsing the dump, 0 uses all cores")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
-def launch(oqmd_dumpdir, structure_group_label, structure_group_description, extras,  dryrun):
+def launch(oqmd_dumpdir, structure_group_label, structure_group_description, extras,
+           num_workers, flush_size, dryrun):
     """
     Load an 'OQMD' dump (created by an custom script). Expects a directory containing a set
     of OQMD_<ID> vasp-formatted POSCAR, and for each of these a corresponding OQMD_<ID>.json
-    json file wich contains a dump of the meta-data
+    json file wich contains a dump of the meta-data. Entries whose files were already
+    imported into the group (same content hash) are skipped without being parsed.
     """
     if extras is not None:
         extras = {y[0]:y[1] for y in [x.split(',') for x in extras.split('|')]}
@@ -33,28 +76,20 @@ def launch(oqmd_dumpdir, structure_group_label, structure_group_description, ext
         extras = {}
 
     print("loading dataset: {} to group: {}".format(oqmd_dumpdir, structure_group_label))
-    # Setup/Retrieve the Group
-    structure_group = Group.objects.get_or_create(label=structure_group_label,
-                            description=structure_group_description)[0]
+    structure_group, storage_batch = get_structure_sink(
+                                       'aiida', None,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     oqmd_dumpfiles = glob.glob(oqmd_dumpdir+'/*')
-    oqmd_dumpfiles = [x for x in oqmd_dumpfiles if '.' not in os.path.basename(x)]
-    print(oqmd_dumpfiles)
-    for oqmd_dumpfile in oqmd_dumpfiles:
-        oqmd_structure = ase.io.read(oqmd_dumpfile, format='vasp')
-
-        oqmd_json = oqmd_dumpfile+'.json'
-        if not os.path.isfile(oqmd_json):
-            print(("No meta file found for {} refusing to load".format(
-                   oqmd_dumpfile)))
-            continue
-        with open(oqmd_json, 'r') as fp:
-            oqmd_meta = json.load(fp)
+    oqmd_dumpfiles = sorted([x for x in oqmd_dumpfiles if '.' not in os.path.basename(x)])
+    print("{} entries found".format(len(oqmd_dumpfiles)))
+    known_hashes = get_group_extra_values(structure_group_label, SOURCE_HASH_EXTRA)
 
-        for k,v in extras.items():
-            if k not in oqmd_meta:
-                oqmd_meta[k] = v
-        store_asestructure(oqmd_structure, oqmd_meta, structure_group, dryrun)
+    oqmd_entries = iter_oqmd_entries(oqmd_dumpfiles, known_hashes)
+    oqmd_structures = generate_samples(functools.partial(read_oqmd_entry, extras=extras),
+                                       oqmd_entries, num_workers)
+    write_structures(oqmd_structures, storage_batch)
 
 if __name__ == "__main__":
     launch()
@@ -4,11 +4,50 @@ aiida.load_profile()
 
 import click
 import ase
+import ase.io
 import glob
 import json
 import os
 from aiida_create_solutesupercell_structures import *
 
+def iter_phonopy_entries(phonopydirs, known_hashes):
+    """
+    Yields the (displacement POSCAR, meta json, content_hash) of the displacements
+    not yet imported, i.e. whose POSCAR and json content hash is not in known_hashes
+    """
+    num_skipped = 0
+    for phonopydir in phonopydirs:
+        phonopy_json = os.path.join(phonopydir, "AiiDA.json")
+        if not os.path.isfile(phonopy_json):
+            print(("No meta file found for {} refusing to load".format(
+                   phonopydir)))
+            continue
+        #Loop all relevant phonopy displacement poscar
+        phonopy_disp_poscars = sorted(glob.glob(phonopydir+'/POSCAR-*'))
+        for phonopy_disp_poscar in phonopy_disp_poscars:
+            content_hash = get_file_content_hash([phonopy_disp_poscar, phonopy_json])
+            if content_hash in known_hashes:
+                num_skipped += 1
+                continue
+            known_hashes.add(content_hash)
+            yield phonopy_disp_poscar, phonopy_json, content_hash
+    print("{} displacements skipped, already imported".format(num_skipped))
+
+def read_phonopy_entry(phonopy_entry):
+    """
+    Parses one displacement, run in the worker processes (no database access)
+    """
+    phonopy_disp_poscar, phonopy_json, content_hash = phonopy_entry
+    with open(phonopy_json, 'r') as fp:
+        phonopy_meta = json.load(fp)
+    phonopy_structure = ase.io.read(phonopy_disp_poscar, format='vasp')
+    phonopy_disp_id = int(os.path.basename(phonopy_disp_poscar).split('-')[-1])
+    #storing the phonopy displacement id, corresponding with phonopy_disp.yaml
+    phonopy_meta['phonopy_disp_id'] = phonopy_disp_id
+    phonopy_meta['phonopy_dirname'] = os.path.dirname(phonopy_disp_poscar)
+    phonopy_meta[SOURCE_HASH_EXTRA] = content_hash
+    return phonopy_structure, phonopy_meta
+
 @click.command()
 @click.option('-pbd', '--phonopy_basedir', required=True,
                help="path to a directory containing a dump of OQMD entries")
@@ -16,39 +55,36 @@ from aiida_create_solutesupercell_structures import *
               help="Output AiiDA group to store created structures")
 @click.option('-sgd', '--structure_group_description', default="",
               help="Description for output AiiDA group")
+@click.option('-nw', '--num_workers', default=DEFAULT_NUM_WORKERS, type=int,
+              help="Number of processes parsing the dump, 0 uses all cores")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
 @click.option('-dr', '--dryrun', is_flag=True,
               help="Prints structures and extras but does not store anything")
-def launch(phonopy_basedir, structure_group_label, structure_group_description, dryrun):
+def launch(phonopy_basedir, structure_group_label, structure_group_description,
+           num_workers, flush_size, dryrun):
     """
-    Load an 'OQMD' dump (created by an custom script). Expects a directory containing a set
-    of OQMD_<ID> vasp-formatted POSCAR, and for each of these a corresponding OQMD_<ID>.json
-    json file wich contains a dump of the meta-data
+    Load a phonopy dump. Expects a directory containing a set of PHONOPY_<ID>
+    directories, each with vasp-formatted POSCAR-<disp_id> displacements and an
+    AiiDA.json json file wich contains a dump of the meta-data. Displacements
+    whose files were already imported into the group (same content hash) are
+    skipped without being parsed.
     """
 
     print("loading dataset: {} to group: {}".format(phonopy_basedir, structure_group_label))
-    # Setup/Retrieve the Group
-    structure_group = Group.objects.get_or_create(label=structure_group_label,
-                            description=structure_group_description)[0]
+    structure_group, storage_batch = get_structure_sink(
+                                       'aiida', None,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
 
     #Loop all relevant phonopy dirs
-    phonopydirs = glob.glob(phonopy_basedir+'/PHONOPY_*')
-    for phonopydir in phonopydirs:
-        phonopy_json = os.path.join(phonopydir, "AiiDA.json")
-        if not os.path.isfile(phonopy_json):
-            print(("No meta file found for {} refusing to load".format(
-                   phonopy_dumpfile)))
-            continue
-        with open(phonopy_json, 'r') as fp:
-            phonopy_meta = json.load(fp)
-        #Loop all relevant phonopy displacement poscar
-        phonopy_disp_poscars = glob.glob(phonopydir+'/POSCAR-*')
-        for phonopy_disp_poscar in phonopy_disp_poscars:
-            phonopy_structure = ase.io.read(phonopy_disp_poscar, format='vasp')
-            phonopy_disp_id = int(os.path.basename(phonopy_disp_poscar).split('-')[-1])
-            #storing the phonopy displacement id, corresponding with phonopy_disp.yaml
-            phonopy_meta['phonopy_disp_id'] = phonopy_disp_id
-            phonopy_meta['phonopy_dirname'] = os.path.dirname(phonopy_disp_poscar)
-            store_asestructure(phonopy_structure, phonopy_meta, structure_group, dryrun)
+    phonopydirs = sorted(glob.glob(phonopy_basedir+'/PHONOPY_*'))
+    known_hashes = get_group_extra_values(structure_group_label, SOURCE_HASH_EXTRA)
+
+    phonopy_entries = iter_phonopy_entries(phonopydirs, known_hashes)
+    phonopy_structures = generate_samples(read_phonopy_entry, phonopy_entries,
+                                          num_workers)
+    write_structures(phonopy_structures, storage_batch)
 
 if __name__ == "__main__":
     launch()
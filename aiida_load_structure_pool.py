@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+import aiida
+aiida.load_profile()
+
+import click
+from aiida_create_solutesupercell_structures import *
+from structure_sinks import read_structure_pool
+
+@click.command()
+@click.option('-pp', '--pool_path', required=True,
+              help="Directory written by an aiida_create_* script with "
+                   "--output_format poscar or columnar")
+@click.option('-fpf', '--fingerprints_file', default=None,
+              help="Only load the structures whose structure_fingerprint is listed "
+                   "(one per line) in this file")
+@click.option('-sg', '--structure_group_label', required=True,
+              help="Output AiiDA group to store created structures")
+@click.option('-sgd', '--structure_group_description', default="",
+              help="Description for output AiiDA group")
+@click.option('-fls', '--flush_size', default=DEFAULT_FLUSH_SIZE, type=int,
+              help="Number of structures stored per database transaction")
+@click.option('-dr', '--dryrun', is_flag=True,
+              help="Prints structures and extras but does not store anything")
+def launch(pool_path, fingerprints_file, structure_group_label,
+           structure_group_description, flush_size, dryrun):
+    """
+    Load (a selection of) a structure pool written to disk by one of the
+    aiida_create_* scripts into an AiiDA group
+    """
+    print("loading pool: {} to group: {}".format(pool_path, structure_group_label))
+    structure_group, storage_batch = get_structure_sink(
+                                       'aiida', None,
+                                       structure_group_label, structure_group_description,
+                                       dryrun=dryrun, flush_size=flush_size)
+
+    pool_structures = read_structure_pool(pool_path)
+    if fingerprints_file is not None:
+        with open(fingerprints_file, 'r') as fp:
+            selected_fingerprints = set(x.strip() for x in fp if x.strip())
+        pool_structures = (x for x in pool_structures
+                           if x[1].get(FINGERPRINT_EXTRA) in selected_fingerprints)
+    write_structures(pool_structures, storage_batch)
+
+if __name__ == "__main__":
+    launch()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Enumeration of symmetry-distinct clusters (pairs, triplets, ...) of sites in a
+supercell and of their symmetry-distinct decorations. The space group of the
+supercell is obtained from spglib and split into its pure translations and one
+operation per rotation, such that the canonical form of a cluster only requires
+(number of rotations) x (cluster size) site lookups.
+"""
+import itertools
+import numpy as np
+from neighbor_shells import get_periodic_vectors, wrap_scaled_positions
+
+
+def get_supercell_symmetry(ase_structure, symprec=1e-3):
+    """
+    Returns a dict with the data required to map clusters by the space group
+    of the structure
+    """
+    import spglib
+    from scipy.spatial import cKDTree
+
+    lattice = np.array(ase_structure.get_cell())
+    scaled_positions = wrap_scaled_positions(ase_structure.get_scaled_positions())
+    symmetry = spglib.get_symmetry(
+                 (lattice, scaled_positions, ase_structure.get_atomic_numbers()),
+                 symprec=symprec)
+    rotations = symmetry['rotations']
+    translations = symmetry['translations']
+
+    is_translation = np.all(rotations == np.identity(3, dtype=int), axis=(1, 2))
+    _, coset_indexes = np.unique(rotations.reshape(len(rotations), -1), axis=0,
+                                 return_index=True)
+
+    supercell_symmetry = {
+        'scaled_positions': scaled_positions,
+        'site_tree': cKDTree(scaled_positions, boxsize=1.0),
+        'scaled_tolerance': symprec/np.min(np.linalg.norm(lattice, axis=1)),
+        'rotations': rotations[coset_indexes],
+        'translations': translations[coset_indexes],
+        'equivalent_atoms': symmetry['equivalent_atoms'],
+    }
+
+    # each site is referenced to the lowest index site related by a pure translation
+    class_reference = np.arange(len(scaled_positions))
+    for translation in translations[is_translation]:
+        translated_indexes = lookup_site_indexes(scaled_positions + translation,
+                                                 supercell_symmetry)
+        class_reference = np.minimum(class_reference, translated_indexes)
+    supercell_symmetry['class_reference'] = class_reference
+    return supercell_symmetry
+
+
+def lookup_site_indexes(scaled_positions, supercell_symmetry):
+    distances, site_indexes = supercell_symmetry['site_tree'].query(
+                                wrap_scaled_positions(scaled_positions))
+    if np.any(distances > supercell_symmetry['scaled_tolerance']):
+        raise Exception("Symmetry operation does not map onto a site")
+    return site_indexes
+
+
+def get_canonical_cluster(cluster_indexes, supercell_symmetry):
+    """
+    Returns the canonical form of a cluster (the smallest sorted tuple of site
+    indexes among its symmetry images) and the permutations of the cluster
+    sites by the operations mapping the cluster onto itself. A permutation p
+    means that site i of the cluster is mapped onto site p[i].
+    """
+    cluster_size = len(cluster_indexes)
+    scaled_positions = supercell_symmetry['scaled_positions']
+    class_reference = supercell_symmetry['class_reference']
+    cluster_positions = scaled_positions[list(cluster_indexes)]
+
+    # images by one operation per rotation
+    mapped_positions = (np.einsum('oij,kj->oki', supercell_symmetry['rotations'],
+                                  cluster_positions)
+                        + supercell_symmetry['translations'][:, None, :])
+    mapped_indexes = lookup_site_indexes(mapped_positions.reshape(-1, 3),
+                                         supercell_symmetry)
+    mapped_indexes = mapped_indexes.reshape(-1, cluster_size)
+
+    # translate each image such that each of its sites, in turn, is on its reference
+    shifts = (scaled_positions[class_reference[mapped_indexes]]
+              - scaled_positions[mapped_indexes])
+    translated_positions = mapped_positions[:, None, :, :] + shifts[:, :, None, :]
+    image_indexes = lookup_site_indexes(translated_positions.reshape(-1, 3),
+                                        supercell_symmetry)
+    image_indexes = image_indexes.reshape(-1, cluster_size)
+
+    image_keys = np.sort(image_indexes, axis=1)
+    order = np.lexsort(image_keys.T[::-1])
+    canonical_cluster = image_keys[order[0]]
+
+    achieving_images = image_indexes[np.all(image_keys == canonical_cluster, axis=1)]
+    reference_position = {x: i for i, x in enumerate(achieving_images[0])}
+    permutations = np.array([[reference_position[x] for x in image]
+                             for image in achieving_images])
+    permutations = np.unique(permutations, axis=0)
+    return tuple(int(x) for x in canonical_cluster), permutations
+
+
+def get_cluster_permutations(cluster_indexes, supercell_symmetry):
+    return get_canonical_cluster(cluster_indexes, supercell_symmetry)[1]
+
+
+def get_cluster_orbits(ase_structure, cluster_size, cutoff, supercell_symmetry=None,
+                       symprec=1e-3):
+    """
+    Enumerates the symmetry-distinct clusters of cluster_size sites for which all
+    site-site distances are within the cutoff. Clusters are anchored on one site
+    of each site orbit, since every cluster has a translated/rotated image
+    containing such a site. Returns a list of dicts, sorted by cluster size, with
+    the site indexes of a representative cluster, its sorted pair distances and
+    the permutations of its sites by its symmetry operations.
+    """
+    if supercell_symmetry is None:
+        supercell_symmetry = get_supercell_symmetry(ase_structure, symprec=symprec)
+    anchors = np.unique(supercell_symmetry['equivalent_atoms'])
+
+    cluster_orbits = {}
+    for anchor in anchors:
+        indexes, vectors, _ = get_periodic_vectors(ase_structure, anchor, cutoff=cutoff)
+        neighbors = indexes != anchor
+        neighbor_indexes = indexes[neighbors]
+        neighbor_vectors = np.vstack([np.zeros((1, 3)), vectors[neighbors]])
+        pair_distances = np.linalg.norm(neighbor_vectors[:, None, :]
+                                        - neighbor_vectors[None, :, :], axis=2)
+
+        for combination in itertools.combinations(range(1, len(neighbor_vectors)),
+                                                  cluster_size-1):
+            cluster_sites = [0] + list(combination)
+            cluster_distances = pair_distances[np.ix_(cluster_sites, cluster_sites)]
+            if np.any(cluster_distances > cutoff + 1e-8):
+                continue
+            cluster_indexes = [int(anchor)] + [int(neighbor_indexes[x-1])
+                                               for x in combination]
+            canonical_cluster, permutations = get_canonical_cluster(
+                                                cluster_indexes, supercell_symmetry)
+            if canonical_cluster in cluster_orbits:
+                continue
+            cluster_orbits[canonical_cluster] = {
+                'indexes': cluster_indexes,
+                'distances': np.sort(cluster_distances[
+                               np.triu_indices(cluster_size, 1)]).round(6).tolist(),
+                'permutations': permutations,
+            }
+
+    return sorted(cluster_orbits.values(),
+                  key=lambda x: (x['distances'][::-1], x['indexes']))
+
+
+def get_canonical_decoration(decoration, permutations):
+    """
+    Smallest of the decorations (element per cluster site) related by the given
+    cluster permutations
+    """
+    decoration = np.asarray(decoration)
+    # site i is mapped onto p[i], i.e. the new decoration at p[i] is decoration[i]
+    return min(tuple(decoration[np.argsort(permutation)].tolist())
+               for permutation in permutations)
+
+
+def get_distinct_decorations(elements, permutations):
+    """
+    Returns the symmetry-distinct decorations of a cluster with the elements
+    """
+    cluster_size = len(permutations[0])
+    distinct_decorations = []
+    for decoration in itertools.product(elements, repeat=cluster_size):
+        if get_canonical_decoration(decoration, permutations) == decoration:
+            distinct_decorations.append(decoration)
+    return distinct_decorations
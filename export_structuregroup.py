@@ -2,13 +2,20 @@
 import click
 import ase
 import ase.build
+import ase.io
+import functools
+import io
 import json
 import os
+import tarfile
 import aiida
 aiida.load_profile()
 from aiida.orm import QueryBuilder
 from aiida.orm import Node, Group
 from aiida.orm import load_node
+from structure_arrays import (get_arrays_from_attributes, get_ase_from_arrays,
+                              get_ase_structure)
+from aiida_create_solutesupercell_structures import generate_samples
 
 def get_structurenode_metadict(structure_node):
     meta_dict = structure_node.extras
@@ -17,7 +24,7 @@ def get_structurenode_metadict(structure_node):
 
 
 def export_structure_node(structure_node, output_path, ase_format='vasp'):
-    ase_structure = structure_node.get_ase()
+    ase_structure = get_ase_structure(structure_node)
     meta_dict = get_structurenode_metadict(structure_node)
 
     ase_structure.write(output_path, format=ase_format)
@@ -33,6 +40,154 @@ def get_allnodes_fromgroup(group_label):
     all_nodes = [x[0] for x in qb.all()]
     return all_nodes
 
+# export formats writing a single archive instead of one POSCAR/.json pair per node
+ARCHIVE_FORMATS = ['extxyz', 'tar']
+
+def iter_structure_entries(group_label=None, uuid=None, batch_size=1000):
+    """
+    Yields the (pk, uuid, attributes, extras) of the structures to export,
+    streamed from a single query
+    """
+    from aiida.orm import StructureData
+
+    if group_label is None:
+        structure_node = load_node(uuid)
+        yield (structure_node.pk, structure_node.uuid,
+               structure_node.attributes, structure_node.extras)
+        return
+    qb = QueryBuilder()
+    qb.append(Group, filters={'label': group_label}, tag='g')
+    qb.append(StructureData, with_group='g',
+              project=['id', 'uuid', 'attributes', 'extras'])
+    for entry in qb.iterall(batch_size=batch_size):
+        yield entry
+
+def convert_structure_entry(structure_entry, export_format):
+    """
+    Converts one entry to the text of its frame/file (None if it fails) and its
+    metadata row, run in the worker processes (no database access)
+    """
+    pk, uuid, attributes, extras = structure_entry
+    meta_dict = dict(extras)
+    meta_dict['uuid'] = uuid
+    meta_dict['pk'] = pk
+    try:
+        ase_structure = get_ase_from_arrays(get_arrays_from_attributes(attributes))
+        ase_structure.info = {'uuid': uuid, 'pk': pk}
+        text_buffer = io.StringIO()
+        if export_format == 'extxyz':
+            ase.io.write(text_buffer, ase_structure, format='extxyz')
+        else:
+            ase.io.write(text_buffer, ase_structure, format='vasp')
+        structure_text = text_buffer.getvalue()
+    except Exception:
+        print(("Failed to parse {}".format(uuid)))
+        structure_text = None
+    return structure_text, meta_dict
+
+def get_resume_state(metadata_path, archive_path, archive_end=b''):
+    """
+    Returns the uuids of the structures in the metadata file, after restoring
+    the archive to its state when the last metadata row was written: an
+    incomplete last row (killed while writing) is dropped, and the archive is
+    truncated to the archive_offset of the last row, removing frames written
+    without their metadata row (interrupted between the two writes), and
+    terminated by archive_end (the end of archive blocks of a tar)
+    """
+    if not os.path.isfile(metadata_path):
+        if os.path.isfile(archive_path):
+            raise Exception("{} exists without its metadata file {}".format(
+                            archive_path, metadata_path))
+        return set()
+
+    metadata_rows = []
+    metadata_size = 0
+    with open(metadata_path, 'rb') as fp:
+        for line in fp:
+            if not line.endswith(b'\n'):
+                break
+            metadata_size += len(line)
+            if line.strip():
+                metadata_rows.append(json.loads(line.decode('utf-8')))
+    with open(metadata_path, 'ab') as fp:
+        fp.truncate(metadata_size)
+
+    archive_offset = metadata_rows[-1].get('archive_offset') if metadata_rows else 0
+    if archive_offset is not None and os.path.isfile(archive_path):
+        if os.path.getsize(archive_path) < archive_offset:
+            raise Exception("{} is shorter than recorded in {}".format(
+                            archive_path, metadata_path))
+        with open(archive_path, 'ab') as fp:
+            fp.truncate(archive_offset)
+            if archive_offset > 0:
+                fp.write(archive_end)
+    return set(x['uuid'] for x in metadata_rows)
+
+def export_archive(structure_entries, output_dir, archive_name, export_format,
+                   num_workers):
+    """
+    Streams the structures into a single archive: a multi-frame extended xyz file
+    or a tar of POSCAR files, with one metadata (extras) row per structure in
+    a json lines file. Structures already in the metadata file are skipped, such
+    that interrupted exports can be resumed. The metadata rows of the structures
+    which failed to convert are written to a separate json lines file, rewritten
+    on each export, such that they are retried when resuming.
+
+    Each frame is flushed to the archive before its metadata row is written,
+    and the row records the archive_offset after the frame. An export
+    interrupted between the two writes (Ctrl-C) or killed with unflushed
+    buffers thus leaves at most frames without a row at the end of the
+    archive, which are truncated on resume (see get_resume_state), such that no
+    structure is exported twice. The flushes do not sync to disk, a system
+    crash can still lose the end of both files.
+    """
+    metadata_path = os.path.join(output_dir, archive_name+'.metadata.jsonl')
+    failed_path = os.path.join(output_dir, archive_name+'.failed.jsonl')
+    if export_format == 'extxyz':
+        archive_path = os.path.join(output_dir, archive_name+'.extxyz')
+        exported_uuids = get_resume_state(metadata_path, archive_path)
+    else:
+        archive_path = os.path.join(output_dir, archive_name+'.tar')
+        exported_uuids = get_resume_state(metadata_path, archive_path,
+                                          archive_end=b'\0'*(2*tarfile.BLOCKSIZE))
+    structure_entries = (x for x in structure_entries if x[1] not in exported_uuids)
+    converted_entries = generate_samples(functools.partial(convert_structure_entry,
+                                                           export_format=export_format),
+                                         structure_entries, num_workers=num_workers,
+                                         chunksize=64)
+
+    if export_format == 'extxyz':
+        archive = open(archive_path, 'a')
+    else:
+        archive_exists = os.path.isfile(archive_path) and os.path.getsize(archive_path) > 0
+        archive = tarfile.open(archive_path, 'a' if archive_exists else 'w')
+
+    num_exported = 0
+    num_failed = 0
+    with archive, open(metadata_path, 'a') as metadata_file, \
+            open(failed_path, 'w') as failed_file:
+        for structure_text, meta_dict in converted_entries:
+            if structure_text is None:
+                failed_file.write(json.dumps(meta_dict)+'\n')
+                num_failed += 1
+                continue
+            if export_format == 'extxyz':
+                archive.write(structure_text)
+                archive.flush()
+                meta_dict['archive_offset'] = archive.tell()
+            else:
+                member_data = structure_text.encode('utf-8')
+                member_info = tarfile.TarInfo("AIIDA_{}".format(meta_dict['pk']))
+                member_info.size = len(member_data)
+                archive.addfile(member_info, io.BytesIO(member_data))
+                archive.fileobj.flush()
+                meta_dict['archive_offset'] = archive.offset
+            metadata_file.write(json.dumps(meta_dict)+'\n')
+            num_exported += 1
+    print(("{} structures exported to {}".format(num_exported, archive_path)))
+    if num_failed > 0:
+        print(("{} structures failed, listed in {}".format(num_failed, failed_path)))
+
 @click.command()
 @click.option('-od', '--output_dir', required=True
          , help="Directory to dump output files")
@@ -40,18 +195,38 @@ def get_allnodes_fromgroup(group_label):
               type=str, help="Group to export identified by label")
 @click.option('-u', '--uuid', default=None,
               type=str, help="Structure to export by uuid")
-def createjob(output_dir, group_label, uuid):
+@click.option('-ef', '--export_format', default='poscar',
+              type=click.Choice(['poscar']+ARCHIVE_FORMATS),
+              help="One POSCAR and .json file per node, or a single extended xyz "
+                   "or tar archive with a json lines metadata table")
+@click.option('-an', '--archive_name', default='structures',
+              help="Base name of the archive and metadata files")
+@click.option('-nw', '--num_workers', default=0, type=int,
+              help="Number of processes converting the structures of an archive, "
+                   "0 uses all cores")
+def createjob(output_dir, group_label, uuid, export_format, archive_name, num_workers):
     '''
     Dumps the contents of an AiiDA group into a directory. Creates a set of
     VASP-poscar files with the name AIIDA_<AiiDA-pk> for each of
     these coordinate files, a corresponding .json file is created
-    which contains the meta data for the entry.
+    which contains the meta data for the entry. With an archive export_format
+    the structures are instead written to a single file, with their meta data
+    in <archive_name>.metadata.jsonl and that of the structures which failed to
+    convert in <archive_name>.failed.jsonl.
     '''
     try:
         os.makedirs(output_dir)
     except Exception:
         pass
 
+    if export_format in ARCHIVE_FORMATS:
+        if group_label is None and uuid is None:
+            raise Exception("You must provide either group_label or uuid")
+        structure_entries = iter_structure_entries(group_label=group_label, uuid=uuid)
+        export_archive(structure_entries, output_dir, archive_name, export_format,
+                       num_workers)
+        return
+
     if group_label is not None:
         all_entries = get_allnodes_fromgroup(group_label)
     elif uuid:
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Generalized stacking fault (gamma) surface helpers for the tilted cell method.
+Displacements are fractions of the (per repeat) in-plane cell vectors a1 and a2.
+Two displacements give the same fault energy if they are related by an in-plane
+translation of the crystal or by a symmetry operation mapping the fault plane
+onto itself (operations flipping the plane normal also swap the two sides of the
+fault, i.e. reverse the displacement).
+"""
+import numpy as np
+
+
+def get_plane_symmetry(ase_structure, xrepeats=1, yrepeats=1, symprec=0.01):
+    """
+    Returns the symmetry operations of the fault plane acting on displacements:
+    the (n, 2, 2) rotations and the (m, 2) in-plane translations, in units of
+    the per repeat cell vectors a1 = cell[0]/xrepeats and a2 = cell[1]/yrepeats.
+    The operations are taken from the primitive cell, since a (e.g. orthogonal)
+    supercell does not have the full point group of the crystal.
+    """
+    import ase
+    import itertools
+    import spglib
+    from aiida_alloy.symmetry_cache import get_symmetry_data
+
+    lattice = np.array(ase_structure.get_cell())
+    plane_basis = np.array([lattice[0]/float(xrepeats), lattice[1]/float(yrepeats)])
+    plane_normal = np.cross(lattice[0], lattice[1])
+    plane_normal /= np.linalg.norm(plane_normal)
+
+    primitive_lattice, primitive_positions, primitive_numbers = spglib.standardize_cell(
+        (lattice, ase_structure.get_scaled_positions(), ase_structure.get_atomic_numbers()),
+        to_primitive=True, no_idealize=True, symprec=symprec)
+    primitive_structure = ase.Atoms(numbers=primitive_numbers, cell=primitive_lattice,
+                                    scaled_positions=primitive_positions, pbc=True)
+    primitive_rotations = get_symmetry_data(primitive_structure, symprec=symprec)['rotations']
+    rotations = np.einsum('ij,ojk,kl->oil', primitive_lattice.T, primitive_rotations,
+                          np.linalg.inv(primitive_lattice.T))
+    normal_projections = np.einsum('i,oij,j->o', plane_normal, rotations, plane_normal)
+    plane_preserving = np.isclose(np.abs(normal_projections), 1, atol=1e-3)
+
+    # rotated in-plane vectors expressed in the plane basis, reversed if the
+    # normal is flipped
+    rotated_basis = np.einsum('oij,kj->oki', rotations[plane_preserving], plane_basis)
+    plane_rotations = get_plane_coefficients(rotated_basis.reshape(-1, 3), plane_basis)
+    plane_rotations = np.transpose(plane_rotations.reshape(-1, 2, 2), (0, 2, 1))
+    plane_rotations *= np.sign(normal_projections[plane_preserving])[:, None, None]
+    plane_rotations = np.unique(np.round(plane_rotations, 6) + 0.0, axis=0)
+
+    # lattice vectors in the fault plane, within the per repeat cell
+    lattice_vectors = np.dot(np.array(list(itertools.product(range(-4, 5), repeat=3))),
+                             primitive_lattice)
+    in_plane = np.abs(np.dot(lattice_vectors, plane_normal)) < 1e-5
+    plane_translations = get_plane_coefficients(lattice_vectors[in_plane], plane_basis)
+    plane_translations = np.unique(wrap_displacements(plane_translations), axis=0)
+    return plane_rotations, plane_translations
+
+
+def get_plane_coefficients(vectors, plane_basis):
+    """
+    Coefficients of in-plane cartesian vectors in the plane basis
+    """
+    return np.linalg.lstsq(plane_basis.T, np.asarray(vectors).T, rcond=None)[0].T
+
+
+def wrap_displacements(displacements, decimals=6):
+    return np.round(np.asarray(displacements) % 1.0, decimals) % 1.0 + 0.0
+
+
+def get_displacement_images(displacements, plane_rotations, plane_translations):
+    """
+    Returns the (num_displacements, num_images, 2) wrapped displacements
+    equivalent to each displacement
+    """
+    rotated = np.einsum('oij,nj->noi', plane_rotations, displacements)
+    images = rotated[:, :, None, :] + plane_translations[None, None, :, :]
+    return wrap_displacements(images.reshape(len(displacements), -1, 2))
+
+
+def reduce_displacements(displacements, plane_rotations, plane_translations):
+    """
+    Returns, for each displacement, the index of the first displacement of the
+    list equivalent to it
+    """
+    displacements = np.asarray(displacements, dtype=float).reshape(-1, 2)
+    point_index = {}
+    for i, displacement in enumerate(wrap_displacements(displacements)):
+        point_index.setdefault(tuple(displacement), i)
+
+    images = get_displacement_images(displacements, plane_rotations, plane_translations)
+    representatives = np.arange(len(displacements))
+    for i in range(len(displacements)):
+        equivalent = [point_index[x] for x in map(tuple, images[i]) if x in point_index]
+        representatives[i] = min(equivalent + [i])
+    # equivalence is transitive, follow the chains to their first member
+    while np.any(representatives[representatives] != representatives):
+        representatives = representatives[representatives]
+    return representatives
+
+
+def get_sheared_cells(cell, a1, a2, displacements):
+    """
+    Returns the (num_displacements, 3, 3) tilted cells, where the third cell
+    vector is shifted by d_x*a1 + d_y*a2
+    """
+    displacements = np.asarray(displacements, dtype=float).reshape(-1, 2)
+    sheared_cells = np.repeat(np.array(cell)[None, :, :], len(displacements), axis=0)
+    sheared_cells[:, 2, :] += np.dot(displacements, np.array([a1, a2]))
+    return sheared_cells
+
+
+def get_refinement_displacements(known_displacements, known_energies, increments,
+                                 plane_rotations, plane_translations,
+                                 energy_tolerance):
+    """
+    Proposes new displacements for adaptive refinement of a gamma surface. The
+    energies are interpolated linearly between neighbouring known displacements
+    (a distance increments apart along x, y or a diagonal). The midpoint is added
+    where the energies of the two endpoints differ by more than energy_tolerance,
+    i.e. where the interpolant is uncertain. Known energies are expanded to all
+    their symmetry images and the proposals are reduced by symmetry.
+    Returns the new displacements and their energy differences.
+    """
+    known_displacements = np.asarray(known_displacements, dtype=float).reshape(-1, 2)
+    known_energies = np.asarray(known_energies, dtype=float)
+    images = get_displacement_images(known_displacements, plane_rotations,
+                                     plane_translations)
+    image_energies = np.repeat(known_energies, images.shape[1])
+    images = images.reshape(-1, 2)
+    energy_lookup = dict(zip(map(tuple, images), image_energies))
+
+    hx, hy = increments
+    steps = np.array([[hx, 0.], [0., hy], [hx, hy], [hx, -hy]])
+    points = np.array(list(energy_lookup.keys()))
+    energies = np.array(list(energy_lookup.values()))
+
+    candidates = {}
+    for step in steps:
+        endpoints = wrap_displacements(points + step)
+        midpoints = wrap_displacements(points + step/2.)
+        for midpoint, endpoint, energy in zip(map(tuple, midpoints),
+                                              map(tuple, endpoints), energies):
+            if endpoint not in energy_lookup or midpoint in energy_lookup:
+                continue
+            uncertainty = abs(energy_lookup[endpoint] - energy)
+            if uncertainty > energy_tolerance:
+                candidates[midpoint] = max(uncertainty, candidates.get(midpoint, 0.))
+
+    if len(candidates) == 0:
+        return np.zeros((0, 2)), np.zeros(0)
+    candidate_points = np.array(sorted(candidates.keys()))
+    representatives = np.unique(reduce_displacements(candidate_points, plane_rotations,
+                                                     plane_translations))
+    return (candidate_points[representatives],
+            np.array([candidates[tuple(x)] for x in candidate_points[representatives]]))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Vectorized neighbor-shell analysis for the structure generators. Distances are
+computed with periodic images for arbitrary (non-orthogonal) cells, and distance
+shells can be split into symmetry-distinct shells using the site symmetry of the
+center (via spglib).
+"""
+import itertools
+import numpy as np
+import pandas as pd
+
+
+def get_image_shifts(cell, pbc, cutoff=None):
+    """
+    Returns the integer lattice shifts to be considered. Without a cutoff only the
+    neighbouring images are used, which is sufficient to find the minimum image
+    of a wrapped displacement.
+    """
+    if cutoff is None:
+        bounds = [1, 1, 1]
+    else:
+        # the norms of the columns of inv(cell) are the inverse plane spacings
+        recip_norms = np.linalg.norm(np.linalg.inv(cell), axis=0)
+        bounds = [int(np.floor(cutoff*x + 0.5)) + 1 for x in recip_norms]
+    bounds = [x if periodic else 0 for x, periodic in zip(bounds, pbc)]
+    shifts = itertools.product(*[np.arange(-x, x+1) for x in bounds])
+    return np.array(list(shifts), dtype=float)
+
+
+def get_periodic_vectors(ase_structure, center_index=0, cutoff=None,
+                         periodic_images=False):
+    """
+    Returns the atom indexes, displacement vectors and distances from the center
+    site to every atom. By default only the minimum image of each atom is kept.
+    If periodic_images is set all images within the cutoff are returned, meaning
+    an atom index can appear more than once.
+    """
+    cell = np.array(ase_structure.get_cell())
+    pbc = np.array(ase_structure.get_pbc(), dtype=bool)
+    positions = ase_structure.get_positions()
+
+    scaled_displacements = np.linalg.solve(
+                             cell.T, (positions - positions[center_index]).T).T
+    scaled_displacements[:, pbc] -= np.round(scaled_displacements[:, pbc])
+
+    if periodic_images and cutoff is None:
+        raise Exception("A cutoff is required when using periodic images")
+    shifts = get_image_shifts(cell, pbc, cutoff if periodic_images else None)
+    vectors = np.dot(scaled_displacements[:, None, :] + shifts[None, :, :], cell)
+    distances = np.linalg.norm(vectors, axis=2)
+
+    if periodic_images:
+        atom_indexes, shift_indexes = np.nonzero(distances <= cutoff + 1e-8)
+    else:
+        atom_indexes = np.arange(len(ase_structure))
+        shift_indexes = np.argmin(distances, axis=1)
+        if cutoff is not None:
+            in_cutoff = distances[atom_indexes, shift_indexes] <= cutoff + 1e-8
+            atom_indexes = atom_indexes[in_cutoff]
+            shift_indexes = shift_indexes[in_cutoff]
+
+    return (atom_indexes,
+            vectors[atom_indexes, shift_indexes],
+            distances[atom_indexes, shift_indexes])
+
+
+def get_periodic_distances(ase_structure, center_index=0):
+    """
+    Minimum image distance from the center site to every atom
+    """
+    return get_periodic_vectors(ase_structure, center_index)[2]
+
+
+def get_minimum_image_distances(cells):
+    """
+    Shortest lattice vector of each of the (num_cells, 3, 3) cells. The cells
+    are Minkowski reduced first: the shortest vector of a skewed cell can need
+    arbitrarily large integer combinations of its vectors, but is among the
+    combinations with coefficients in [-1, 1] of the reduced vectors.
+    """
+    from ase.geometry import minkowski_reduce
+
+    reduced_cells = np.array([minkowski_reduce(x)[0] for x in cells]).reshape(-1, 3, 3)
+    coefficients = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+    coefficients = coefficients[np.any(coefficients != 0, axis=1)]
+    lattice_vectors = np.einsum('kj,cji->cki', coefficients, reduced_cells)
+    return np.min(np.linalg.norm(lattice_vectors, axis=2), axis=1)
+
+
+def wrap_scaled_positions(scaled_positions):
+    wrapped = scaled_positions % 1.0
+    wrapped[wrapped >= 1.0] = 0.0
+    return wrapped
+
+
+def get_site_rotations(ase_structure, center_index=0, symprec=1e-3):
+    """
+    Returns the cartesian rotations which leave the structure invariant when
+    applied about the center site (i.e. the site symmetry group). The candidate
+    rotations are the point group of the lattice (from spglib), each of which is
+    checked with a periodic KD-tree. This avoids running spglib on the whole
+    supercell, whose space group grows with the number of atoms.
+    """
+    import spglib
+    from scipy.spatial import cKDTree
+
+    lattice = np.array(ase_structure.get_cell())
+    lattice_symmetry = spglib.get_symmetry((lattice, [[0., 0., 0.]], [1]),
+                                           symprec=symprec)
+    candidate_rotations = np.unique(lattice_symmetry['rotations'], axis=0)
+
+    scaled_positions = ase_structure.get_scaled_positions(wrap=False)
+    scaled_displacements = scaled_positions - scaled_positions[center_index]
+    numbers = ase_structure.get_atomic_numbers()
+    site_tree = cKDTree(wrap_scaled_positions(scaled_displacements), boxsize=1.0)
+    scaled_tolerance = symprec/np.min(np.linalg.norm(lattice, axis=1))
+
+    site_rotations = []
+    for rotation in candidate_rotations:
+        mapped_displacements = np.dot(scaled_displacements, rotation.T)
+        distances, mapped_indexes = site_tree.query(
+                                      wrap_scaled_positions(mapped_displacements))
+        if (np.all(distances < scaled_tolerance) and
+                np.array_equal(numbers[mapped_indexes], numbers)):
+            site_rotations.append(rotation)
+
+    # fractional x' = R x maps to cartesian r' = L^T R L^-T r
+    site_rotations = np.einsum('ij,ojk,kl->oil', lattice.T, np.array(site_rotations),
+                               np.linalg.inv(lattice.T))
+    return site_rotations
+
+
+def get_canonical_vectors(vectors, rotations, decimals=4):
+    """
+    Maps each vector to the lexicographically smallest of its images under the
+    given rotations. Vectors sharing a canonical vector are symmetry equivalent.
+    """
+    num_vectors = len(vectors)
+    num_rotations = len(rotations)
+    rotated = np.einsum('oij,nj->noi', rotations, vectors)
+    rotated = (np.round(rotated, decimals) + 0.0).reshape(-1, 3)
+    vector_ids = np.repeat(np.arange(num_vectors), num_rotations)
+    order = np.lexsort((rotated[:, 2], rotated[:, 1], rotated[:, 0], vector_ids))
+    return rotated[order[::num_rotations]]
+
+
+def get_neighbor_shells(ase_structure, center_index=0, cutoff=None, max_shells=None,
+                        periodic_images=False, use_symmetry=True, symprec=1e-3,
+                        decimals=6):
+    """
+    Returns a frame of the neighbor shells around the center site, sorted by
+    distance. Each row gives the shell distance, the (lowest) index of a
+    representative atom and the number of atoms in the shell. The first row is
+    always the center site itself.
+
+    With use_symmetry, shells at the same distance which are not related by the
+    site symmetry of the center are returned as separate shells.
+    """
+    indexes, vectors, distances = get_periodic_vectors(
+                                    ase_structure, center_index, cutoff=cutoff,
+                                    periodic_images=periodic_images)
+    if use_symmetry:
+        rotations = get_site_rotations(ase_structure, center_index, symprec=symprec)
+        canonical_vectors = get_canonical_vectors(vectors, rotations)
+    else:
+        canonical_vectors = np.zeros((len(vectors), 3))
+
+    shell_keys = np.column_stack([np.round(distances, decimals), canonical_vectors])
+    _, first_indexes, shell_counts = np.unique(shell_keys, axis=0,
+                                               return_index=True,
+                                               return_counts=True)
+
+    nn_shell_frame = pd.DataFrame({
+                        'distances': np.round(distances[first_indexes], decimals),
+                        'indexes': indexes[first_indexes],
+                        'multiplicity': shell_counts,
+                        })
+    if max_shells is not None:
+        nn_shell_frame = nn_shell_frame.head(int(max_shells)+1)
+    return nn_shell_frame
+
+
+def find_cluster_indexes(ase_structure, pair_shells, center_index=0, decimals=6):
+    """
+    Finds a triplet of site indexes (center, j, k) whose center-j, j-k and center-k
+    distances correspond to the nearest-neighbour shells given in pair_shells
+    (e.g. (1,1,2)). Shells are numbered by the distances from the center site.
+    The lowest matching j and k are returned.
+    """
+    center_distances = get_periodic_distances(ase_structure, center_index)
+    shell_distances = np.unique(np.round(center_distances, decimals))
+    if max(pair_shells) >= len(shell_distances):
+        raise Exception("Supercell too small for pair shells {}".format(pair_shells))
+    target_distances = shell_distances[list(pair_shells)]
+    tolerance = 10.**-decimals
+
+    for j in np.nonzero(np.isclose(center_distances, target_distances[0],
+                                   atol=tolerance, rtol=0))[0]:
+        j_distances = get_periodic_distances(ase_structure, j)
+        matches = np.nonzero(
+                    np.isclose(j_distances, target_distances[1], atol=tolerance, rtol=0) &
+                    np.isclose(center_distances, target_distances[2], atol=tolerance, rtol=0)
+                    )[0]
+        if len(matches) > 0:
+            return [center_index, int(j), int(matches[0])]
+    raise Exception("No cluster found with pair shells {}".format(pair_shells))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+Cost model of pw.x calculations, fitted on the finished calculations of the
+database (see aiida_fit_resource_model.py). The wall time per SCF iteration is
+modelled as a power law of the problem size (k-points, bands, cell volume) and
+of the parallelization (machines, k-point pools), i.e. a linear least squares
+fit in log space. The number of SCF iterations is taken as the median of the
+fitted calculations of the same type (scf, relax, vc-relax).
+
+The launcher uses the model to choose, for each structure, the number of
+machines and pools with the lowest predicted node-hours whose predicted wall
+time fits in the wall time limit, i.e. the highest throughput per node-hour.
+The choice relies on the machine exponent, which is only determined if the
+number of machines of the fitted calculations varied independently of the
+problem size (e.g. not only through the electron count guess of the launcher).
+This is measured by the standard error of the fitted machine exponent, which
+grows with the variance inflation factor of the machine feature.
+"""
+import json
+import numpy as np
+
+RESOURCE_MODEL_FEATURES = ['num_kpoints', 'num_bands', 'volume', 'num_machines',
+                           'num_pools']
+# above this standard error the machine exponent is not determined
+MAX_MACHINE_EXPONENT_ERROR = 0.1
+
+
+def get_variance_inflation_factor(feature_matrix, column):
+    """
+    1/(1-R^2) of the regression of a column of the feature matrix (with an
+    intercept column) on the other columns, infinite for a constant column
+    """
+    target = feature_matrix[:, column]
+    others = np.delete(feature_matrix, column, axis=1)
+    total_variance = np.sum((target - np.mean(target))**2)
+    if total_variance < 1e-12:
+        return float('inf')
+    residuals = target - np.dot(others, np.linalg.lstsq(others, target, rcond=None)[0])
+    unexplained = np.sum(residuals**2)/total_variance
+    return float('inf') if unexplained < 1e-12 else 1./unexplained
+
+
+def get_feature_matrix(samples):
+    """
+    Log features (with an intercept column) of a list of sample dicts
+    """
+    features = np.array([[float(x[y]) for y in RESOURCE_MODEL_FEATURES]
+                         for x in samples]).reshape(-1, len(RESOURCE_MODEL_FEATURES))
+    return np.column_stack([np.ones(len(features)), np.log(features)])
+
+
+class ResourceModel(object):
+
+    def __init__(self, coefficients, scf_iterations, residual_std=0., num_samples=0,
+                 max_num_pools=None, num_machines_range=None,
+                 machine_exponent_error=None, machine_vif=None, condition_number=None):
+        """
+        :param coefficients: intercept and exponents of RESOURCE_MODEL_FEATURES of
+                             the wall time per SCF iteration (in s)
+        :param scf_iterations: dict calculation type -> typical SCF iterations
+        :param residual_std: standard deviation of the log residuals of the fit
+        :param max_num_pools: largest number of pools of the fitted calculations,
+                              the power law is not extrapolated beyond it
+        :param num_machines_range: smallest and largest number of machines of the
+                                   fitted calculations, idem
+        :param machine_exponent_error: standard error of the machine exponent
+        :param machine_vif: variance inflation factor of the machine feature
+        :param condition_number: condition number of the fitted feature matrix
+        """
+        self.coefficients = np.array(coefficients, dtype=float)
+        self.scf_iterations = dict(scf_iterations)
+        self.residual_std = float(residual_std)
+        self.num_samples = int(num_samples)
+        self.max_num_pools = max_num_pools
+        self.num_machines_range = num_machines_range
+        self.machine_exponent_error = machine_exponent_error
+        self.machine_vif = machine_vif
+        self.condition_number = condition_number
+
+    @classmethod
+    def fit(cls, samples, regularization=1e-6):
+        """
+        Fits the model to samples: dicts of RESOURCE_MODEL_FEATURES, the
+        'wall_time' (s), 'scf_iterations' and 'calculation' type of a calculation
+        """
+        samples = [x for x in samples if x['wall_time'] > 0 and x['scf_iterations'] > 0]
+        if len(samples) <= len(RESOURCE_MODEL_FEATURES):
+            raise Exception("Not enough samples ({}) to fit the resource model".format(
+                            len(samples)))
+        feature_matrix = get_feature_matrix(samples)
+        iteration_times = np.log([x['wall_time']/float(x['scf_iterations'])
+                                  for x in samples])
+        # a small ridge term keeps the fit defined if e.g. num_pools never varies
+        num_columns = feature_matrix.shape[1]
+        normal_matrix = (np.dot(feature_matrix.T, feature_matrix)
+                         + regularization*len(samples)*np.eye(num_columns))
+        coefficients = np.linalg.solve(normal_matrix,
+                                       np.dot(feature_matrix.T, iteration_times))
+        residuals = iteration_times - np.dot(feature_matrix, coefficients)
+        coefficient_errors = np.std(residuals)*np.sqrt(np.diag(np.linalg.inv(normal_matrix)))
+
+        calculation_iterations = {}
+        for sample in samples:
+            calculation_iterations.setdefault(sample['calculation'], []).append(
+                sample['scf_iterations'])
+        scf_iterations = {k: float(np.median(v)) for k, v in calculation_iterations.items()}
+        num_machines = [x['num_machines'] for x in samples]
+        machine_column = RESOURCE_MODEL_FEATURES.index('num_machines') + 1
+        return cls(coefficients, scf_iterations, residual_std=np.std(residuals),
+                   num_samples=len(samples),
+                   max_num_pools=int(max(x['num_pools'] for x in samples)),
+                   num_machines_range=[int(min(num_machines)), int(max(num_machines))],
+                   machine_exponent_error=float(coefficient_errors[machine_column]),
+                   machine_vif=get_variance_inflation_factor(feature_matrix,
+                                                             machine_column),
+                   condition_number=float(np.linalg.cond(feature_matrix)))
+
+    def is_machine_exponent_determined(self, max_error=MAX_MACHINE_EXPONENT_ERROR):
+        """
+        Whether the fitted calculations used several numbers of machines, not
+        (nearly) collinear with the other features, such that the model can
+        choose them
+        """
+        return (self.num_machines_range is not None and
+                self.num_machines_range[0] < self.num_machines_range[1] and
+                self.machine_exponent_error is not None and
+                self.machine_exponent_error <= max_error)
+
+    def get_fitted_machine_options(self, machine_options):
+        """
+        The machine options within the fitted range, or the option closest to it
+        """
+        if self.num_machines_range is None:
+            return list(machine_options)
+        min_machines, max_machines = self.num_machines_range
+        fitted_options = [x for x in machine_options
+                          if min_machines <= x <= max_machines]
+        if len(fitted_options) == 0:
+            fitted_options = [min(machine_options,
+                                  key=lambda x: max(min_machines - x, x - max_machines))]
+        return fitted_options
+
+    def predict_wall_time(self, samples, calculation='scf'):
+        """
+        Predicted wall times (s) of samples (dicts of RESOURCE_MODEL_FEATURES)
+        """
+        if calculation in self.scf_iterations:
+            scf_iterations = self.scf_iterations[calculation]
+        else:
+            scf_iterations = max(self.scf_iterations.values())
+        iteration_times = np.exp(np.dot(get_feature_matrix(samples), self.coefficients))
+        return iteration_times*scf_iterations
+
+    def choose_resources(self, structure_features, calculation, machine_options,
+                         mpiprocs_per_machine, max_wallclock_seconds,
+                         safety_factor=2.0):
+        """
+        Returns the num_machines, num_pools and max_wallclock_seconds with the
+        lowest predicted node-hours among machine_options (within the fitted
+        range of machines, see get_fitted_machine_options), and the pools evenly
+        dividing the processes, at most one per k-point and at most
+        max_num_pools, whose predicted wall time, times safety_factor, is within
+        max_wallclock_seconds. If none fits, the fastest option is used.
+        """
+        candidates = []
+        for num_machines in self.get_fitted_machine_options(machine_options):
+            num_processes = num_machines*mpiprocs_per_machine
+            for num_pools in range(1, num_processes+1):
+                if (num_processes % num_pools != 0 or
+                        num_pools > structure_features['num_kpoints'] or
+                        (self.max_num_pools is not None and
+                         num_pools > self.max_num_pools)):
+                    continue
+                candidate = dict(structure_features, num_machines=num_machines,
+                                 num_pools=num_pools)
+                candidates.append(candidate)
+        if len(candidates) == 0:
+            raise Exception("No resource options to choose from")
+
+        wall_times = self.predict_wall_time(candidates, calculation=calculation)
+        # log-normal margin on top of the safety factor
+        wall_limits = safety_factor*wall_times*np.exp(self.residual_std)
+        node_hours = wall_times*np.array([x['num_machines'] for x in candidates])/3600.
+        feasible = wall_limits <= max_wallclock_seconds
+        if np.any(feasible):
+            best = np.flatnonzero(feasible)[np.argmin(node_hours[feasible])]
+        else:
+            best = np.argmin(wall_times)
+        return (candidates[best]['num_machines'], candidates[best]['num_pools'],
+                int(min(max_wallclock_seconds, np.ceil(wall_limits[best]))))
+
+    def save(self, model_path):
+        with open(model_path, 'w') as fp:
+            json.dump({'features': RESOURCE_MODEL_FEATURES,
+                       'coefficients': self.coefficients.tolist(),
+                       'scf_iterations': self.scf_iterations,
+                       'residual_std': self.residual_std,
+                       'num_samples': self.num_samples,
+                       'max_num_pools': self.max_num_pools,
+                       'num_machines_range': self.num_machines_range,
+                       'machine_exponent_error': self.machine_exponent_error,
+                       'machine_vif': self.machine_vif,
+                       'condition_number': self.condition_number}, fp, indent=2)
+
+    @classmethod
+    def load(cls, model_path):
+        with open(model_path, 'r') as fp:
+            model_dict = json.load(fp)
+        if model_dict['features'] != RESOURCE_MODEL_FEATURES:
+            raise Exception("{} was fitted with other features: {}".format(
+                            model_path, model_dict['features']))
+        return cls(model_dict['coefficients'], model_dict['scf_iterations'],
+                   residual_std=model_dict['residual_std'],
+                   num_samples=model_dict['num_samples'],
+                   max_num_pools=model_dict.get('max_num_pools'),
+                   num_machines_range=model_dict.get('num_machines_range'),
+                   machine_exponent_error=model_dict.get('machine_exponent_error'),
+                   machine_vif=model_dict.get('machine_vif'),
+                   condition_number=model_dict.get('condition_number'))
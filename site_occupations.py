@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Lightweight representation of decorated structures. A HostLattice holds the cell
+and positions of a host structure once (as read-only arrays), and each decoration
+is a small integer array giving the species index occupying every site. ase Atoms
+objects are only built, via to_atoms, when a structure is stored.
+"""
+import ase
+from ase.data import atomic_numbers
+import numpy as np
+
+
+class HostLattice(object):
+
+    def __init__(self, ase_structure, species=()):
+        """
+        :param ase_structure: the host structure
+        :param species: additional species (e.g. solutes or the vacancy symbol)
+                        which may occupy the sites of the host
+        """
+        host_symbols = ase_structure.get_chemical_symbols()
+        self.species = list(dict.fromkeys(list(host_symbols) + list(species)))
+        self.species_index = {x: i for i, x in enumerate(self.species)}
+        self.species_numbers = np.array([atomic_numbers[x] for x in self.species])
+
+        self.cell = np.array(ase_structure.get_cell())
+        self.positions = ase_structure.get_positions()
+        self.pbc = np.array(ase_structure.get_pbc())
+        self.occupation = np.array([self.species_index[x] for x in host_symbols],
+                                   dtype=np.min_scalar_type(len(self.species)))
+        for array in [self.cell, self.positions, self.pbc, self.occupation,
+                      self.species_numbers]:
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.occupation)
+
+    def decorate(self, site_indexes, symbols, occupation=None):
+        """
+        Returns a new occupation array with the given sites set to the given
+        symbols, starting from occupation (default: the host occupation)
+        """
+        if occupation is None:
+            occupation = self.occupation
+        decorated = occupation.copy()
+        decorated[list(site_indexes)] = [self.species_index[x] for x in symbols]
+        return decorated
+
+    def decorate_batch(self, site_indexes, symbol_combinations, occupation=None):
+        """
+        Returns a (num_combinations, num_sites) occupation array with each row
+        decorating site_indexes with one combination of symbols. site_indexes may
+        also be a (num_combinations, num_decorated) array giving the sites of each
+        combination.
+        """
+        if occupation is None:
+            occupation = self.occupation
+        site_indexes = np.asarray(site_indexes, dtype=int)
+        species_combinations = np.array(
+                                 [[self.species_index[x] for x in combination]
+                                  for combination in symbol_combinations],
+                                 dtype=occupation.dtype).reshape(-1, site_indexes.shape[-1])
+        decorated = np.repeat(occupation[None, :], len(species_combinations), axis=0)
+        if site_indexes.ndim == 2:
+            np.put_along_axis(decorated, site_indexes, species_combinations, axis=1)
+        else:
+            decorated[:, site_indexes] = species_combinations
+        return decorated
+
+    def decorate_random(self, symbols, concentrations, rng, exact_composition=False):
+        """
+        Returns an occupation array with every site randomly assigned one of the
+        symbols, see get_random_occupation
+        """
+        symbol_species = np.array([self.species_index[x] for x in symbols],
+                                  dtype=self.occupation.dtype)
+        return symbol_species[get_random_occupation(len(self), concentrations, rng,
+                                                    exact_composition=exact_composition)]
+
+    def get_symbols(self, occupation):
+        return [self.species[x] for x in occupation]
+
+    def to_atoms(self, occupation, vacancy_symbol=None):
+        """
+        Builds the ase Atoms object of a decoration. Sites occupied by
+        vacancy_symbol, if given, are masked out.
+        """
+        site_mask = np.ones(len(occupation), dtype=bool)
+        if vacancy_symbol in self.species_index:
+            site_mask = occupation != self.species_index[vacancy_symbol]
+        return ase.Atoms(numbers=self.species_numbers[occupation[site_mask]],
+                         positions=self.positions[site_mask],
+                         cell=self.cell.copy(),
+                         pbc=self.pbc.copy())
+
+
+def get_composition_counts(num_sites, concentrations):
+    """
+    Number of sites of each species closest to the concentrations, rounded
+    such that the counts sum to num_sites (largest remainder)
+    """
+    concentrations = np.asarray(concentrations, dtype=float)
+    if not np.allclose(np.sum(concentrations), 1):
+        raise Exception("concentrations:{} do not sum to 1".format(concentrations))
+    exact_counts = concentrations*num_sites
+    counts = np.floor(exact_counts).astype(int)
+    remainders = exact_counts - counts
+    largest_remainders = np.argsort(-remainders, kind='stable')
+    counts[largest_remainders[:num_sites - np.sum(counts)]] += 1
+    return counts
+
+
+def get_random_occupation(num_sites, concentrations, rng, exact_composition=False):
+    """
+    Randomly assigns a species index (into concentrations) to every site.
+
+    :param rng: a numpy.random.Generator
+    :param exact_composition: if True the composition is fixed to the rounded
+        concentrations and the sites are permuted, otherwise each site is drawn
+        independently with the concentrations as probabilities
+    """
+    if exact_composition:
+        counts = get_composition_counts(num_sites, concentrations)
+        return rng.permutation(np.repeat(np.arange(len(counts)), counts))
+    concentrations = np.asarray(concentrations, dtype=float)
+    if not np.allclose(np.sum(concentrations), 1):
+        raise Exception("concentrations:{} do not sum to 1".format(concentrations))
+    return rng.choice(len(concentrations), size=num_sites,
+                      p=concentrations/np.sum(concentrations))
+
+
+def get_sample_seeds(number_samples, master_seed=None):
+    """
+    Returns the master seed and one independent integer seed per sample, spawned
+    with numpy.random.SeedSequence such that the samples are reproducible from
+    the master seed alone
+    """
+    seed_sequence = np.random.SeedSequence(master_seed)
+    sample_seeds = [int(x.generate_state(1)[0])
+                    for x in seed_sequence.spawn(number_samples)]
+    return seed_sequence.entropy, sample_seeds
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Special quasirandom structure (SQS) search. The pair and triplet cluster
+correlations of a supercell decoration are optimized towards those of the
+random alloy by Monte Carlo swaps of unlike sites. The cluster counts are kept
+up to date on every swap by only re-evaluating the clusters which contain the
+two swapped sites.
+"""
+import itertools
+import numpy as np
+from math import factorial
+from neighbor_shells import get_image_shifts, get_periodic_vectors
+
+
+def get_min_image_distance(ase_structure):
+    """
+    Length of the shortest lattice vector along the periodic directions
+    (infinite without any)
+    """
+    cell = np.array(ase_structure.get_cell())
+    pbc = np.array(ase_structure.get_pbc(), dtype=bool)
+    if not np.any(pbc):
+        return np.inf
+    max_length = np.min(np.linalg.norm(cell[pbc], axis=1))
+    image_vectors = np.dot(get_image_shifts(cell, pbc, cutoff=max_length), cell)
+    image_lengths = np.linalg.norm(image_vectors, axis=1)
+    return np.min(image_lengths[image_lengths > 1e-8])
+
+
+def get_distance_clusters(ase_structure, cluster_size, cutoff, decimals=4):
+    """
+    Returns all clusters of cluster_size sites (each counted once) with all
+    pair distances within the cutoff, grouped by their sorted pair distances:
+    a list of (distances, clusters) with clusters an (n_clusters, cluster_size)
+    array of site indexes, sorted by the largest distance. The cutoff must be
+    below half the shortest periodic image distance, such that every pair of
+    sites within the cutoff is a unique minimum image (a site is not paired
+    with its own image nor appears twice in a cluster).
+    """
+    min_image_distance = get_min_image_distance(ase_structure)
+    if cutoff >= min_image_distance/2.:
+        raise Exception("The cutoff {} is not below half the shortest periodic image "
+                        "distance {:.4f} of the supercell, use a larger supercell".format(
+                        cutoff, min_image_distance))
+
+    cluster_keys = []
+    cluster_indexes = []
+    for i in range(len(ase_structure)):
+        indexes, vectors, _ = get_periodic_vectors(ase_structure, i, cutoff=cutoff)
+        # every cluster is anchored on its lowest site index
+        higher = indexes > i
+        if np.sum(higher) < cluster_size-1:
+            continue
+        site_indexes = np.concatenate([[i], indexes[higher]])
+        site_vectors = np.vstack([np.zeros((1, 3)), vectors[higher]])
+
+        combinations = np.array(list(itertools.combinations(
+                                range(1, len(site_indexes)), cluster_size-1)),
+                                dtype=int).reshape(-1, cluster_size-1)
+        combinations = np.column_stack([np.zeros(len(combinations), dtype=int),
+                                        combinations])
+        cluster_vectors = site_vectors[combinations]
+        pair_distances = np.linalg.norm(cluster_vectors[:, :, None, :]
+                                        - cluster_vectors[:, None, :, :], axis=3)
+        pair_distances = pair_distances[:, np.triu_indices(cluster_size, 1)[0],
+                                        np.triu_indices(cluster_size, 1)[1]]
+        in_cutoff = np.all(pair_distances <= cutoff + 1e-8, axis=1)
+
+        cluster_keys.append(np.sort(np.round(pair_distances[in_cutoff], decimals), axis=1))
+        cluster_indexes.append(site_indexes[combinations[in_cutoff]])
+
+    cluster_keys = np.vstack(cluster_keys)
+    cluster_indexes = np.vstack(cluster_indexes)
+    unique_keys, cluster_orbits = np.unique(cluster_keys, axis=0, return_inverse=True)
+    cluster_orbits = cluster_orbits.reshape(-1)
+
+    distance_clusters = [(unique_keys[i].tolist(), cluster_indexes[cluster_orbits == i])
+                         for i in range(len(unique_keys))]
+    return sorted(distance_clusters, key=lambda x: x[0][::-1])
+
+
+def get_random_correlations(concentrations, cluster_size):
+    """
+    Probability of each (sorted) species multiset on a cluster of the random
+    alloy, indexed by the decoration code used by SQSOptimizer
+    """
+    num_species = len(concentrations)
+    random_correlations = np.zeros(num_species**cluster_size)
+    for species in itertools.combinations_with_replacement(range(num_species),
+                                                           cluster_size):
+        species_counts = np.bincount(species, minlength=num_species)
+        multiplicity = factorial(cluster_size)/np.prod(
+                           [factorial(x) for x in species_counts])
+        code = np.dot(species, num_species**np.arange(cluster_size))
+        random_correlations[code] = multiplicity*np.prod(
+                                      np.power(concentrations, species_counts))
+    return random_correlations
+
+
+class SQSOptimizer(object):
+
+    def __init__(self, ase_structure, concentrations, pair_cutoff,
+                 triplet_cutoff=None):
+        self.concentrations = np.asarray(concentrations, dtype=float)
+        self.num_species = len(concentrations)
+        self.num_sites = len(ase_structure)
+
+        self.orbits = []
+        cluster_cutoffs = [(2, pair_cutoff), (3, triplet_cutoff)]
+        for cluster_size, cutoff in cluster_cutoffs:
+            if cutoff is None:
+                continue
+            for distances, clusters in get_distance_clusters(ase_structure,
+                                                             cluster_size, cutoff):
+                self.orbits.append({
+                    'cluster_size': cluster_size,
+                    'distances': distances,
+                    'clusters': clusters,
+                    'site_clusters': self.get_site_clusters(clusters),
+                    'code_base': self.num_species**np.arange(cluster_size),
+                    'target': get_random_correlations(self.concentrations,
+                                                      cluster_size),
+                })
+
+    def get_site_clusters(self, clusters):
+        """
+        For each site, the rows of the clusters containing it
+        """
+        cluster_rows = np.repeat(np.arange(len(clusters)), clusters.shape[1])
+        cluster_sites = clusters.ravel()
+        order = np.argsort(cluster_sites, kind='stable')
+        splits = np.searchsorted(cluster_sites[order], np.arange(1, self.num_sites))
+        return [np.unique(x) for x in np.split(cluster_rows[order], splits)]
+
+    def get_decoration_codes(self, orbit, cluster_rows, occupation):
+        species = np.sort(occupation[orbit['clusters'][cluster_rows]], axis=1)
+        return np.dot(species, orbit['code_base'])
+
+    def get_counts(self, occupation):
+        return [np.bincount(self.get_decoration_codes(
+                              x, np.arange(len(x['clusters'])), occupation),
+                            minlength=len(x['target']))
+                for x in self.orbits]
+
+    def get_objective(self, counts):
+        return sum(np.sum((x/float(len(orbit['clusters'])) - orbit['target'])**2)
+                   for x, orbit in zip(counts, self.orbits))
+
+    def swap_sites(self, occupation, counts, site_a, site_b):
+        """
+        Swaps the species on two sites in place, updating the cluster counts
+        from the clusters containing either site only
+        """
+        affected_rows = [np.union1d(x['site_clusters'][site_a], x['site_clusters'][site_b])
+                         for x in self.orbits]
+        for orbit, orbit_counts, rows in zip(self.orbits, counts, affected_rows):
+            np.subtract.at(orbit_counts, self.get_decoration_codes(orbit, rows, occupation), 1)
+        occupation[[site_a, site_b]] = occupation[[site_b, site_a]]
+        for orbit, orbit_counts, rows in zip(self.orbits, counts, affected_rows):
+            np.add.at(orbit_counts, self.get_decoration_codes(orbit, rows, occupation), 1)
+
+    def optimize(self, occupation, rng, number_steps, temperature=1e-3):
+        """
+        Monte Carlo search with a linearly decreasing temperature. The
+        occupation gives the species index of each site and is not modified.
+        Returns the best occupation found and its objective.
+        """
+        occupation = np.array(occupation)
+        counts = self.get_counts(occupation)
+        objective = self.get_objective(counts)
+        best_occupation = occupation.copy()
+        best_objective = objective
+        if len(np.unique(occupation)) < 2:
+            return best_occupation, best_objective
+
+        for step in range(number_steps):
+            site_a = rng.integers(self.num_sites)
+            unlike_sites = np.nonzero(occupation != occupation[site_a])[0]
+            site_b = unlike_sites[rng.integers(len(unlike_sites))]
+
+            self.swap_sites(occupation, counts, site_a, site_b)
+            new_objective = self.get_objective(counts)
+            step_temperature = temperature*(1. - step/float(number_steps))
+            delta = new_objective - objective
+            if delta <= 0 or (step_temperature > 0 and
+                              rng.random() < np.exp(-delta/step_temperature)):
+                objective = new_objective
+                if objective < best_objective:
+                    best_objective = objective
+                    best_occupation = occupation.copy()
+            else:
+                self.swap_sites(occupation, counts, site_a, site_b)
+
+        return best_occupation, best_objective
+
+    def get_correlations(self, occupation, species_labels):
+        """
+        Returns, per cluster orbit, the achieved and random-alloy probability of
+        each species multiset (labelled e.g. 'Al-Mg')
+        """
+        correlations = []
+        for orbit, orbit_counts in zip(self.orbits, self.get_counts(occupation)):
+            achieved = {}
+            target = {}
+            for species in itertools.combinations_with_replacement(
+                             range(self.num_species), orbit['cluster_size']):
+                code = np.dot(species, orbit['code_base'])
+                label = '-'.join([species_labels[x] for x in species])
+                achieved[label] = float(orbit_counts[code])/len(orbit['clusters'])
+                target[label] = float(orbit['target'][code])
+            correlations.append({'cluster_size': orbit['cluster_size'],
+                                 'distances': orbit['distances'],
+                                 'correlations': achieved,
+                                 'random_correlations': target})
+        return correlations
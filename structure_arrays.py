@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Fast conversion of StructureData nodes to numpy arrays. The cell, positions and
+species are read directly from the node attributes (cell, pbc1-3, kinds and
+sites) instead of building an ase Atoms object site by site with get_ase().
+Stored nodes are immutable, so the arrays of each node are memoized by uuid for
+the duration of a run, and lists of nodes are converted with a single query.
+"""
+import ase
+from ase.data import atomic_numbers
+import numpy as np
+
+STRUCTURE_ARRAYS_CACHE = {}
+
+
+def get_kind_tag(kind_name, symbol):
+    # as StructureData.get_ase: kind 'Fe2' of symbol 'Fe' gets tag 2
+    if kind_name == symbol or not kind_name.startswith(symbol):
+        return 0
+    try:
+        return int(kind_name[len(symbol):])
+    except ValueError:
+        return 0
+
+
+def get_arrays_from_attributes(attributes):
+    """
+    Returns a dict of the (read-only) cell, positions, symbols, atomic numbers,
+    masses, tags and pbc arrays of a StructureData from its attributes
+    """
+    kinds = attributes['kinds']
+    for kind in kinds:
+        if len(kind['symbols']) != 1:
+            raise Exception("Cannot convert alloy or vacancy kind {}".format(kind['name']))
+    kind_index = {x['name']: i for i, x in enumerate(kinds)}
+    kind_symbols = np.array([x['symbols'][0] for x in kinds])
+    kind_numbers = np.array([atomic_numbers[x] for x in kind_symbols], dtype=int)
+    kind_masses = np.array([x['mass'] for x in kinds], dtype=float)
+    kind_tags = np.array([get_kind_tag(x['name'], x['symbols'][0]) for x in kinds],
+                         dtype=int)
+
+    sites = attributes['sites']
+    site_kinds = np.array([kind_index[x['kind_name']] for x in sites], dtype=int)
+    structure_arrays = {
+        'cell': np.array(attributes['cell'], dtype=float),
+        'positions': np.array([x['position'] for x in sites],
+                              dtype=float).reshape(-1, 3),
+        'symbols': kind_symbols[site_kinds],
+        'numbers': kind_numbers[site_kinds],
+        'masses': kind_masses[site_kinds],
+        'tags': kind_tags[site_kinds],
+        'pbc': np.array([attributes['pbc1'], attributes['pbc2'], attributes['pbc3']]),
+    }
+    for array in structure_arrays.values():
+        array.flags.writeable = False
+    return structure_arrays
+
+
+def get_structure_arrays(structure_node):
+    """
+    Returns the arrays of a StructureData, memoized per stored node
+    """
+    if not structure_node.is_stored:
+        return get_arrays_from_attributes(structure_node.attributes)
+    if structure_node.uuid not in STRUCTURE_ARRAYS_CACHE:
+        STRUCTURE_ARRAYS_CACHE[structure_node.uuid] = get_arrays_from_attributes(
+                                                        structure_node.attributes)
+    return STRUCTURE_ARRAYS_CACHE[structure_node.uuid]
+
+
+def get_structure_arrays_batch(structure_nodes, batch_size=1000):
+    """
+    Returns the arrays of a list of StructureData. The attributes of all stored
+    nodes not yet memoized are retrieved with one query per batch_size nodes.
+    """
+    from aiida.orm import QueryBuilder, StructureData
+
+    missing_uuids = list(dict.fromkeys(
+                      [x.uuid for x in structure_nodes
+                       if x.is_stored and x.uuid not in STRUCTURE_ARRAYS_CACHE]))
+    for i in range(0, len(missing_uuids), batch_size):
+        qb = QueryBuilder()
+        qb.append(StructureData, filters={'uuid': {'in': missing_uuids[i:i+batch_size]}},
+                  project=['uuid', 'attributes'])
+        for node_uuid, attributes in qb.iterall():
+            STRUCTURE_ARRAYS_CACHE[node_uuid] = get_arrays_from_attributes(attributes)
+    return [get_structure_arrays(x) for x in structure_nodes]
+
+
+def get_ase_from_arrays(structure_arrays):
+    return ase.Atoms(numbers=structure_arrays['numbers'],
+                     positions=structure_arrays['positions'],
+                     masses=structure_arrays['masses'],
+                     tags=structure_arrays['tags'],
+                     cell=structure_arrays['cell'],
+                     pbc=structure_arrays['pbc'])
+
+
+def get_ase_structure(structure_node):
+    """
+    Drop-in replacement of StructureData.get_ase() using the memoized arrays
+    """
+    return get_ase_from_arrays(get_structure_arrays(structure_node))
+
+
+def get_reciprocal_cell(structure_arrays):
+    # as ase.Atoms.get_reciprocal_cell, i.e. without the factor 2*pi
+    return np.linalg.inv(structure_arrays['cell']).T
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+File outputs for the structure generators. Like StructureStorageBatch, each sink
+consumes (ase_structure, extras) pairs through add() and writes them in batches
+on flush(), such that the aiida_create_* scripts can write large candidate pools
+to disk without touching the database. Structures are prepared (sorted, vacancies
+removed) and deduplicated by fingerprint exactly as when stored in a group.
+
+The written pools can be read back with read_structure_pool, e.g. to import a
+selection into a group with aiida_load_structure_pool.py.
+"""
+import glob
+import json
+import os
+import ase
+import ase.io
+import numpy as np
+from aiida_create_solutesupercell_structures import (prepare_asestructure,
+                                                     get_structure_fingerprint,
+                                                     DEFAULT_FLUSH_SIZE)
+
+
+def to_jsonable(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class StructureFileSink(object):
+    """
+    Base class of the file sinks, subclasses implement write_batch
+    """
+    structure_group = None
+
+    def __init__(self, output_path, dryrun=False, flush_size=DEFAULT_FLUSH_SIZE):
+        self.output_path = os.path.abspath(output_path)
+        self.dryrun = dryrun
+        self.flush_size = int(flush_size)
+        self.fingerprints = set()
+        self.num_written = 0
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, ase_structure, extras):
+        ase_structure, extras = prepare_asestructure(ase_structure, extras)
+
+        fingerprint = get_structure_fingerprint(ase_structure)
+        if fingerprint in self.fingerprints:
+            print(("skiping structure, already written: {}".format(ase_structure)))
+            return
+        self.fingerprints.add(fingerprint)
+
+        if self.dryrun:
+            print(("structure: {}".format(ase_structure)))
+            print(("extras: {}".format(extras)))
+            return
+
+        extras = dict(extras, num_atoms=len(ase_structure),
+                      chem_formula=ase_structure.get_chemical_formula(),
+                      structure_fingerprint=fingerprint)
+        self.pending.append((ase_structure, json.dumps(extras, default=to_jsonable)))
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.write_batch(self.pending)
+        self.num_written += len(self.pending)
+        print(("{} structures written to {}".format(len(self.pending), self.output_path)))
+        self.pending = []
+
+    def write_batch(self, structures):
+        raise NotImplementedError
+
+
+class PoscarDirectorySink(StructureFileSink):
+    """
+    Writes STRUCTURE_<n> vasp POSCAR files, each with a STRUCTURE_<n>.json file
+    of its extras (the layout read by aiida_load_oqmd_dump.py)
+    """
+    def __init__(self, *args, **kwargs):
+        super(PoscarDirectorySink, self).__init__(*args, **kwargs)
+        if not self.dryrun:
+            os.makedirs(self.output_path, exist_ok=True)
+            self.num_written = len(get_poscar_files(self.output_path))
+
+    def write_batch(self, structures):
+        for i, (ase_structure, extras_json) in enumerate(structures):
+            poscar_path = os.path.join(self.output_path,
+                                       "STRUCTURE_{}".format(self.num_written+i))
+            ase_structure.write(poscar_path, format='vasp')
+            with open(poscar_path+'.json', 'w') as fp:
+                fp.write(extras_json)
+
+
+class RunnerFileSink(StructureFileSink):
+    """
+    Appends the structures to a single RuNNer input.data file (zero energies and
+    forces), with the fingerprint in the comment line
+    """
+    def write_batch(self, structures):
+        from aiida_export_group_to_runner import (write_runner_cell,
+                                                  write_runner_atomlines,
+                                                  write_runner_finalline)
+        with open(self.output_path, 'a') as fileout:
+            for ase_structure, extras_json in structures:
+                ase_structure.wrap()
+                fingerprint = json.loads(extras_json)['structure_fingerprint']
+                fileout.write("begin\ncomment structure_fingerprint: {}\n".format(
+                              fingerprint))
+                write_runner_cell(fileout, np.array(ase_structure.get_cell()))
+                write_runner_atomlines(fileout, ase_structure.get_positions(),
+                                       ase_structure.get_chemical_symbols())
+                write_runner_finalline(fileout)
+
+
+class ColumnarSink(StructureFileSink):
+    """
+    Writes each batch as one chunk_<n>.npz file of concatenated arrays: atomic
+    numbers and positions of all atoms, per structure cells, pbc and atom
+    offsets, and the extras as json strings
+    """
+    def __init__(self, *args, **kwargs):
+        super(ColumnarSink, self).__init__(*args, **kwargs)
+        if not self.dryrun:
+            os.makedirs(self.output_path, exist_ok=True)
+        self.num_chunks = len(glob.glob(os.path.join(self.output_path, 'chunk_*.npz')))
+
+    def write_batch(self, structures):
+        num_atoms = [len(x[0]) for x in structures]
+        chunk_path = os.path.join(self.output_path,
+                                  "chunk_{:05d}.npz".format(self.num_chunks))
+        np.savez(chunk_path,
+                 numbers=np.concatenate([x[0].get_atomic_numbers() for x in structures]),
+                 positions=np.concatenate([x[0].get_positions() for x in structures]),
+                 cells=np.array([np.array(x[0].get_cell()) for x in structures]),
+                 pbc=np.array([x[0].get_pbc() for x in structures]),
+                 offsets=np.concatenate([[0], np.cumsum(num_atoms)]),
+                 extras=np.array([x[1] for x in structures]))
+        self.num_chunks += 1
+
+
+def get_poscar_files(pool_path):
+    return sorted([x for x in glob.glob(os.path.join(pool_path, 'STRUCTURE_*'))
+                   if '.' not in os.path.basename(x)],
+                  key=lambda x: int(os.path.basename(x).split('_')[-1]))
+
+
+def read_structure_pool(pool_path):
+    """
+    Lazily yields the (ase_structure, extras) written by a PoscarDirectorySink or
+    a ColumnarSink
+    """
+    chunk_paths = sorted(glob.glob(os.path.join(pool_path, 'chunk_*.npz')))
+    if len(chunk_paths) == 0:
+        for poscar_path in get_poscar_files(pool_path):
+            with open(poscar_path+'.json', 'r') as fp:
+                extras = json.load(fp)
+            yield ase.io.read(poscar_path, format='vasp'), extras
+        return
+
+    for chunk_path in chunk_paths:
+        chunk = np.load(chunk_path)
+        offsets = chunk['offsets']
+        for i in range(len(offsets)-1):
+            atom_slice = slice(offsets[i], offsets[i+1])
+            yield (ase.Atoms(numbers=chunk['numbers'][atom_slice],
+                             positions=chunk['positions'][atom_slice],
+                             cell=chunk['cells'][i], pbc=chunk['pbc'][i]),
+                   json.loads(str(chunk['extras'][i])))
+
+
+def get_file_sink(output_format, output_path, dryrun=False,
+                  flush_size=DEFAULT_FLUSH_SIZE):
+    file_sinks = {'poscar': PoscarDirectorySink,
+                  'runner': RunnerFileSink,
+                  'columnar': ColumnarSink}
+    if output_format not in file_sinks:
+        raise Exception("Unknown output format: {}".format(output_format))
+    if output_path is None:
+        raise Exception("An output path is required for output format {}".format(
+                        output_format))
+    return file_sinks[output_format](output_path, dryrun=dryrun, flush_size=flush_size)
@@ -0,0 +1,37 @@
+import itertools
+
+import numpy as np
+from ase.build import bulk
+
+from neighbor_shells import get_minimum_image_distances
+
+
+def get_brute_force_distance(cell, max_coefficient=8):
+    coefficients = np.array(list(itertools.product(
+                     range(-max_coefficient, max_coefficient+1), repeat=3)))
+    coefficients = coefficients[np.any(coefficients != 0, axis=1)]
+    return np.min(np.linalg.norm(np.dot(coefficients, cell), axis=1))
+
+
+def get_skewed_supercells(cell, num_cells=50, seed=0):
+    rng = np.random.RandomState(seed)
+    supercell_matrices = [np.array([[1, -1, -1], [0, 3, -1], [-1, 0, 2]])]
+    while len(supercell_matrices) < num_cells:
+        supercell_matrix = rng.randint(-3, 4, size=(3, 3))
+        if abs(np.linalg.det(supercell_matrix)) > 0.5:
+            supercell_matrices.append(supercell_matrix)
+    return np.einsum('cij,jk->cik', np.array(supercell_matrices), cell)
+
+
+def test_minimum_image_distances_skewed_cells():
+    monoclinic_cell = np.array([[4.1, 0., 0.], [0., 5.3, 0.], [-1.7, 0., 6.2]])
+    for cell in [np.array(bulk('Mg', 'hcp', a=3.2, c=5.2).get_cell()), monoclinic_cell]:
+        supercells = get_skewed_supercells(cell)
+        assert np.allclose(get_minimum_image_distances(supercells),
+                           [get_brute_force_distance(x) for x in supercells])
+
+
+def test_minimum_image_distance_hcp():
+    hcp_cell = np.array(bulk('Mg', 'hcp', a=3.2, c=5.2).get_cell())
+    supercell = np.dot(np.array([[1, -1, -1], [0, 3, -1], [-1, 0, 2]]), hcp_cell)
+    assert np.isclose(get_minimum_image_distances(supercell[None, :, :])[0], 3.2)
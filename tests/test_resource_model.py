@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from resource_model import ResourceModel
+
+EXPONENTS = [0.9, 1.6, 0.5, -0.85, -0.2]
+
+
+def get_samples(independent_machines=True, num_samples=400, seed=0):
+    rng = np.random.RandomState(seed)
+    samples = []
+    for _ in range(num_samples):
+        num_machines = rng.choice([2, 4, 8, 16])
+        if independent_machines:
+            num_bands = rng.randint(20, 800)
+        else:
+            # machines chosen from the problem size only
+            num_bands = 50*num_machines
+        sample = {'num_kpoints': rng.randint(1, 200), 'num_bands': num_bands,
+                  'volume': rng.uniform(50, 3000), 'num_machines': num_machines,
+                  'num_pools': rng.choice([1, 2, 4, 8]),
+                  'scf_iterations': rng.randint(8, 20), 'calculation': 'scf'}
+        iteration_time = 1e-4*np.exp(rng.normal(0, 0.05))*np.prod(
+            [sample[x]**y for x, y in zip(['num_kpoints', 'num_bands', 'volume',
+                                           'num_machines', 'num_pools'], EXPONENTS)])
+        sample['wall_time'] = iteration_time*sample['scf_iterations']
+        samples.append(sample)
+    return samples
+
+
+def test_fit_choose_roundtrip(tmpdir):
+    resource_model = ResourceModel.fit(get_samples())
+    assert np.allclose(resource_model.coefficients[1:], EXPONENTS, atol=0.05)
+    assert resource_model.is_machine_exponent_determined()
+    assert resource_model.num_machines_range == [2, 16]
+
+    model_path = str(tmpdir.join('resource_model.json'))
+    resource_model.save(model_path)
+    loaded_model = ResourceModel.load(model_path)
+    assert np.allclose(loaded_model.coefficients, resource_model.coefficients)
+    assert loaded_model.num_machines_range == resource_model.num_machines_range
+
+    structure_features = {'num_kpoints': 64, 'num_bands': 300, 'volume': 1000.}
+    num_machines, num_pools, wallclock_seconds = loaded_model.choose_resources(
+        structure_features, 'scf', list(range(2, 41, 2)), 24, 8*3600)
+    # candidates beyond the fitted machines are not extrapolated to
+    assert 2 <= num_machines <= 16
+    assert (num_machines*24) % num_pools == 0 and num_pools <= 8
+    assert wallclock_seconds <= 8*3600
+
+
+def test_collinear_machines_undetermined():
+    resource_model = ResourceModel.fit(get_samples(independent_machines=False))
+    assert not resource_model.is_machine_exponent_determined()
+
+
+def test_fitted_machine_options():
+    resource_model = ResourceModel.fit(get_samples())
+    assert resource_model.get_fitted_machine_options([1, 2, 10, 20]) == [2, 10]
+    assert resource_model.get_fitted_machine_options([18, 20, 24]) == [18]
+
+
+def test_not_enough_samples():
+    with pytest.raises(Exception):
+        ResourceModel.fit(get_samples(num_samples=3))